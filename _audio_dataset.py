@@ -0,0 +1,386 @@
+#!/usr/bin/env python
+# (c) Copyright 2015 by James Stout
+# Licensed under the LGPL, see <http://www.gnu.org/licenses/>
+
+"""Sharded, append-only storage for saved utterance audio.
+
+Instead of writing a .wav and .txt file per utterance, samples are appended to
+size-capped shard files (shard-00000.dat, shard-00001.dat, ...) and described by
+fixed-size records in a single index file (index.dat). Each shard record is the
+UTF-8 words immediately followed by the audio bytes; the index holds the shard
+number, offset, lengths, result type and timestamp of every sample.
+
+Reading loads the index once and memory-maps each shard, so iterating over
+samples of a given type does not touch the filesystem per sample.
+
+Audio can optionally be stored with a lossless codec (see CODECS), and the
+dataset can be capped in total size or per result type. Each result type is
+appended to its own shards, so that when a cap is exceeded, the shards holding
+the oldest samples can be deleted whole instead of being rewritten.
+"""
+
+import array
+from collections import namedtuple
+from itertools import accumulate
+import lzma
+import mmap
+import os
+import struct
+import sys
+import time
+import zlib
+
+# Recognition types, in index encoding order.
+RESULT_TYPES = ("dictation", "grammar", "mixed", "reject")
+
+INDEX_FILENAME = "index.dat"
+SHARD_FILENAME = "shard-%05d.dat"
+
+# 64 MB shards keep the file count low without making any single file unwieldy.
+DEFAULT_MAX_SHARD_BYTES = 64 * 1024 * 1024
+
+# Audio codecs, in index encoding order. The "delta" codecs store the difference
+# between consecutive 16-bit samples, which compresses much better than raw PCM.
+CODECS = ("raw", "zlib", "delta-zlib", "delta-lzma")
+
+# Evictions free space down to this fraction of a cap, so that the index is not
+# rewritten on every append once the cap is reached.
+EVICTION_TARGET = 0.9
+
+# Shard number, offset, words length, audio length, result type and codec,
+# timestamp. The result type is stored in the low four bits and the codec in the
+# high four bits of the same byte.
+_INDEX_RECORD = struct.Struct("<IQIIBd")
+
+Sample = namedtuple("Sample", ["words", "result_type", "timestamp", "audio"])
+
+_IndexEntry = namedtuple("_IndexEntry", ["shard", "offset", "words_length",
+                                         "audio_length", "type_and_codec", "timestamp"])
+
+
+def get_result_type(details, res_obj):
+    """Returns the recognition type of a Natlink results object."""
+    if details == "reject":
+        return "reject"
+
+    # Check the rules for each word.
+    # Anything between 1 and 1000000 (exclusive) is a grammar word.
+    # 0 is used as the rule number for free-form dictation.
+    rules = [r for _, r in res_obj.getResults(0)]
+    grammar_words = len([r for r in rules if 0 < r < 1000000])
+    if grammar_words > 0:
+        return "mixed" if 1000000 in rules else "grammar"
+    else:
+        return "dictation"
+
+
+def _type_code(entry):
+    return entry.type_and_codec & 0x0f
+
+
+def _codec_code(entry):
+    return entry.type_and_codec >> 4
+
+
+def _entry_bytes(entry):
+    return entry.words_length + entry.audio_length
+
+
+#-------------------------------------------------------------------------------
+# Codecs. Audio is treated as little-endian 16-bit PCM; a trailing odd byte is
+# kept as-is so that encoding is lossless for any input.
+
+def _wrap_int16(value):
+    return ((value + 0x8000) & 0xffff) - 0x8000
+
+
+def _to_samples(audio):
+    even_length = len(audio) - len(audio) % 2
+    samples = array.array("h")
+    samples.frombytes(bytes(audio[:even_length]))
+    if sys.byteorder == "big":
+        samples.byteswap()
+    return samples, bytes(audio[even_length:])
+
+
+def _from_samples(samples, tail):
+    if sys.byteorder == "big":
+        samples.byteswap()
+    return samples.tobytes() + tail
+
+
+def delta_encode(audio):
+    samples, tail = _to_samples(audio)
+    deltas = array.array("h", [_wrap_int16(current - previous)
+                               for previous, current in zip([0] + samples[:-1].tolist(), samples)])
+    return _from_samples(deltas, tail)
+
+
+def delta_decode(data):
+    deltas, tail = _to_samples(data)
+    samples = array.array("h", accumulate(deltas, lambda total, delta: _wrap_int16(total + delta)))
+    return _from_samples(samples, tail)
+
+
+def encode_audio(audio, codec):
+    if codec == "raw":
+        return bytes(audio)
+    if codec == "zlib":
+        return zlib.compress(audio)
+    if codec == "delta-zlib":
+        return zlib.compress(delta_encode(audio))
+    if codec == "delta-lzma":
+        return lzma.compress(delta_encode(audio))
+    raise ValueError("Unknown codec: " + codec)
+
+
+def decode_audio(data, codec):
+    if codec == "raw":
+        return bytes(data)
+    if codec == "zlib":
+        return zlib.decompress(data)
+    if codec == "delta-zlib":
+        return delta_decode(zlib.decompress(data))
+    if codec == "delta-lzma":
+        return delta_decode(lzma.decompress(data))
+    raise ValueError("Unknown codec: " + codec)
+
+
+class AudioDataset(object):
+    """Append-only dataset of utterance audio stored in size-capped shards.
+
+    The same instance can be used for writing (append) and reading (samples).
+    The directory must already exist. New samples are encoded with the given
+    codec; existing samples keep whatever codec they were written with.
+
+    max_bytes caps the total size of stored samples, evicting the oldest samples
+    of any type. max_bytes_by_type caps individual result types, e.g.
+    {"dictation": 10 ** 9} keeps every other type but caps dictation. Samples are
+    evicted a shard at a time, so caps should be several times max_shard_bytes.
+    Shards written before types were kept apart may hold several types, and are
+    evicted whole regardless.
+    """
+
+    def __init__(self, directory, max_shard_bytes=DEFAULT_MAX_SHARD_BYTES,
+                 codec="raw", max_bytes=None, max_bytes_by_type=None):
+        if not os.path.isdir(directory):
+            raise ValueError("Dataset directory does not exist: " + directory)
+        if codec not in CODECS:
+            raise ValueError("Unknown codec: " + codec)
+        self.directory = directory
+        self.max_shard_bytes = max_shard_bytes
+        self.codec = codec
+        self.max_bytes = max_bytes
+        self.max_bytes_by_type = max_bytes_by_type or {}
+        self._index = self._read_index()
+        self._index_file = None
+        # Open shard number and file of each result type.
+        self._shards = {}
+        self._shard_files = {}
+        self._next_shard = max(entry.shard for entry in self._index) + 1 if self._index else 0
+        self._maps = {}
+        self._bytes_by_type = dict((result_type, 0) for result_type in RESULT_TYPES)
+        for entry in self._index:
+            self._bytes_by_type[RESULT_TYPES[_type_code(entry)]] += _entry_bytes(entry)
+
+    def _shard_path(self, shard):
+        return os.path.join(self.directory, SHARD_FILENAME % shard)
+
+    def _read_index(self):
+        path = os.path.join(self.directory, INDEX_FILENAME)
+        if not os.path.exists(path):
+            return []
+        with open(path, "rb") as index_file:
+            data = index_file.read()
+        # Ignore a partially written trailing record.
+        data = data[:len(data) - len(data) % _INDEX_RECORD.size]
+        return [_IndexEntry(*fields) for fields in _INDEX_RECORD.iter_unpack(data)]
+
+    def __len__(self):
+        return len(self._index)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    #---------------------------------------------------------------------------
+    # Writing.
+
+    def _open_shard_for_append(self, result_type, record_length):
+        """Returns the shard number and offset to append the record at. Each
+        result type gets its own shards, starting with a new one when opened."""
+        shard_file = self._shard_files.get(result_type)
+        if shard_file:
+            size = shard_file.tell()
+            if size > 0 and size + record_length > self.max_shard_bytes:
+                shard_file.close()
+                shard_file = None
+        if not shard_file:
+            self._shards[result_type] = self._next_shard
+            self._next_shard += 1
+            shard_file = open(self._shard_path(self._shards[result_type]), "ab")
+            self._shard_files[result_type] = shard_file
+        return self._shards[result_type], shard_file.tell()
+
+    def append(self, audio, words, result_type, timestamp=None):
+        """Appends a sample, evicting old samples if a cap is exceeded. Returns
+        the sample number, or None if the sample was itself evicted. The number
+        is the sample's current position, which shifts as older samples are
+        evicted, so it should not be stored."""
+        if timestamp is None:
+            timestamp = time.time()
+        type_code = RESULT_TYPES.index(result_type)
+        words_bytes = words.encode("utf-8")
+        data = encode_audio(audio, self.codec)
+        shard, offset = self._open_shard_for_append(result_type, len(words_bytes) + len(data))
+        shard_file = self._shard_files[result_type]
+        shard_file.write(words_bytes)
+        shard_file.write(data)
+        shard_file.flush()
+        # The index is written last, so a crash can only leave unreferenced
+        # bytes at the end of a shard.
+        entry = _IndexEntry(shard, offset, len(words_bytes), len(data),
+                            type_code | CODECS.index(self.codec) << 4, timestamp)
+        if not self._index_file:
+            self._index_file = open(os.path.join(self.directory, INDEX_FILENAME), "ab")
+        self._index_file.write(_INDEX_RECORD.pack(*entry))
+        self._index_file.flush()
+        self._index.append(entry)
+        self._bytes_by_type[result_type] += _entry_bytes(entry)
+        self._enforce_quota()
+        if self._index and self._index[-1] is entry:
+            return len(self._index) - 1
+        return None
+
+    #---------------------------------------------------------------------------
+    # Eviction.
+
+    def size(self, result_type=None):
+        """Returns the stored size in bytes, optionally of a single type."""
+        if result_type is None:
+            return sum(self._bytes_by_type.values())
+        return self._bytes_by_type[result_type]
+
+    def _over_quota(self):
+        return (any(self._bytes_by_type[result_type] > max_bytes
+                    for result_type, max_bytes in self.max_bytes_by_type.items())
+                or (self.max_bytes is not None and self.size() > self.max_bytes))
+
+    def _enforce_quota(self):
+        # Sizes are kept as running totals, so the index is only scanned when a
+        # cap is exceeded.
+        if not self._over_quota():
+            return
+        entries_by_shard = {}
+        for entry in self._index:
+            entries_by_shard.setdefault(entry.shard, []).append(entry)
+        evicted = set()
+        for result_type, max_bytes in self.max_bytes_by_type.items():
+            if self._bytes_by_type[result_type] > max_bytes:
+                type_code = RESULT_TYPES.index(result_type)
+                self._evict_oldest(evicted, entries_by_shard, max_bytes, result_type,
+                                   lambda entry: _type_code(entry) == type_code)
+        if self.max_bytes is not None and self.size() > self.max_bytes:
+            self._evict_oldest(evicted, entries_by_shard, self.max_bytes, None,
+                               lambda entry: True)
+        if evicted:
+            self._remove(evicted)
+
+    def _evict_oldest(self, evicted, entries_by_shard, max_bytes, result_type, predicate):
+        """Adds the shards of the oldest samples matching the predicate to the
+        evicted shards, until the size is under the eviction target."""
+        target = max_bytes * EVICTION_TARGET
+        for entry in self._index:
+            if self.size(result_type) <= target:
+                return
+            if entry.shard in evicted or not predicate(entry):
+                continue
+            evicted.add(entry.shard)
+            for shard_entry in entries_by_shard[entry.shard]:
+                self._bytes_by_type[RESULT_TYPES[_type_code(shard_entry)]] -= (
+                    _entry_bytes(shard_entry))
+
+    def _remove(self, evicted):
+        """Removes the given shards and their samples. Only the index is
+        rewritten; no sample data is copied."""
+        for result_type, shard in list(self._shards.items()):
+            if shard in evicted:
+                self._shard_files.pop(result_type).close()
+                del self._shards[result_type]
+        for shard in evicted:
+            shard_map = self._maps.pop(shard, None)
+            if shard_map is not None:
+                shard_map.close()
+        if self._index_file:
+            self._index_file.close()
+            self._index_file = None
+        new_index = [entry for entry in self._index if entry.shard not in evicted]
+        # Replace the index before deleting anything it used to point to.
+        index_path = os.path.join(self.directory, INDEX_FILENAME)
+        with open(index_path + ".tmp", "wb") as index_file:
+            for entry in new_index:
+                index_file.write(_INDEX_RECORD.pack(*entry))
+        os.replace(index_path + ".tmp", index_path)
+        for shard in evicted:
+            os.remove(self._shard_path(shard))
+        self._index = new_index
+
+    #---------------------------------------------------------------------------
+    # Reading.
+
+    def _map(self, shard, end):
+        shard_map = self._maps.get(shard)
+        if shard_map is None or len(shard_map) < end:
+            # The shard may have grown since it was mapped.
+            if shard_map is not None:
+                shard_map.close()
+            with open(self._shard_path(shard), "rb") as shard_file:
+                shard_map = mmap.mmap(shard_file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[shard] = shard_map
+        return shard_map
+
+    def _read(self, entry):
+        words_end = entry.offset + entry.words_length
+        audio_end = words_end + entry.audio_length
+        shard_map = self._map(entry.shard, audio_end)
+        return Sample(shard_map[entry.offset:words_end].decode("utf-8"),
+                      RESULT_TYPES[_type_code(entry)],
+                      entry.timestamp,
+                      decode_audio(shard_map[words_end:audio_end],
+                                   CODECS[_codec_code(entry)]))
+
+    def count(self, result_type=None):
+        """Returns the number of samples, optionally of a single type."""
+        if result_type is None:
+            return len(self._index)
+        type_code = RESULT_TYPES.index(result_type)
+        return sum(1 for entry in self._index if _type_code(entry) == type_code)
+
+    def samples(self, result_type=None):
+        """Yields samples in the order they were saved, optionally filtered by
+        result type ("dictation", "grammar", "mixed" or "reject").
+        """
+        type_code = None if result_type is None else RESULT_TYPES.index(result_type)
+        for entry in list(self._index):
+            if type_code is None or _type_code(entry) == type_code:
+                yield self._read(entry)
+
+    def __getitem__(self, i):
+        return self._read(self._index[i])
+
+    def _close_files(self):
+        for shard_map in self._maps.values():
+            shard_map.close()
+        self._maps = {}
+        for shard_file in self._shard_files.values():
+            shard_file.close()
+        self._shards = {}
+        self._shard_files = {}
+        if self._index_file:
+            self._index_file.close()
+            self._index_file = None
+
+    def close(self):
+        self._close_files()
@@ -13,28 +13,41 @@ DLL_DIRECTORY: Path to directory containing DLLs used in this module. Missing
 CHROME_DRIVER_PATH: Path to chrome driver executable.
 """
 
-from collections import OrderedDict
+from collections import OrderedDict, deque
 import copy
+import ctypes
 import json
 import os
 import os.path
 import platform
-from six import text_type
+from six import string_types, text_type
 import tempfile
+import threading
+import time
+import traceback
 
 from dragonfly import (
     ActionBase,
+    Clipboard,
+    Context,
+    Dictation,
     DynStrActionBase,
+    ElementBase,
     Function,
     Grammar,
     Key,
+    ListRef,
     MappingRule,
     Pause,
+    RecognitionObserver,
     Repetition,
+    RuleRef,
+    RuleWrap,
     Sequence,
     StartApp,
     Text,
     WaitWindow,
+    get_engine,
 )
 from dragonfly.windows.window import Window
 
@@ -78,28 +91,91 @@ class Delete(object):
         return "Delete(" + self.key + ")"
 
 
-def combine_maps(*maps):
+class ActionInterner(object):
+    """Maps identical actions to a single canonical action (a flyweight).
+
+    Actions are compared by type and attributes, recursing into actions they
+    contain (e.g. in an ActionSeries). Any other attribute which isn't a plain
+    value, such as the function of a Function action, is compared by identity.
+    Attributes derived from the spec are ignored.
+    """
+
+    _IGNORED_ATTRIBUTES = frozenset(["_str", "_events"])
+
+    def __init__(self):
+        self._canonical = {}
+        self.interned_count = 0
+        self.deduplicated_count = 0
+
+    def intern(self, action):
+        if not isinstance(action, ActionBase):
+            return action
+        canonical = self._canonical.setdefault(self._action_key(action), action)
+        self.interned_count += 1
+        if canonical is not action:
+            self.deduplicated_count += 1
+        return canonical
+
+    def _action_key(self, action):
+        return (type(action),) + tuple((attribute, self._value_key(value))
+                                       for (attribute, value) in sorted(vars(action).items())
+                                       if attribute not in self._IGNORED_ATTRIBUTES)
+
+    def _value_key(self, value):
+        if value is None or isinstance(value, (bool, int, float, string_types, bytes)):
+            return value
+        if type(value) in (list, tuple):
+            return tuple(self._value_key(item) for item in value)
+        if type(value) in (set, frozenset):
+            return ("set",) + tuple(sorted(repr(self._value_key(item)) for item in value))
+        if type(value) is dict:
+            return tuple(sorted((repr(key), self._value_key(item)) for (key, item) in value.items()))
+        if isinstance(value, ActionBase):
+            return self._action_key(value)
+        # Canonical actions keep their attributes alive, so ids in their keys
+        # are not reused.
+        return ("id", id(value))
+
+    def clear(self):
+        """Releases the canonical actions, e.g. when their grammars unload."""
+        self._canonical.clear()
+
+    def report(self):
+        return "%d of %d actions deduplicated" % (self.deduplicated_count, self.interned_count)
+
+
+def _intern_action(value, action_interner):
+    return action_interner.intern(value) if action_interner else value
+
+
+def combine_maps(*maps, action_interner=None):
     """Merge the contents of multiple maps.
 
-    Does not allow deletions or overrides. Skips empty maps.
+    Does not allow deletions or overrides. Skips empty maps. If an action
+    interner is provided, the actions in the result are interned.
     """
     # Use OrderedDict to maintain possible ordering in the source maps.
     result = OrderedDict()
+    # Check duplicates against the values as given, since interning makes equal
+    # actions identical.
+    originals = {}
     for map in maps:
         if not map:
             continue
         for key, value in map.items():
-            if key in result and result[key] != value:
+            if key in originals and originals[key] != value:
                 raise ValueError("Key already exists: {}. Use combine_maps_checked to override.".format(key))
-            result[key] = value
+            originals[key] = value
+            result[key] = _intern_action(value, action_interner)
     return result
 
 
-def combine_maps_checked(*maps):
+def combine_maps_checked(*maps, action_interner=None):
     """Merge the contents of multiple maps allowing deletion and override.
 
     Wrap keys in Override and Delete to perform those operations. Skips empty
-    maps.
+    maps. If an action interner is provided, the actions in the result are
+    interned.
     """
     # Use OrderedDict to maintain possible ordering in the source maps.
     result = OrderedDict()
@@ -107,6 +183,7 @@ def combine_maps_checked(*maps):
         if not map:
             continue
         for key, value in map.items():
+            value = _intern_action(value, action_interner)
             if isinstance(key, Delete):
                 if value is not None:
                     raise ValueError("Delete key has non-None value: {}".format(key))
@@ -124,9 +201,9 @@ def combine_maps_checked(*maps):
     return result
 
 
-def text_map_to_action_map(text_map):
+def text_map_to_action_map(text_map, action_interner=None):
     """Converts string values in a map to text actions."""
-    return dict((k, Text(v.replace("%", "%%")))
+    return dict((k, _intern_action(Text(v.replace("%", "%%")), action_interner))
                 for (k, v) in text_map.items())
 
 
@@ -146,9 +223,9 @@ def _printable_to_key_action_spec(printable):
     return printable
 
 
-def text_map_to_key_action_map(text_map):
+def text_map_to_key_action_map(text_map, action_interner=None):
     """Converts string values in a map to key actions."""
-    return dict((k, Key(_printable_to_key_action_spec(v)))
+    return dict((k, _intern_action(Key(_printable_to_key_action_spec(v)), action_interner))
                 for (k, v) in text_map.items())
 
 
@@ -184,12 +261,80 @@ def renamed_element(name, element):
     element_copy.name = name
     return element_copy
 
-def element_map_to_extras(element_map):
+
+class ElementInterner(object):
+    """Maps structurally identical elements to a single canonical element.
+
+    Elements are compared by type, attributes and children, recursing into the
+    private rules of RuleWraps. Any attribute which isn't a plain value or an
+    element (e.g. a value function or a list) is compared by identity, so
+    elements are only merged if they are certain to behave the same. Sharing
+    a RuleWrap means its private rule is compiled once per grammar instead of
+    once per copy.
+    """
+
+    # Attributes which are covered by children, or differ between instances.
+    _IGNORED_ATTRIBUTES = frozenset(["_id", "_children", "_child", "_extras", "_rule", "_builders"])
+
+    def __init__(self):
+        self._canonical = {}
+        self.interned_count = 0
+        self.deduplicated_count = 0
+
+    def intern(self, element):
+        canonical = self._canonical.setdefault(self._element_key(element, root=True), element)
+        self.interned_count += 1
+        if canonical is not element:
+            self.deduplicated_count += 1
+        return canonical
+
+    def _element_key(self, element, root=False):
+        key = [type(element)]
+        for (attribute, value) in sorted(vars(element).items()):
+            if attribute in self._IGNORED_ATTRIBUTES or (root and attribute == "name"):
+                continue
+            key.append((attribute, self._value_key(value)))
+        if isinstance(element, RuleWrap):
+            key.append(self._element_key(element.rule.element))
+        elif isinstance(element, RuleRef):
+            key.append(self._value_key(element.rule))
+        else:
+            key.append(tuple(self._element_key(child) for child in element.children))
+        return tuple(key)
+
+    def _value_key(self, value):
+        if value is None or isinstance(value, (bool, int, float, string_types, bytes)):
+            return value
+        # Exact types, so that dragonfly lists are compared by identity.
+        if type(value) in (list, tuple):
+            return tuple(self._value_key(item) for item in value)
+        if type(value) is dict:
+            return tuple(sorted((repr(key), self._value_key(item)) for (key, item) in value.items()))
+        if isinstance(value, ElementBase):
+            return self._element_key(value)
+        # Canonical elements keep their attributes alive, so ids in their keys
+        # are not reused.
+        return ("id", id(value))
+
+    def clear(self):
+        """Releases the canonical elements, e.g. when their grammars unload."""
+        self._canonical.clear()
+
+    def report(self):
+        return "%d of %d elements deduplicated" % (self.deduplicated_count, self.interned_count)
+
+
+def element_map_to_extras(element_map, interner=None):
     """Converts an element map to a standard named element list that may be used in
-    MappingRule.
+    MappingRule. If an interner is provided, elements are canonicalized first.
     """
-    return [renamed_element(name, element[0] if isinstance(element, tuple) else element)
-            for (name, element) in element_map.items()]
+    extras = []
+    for (name, element) in element_map.items():
+        element = element[0] if isinstance(element, tuple) else element
+        if interner:
+            element = interner.intern(element)
+        extras.append(renamed_element(name, element))
+    return extras
 
 
 def element_map_to_defaults(element_map):
@@ -199,19 +344,61 @@ def element_map_to_defaults(element_map):
                  if isinstance(element, tuple)])
 
 
-def create_rule(name, action_map, element_map=None, exported=False, context=None):
+def create_rule(name, action_map, element_map=None, exported=False, context=None,
+                element_interner=None):
     """Creates a rule with the given name, binding the given element map to the
-    action map.
+    action map. If an element interner is provided, identical elements are
+    shared with other rules created with it.
     """
     element_map = element_map if element_map else {}
     return MappingRule(name,
                        action_map,
-                       element_map_to_extras(element_map),
+                       element_map_to_extras(element_map, element_interner),
                        element_map_to_defaults(element_map),
                        exported,
                        context=context)
 
 
+def _identity_key(element_map):
+    return frozenset((name, id(value)) for (name, value) in element_map.items())
+
+
+class RuleRegistry(object):
+    """Creates private rules, reusing a previously created rule when the action and
+    element maps hold the same objects under the same specs. Child environments
+    which don't change a map can then share their ancestor's rule instead of
+    building an identical one. Rules are created with the given element interner.
+
+    With share=False every call creates a rule, so that the load time and
+    resident memory can be compared with and without sharing.
+    """
+
+    def __init__(self, element_interner=None, share=True):
+        self._element_interner = element_interner
+        self._share = share
+        self._rules = {}
+        self.created_count = 0
+        self.reused_count = 0
+
+    def create_rule(self, name, action_map, element_map=None):
+        element_map = element_map if element_map else {}
+        key = (_identity_key(action_map), _identity_key(element_map))
+        entry = self._rules.get(key) if self._share else None
+        if entry:
+            self.reused_count += 1
+            return entry[0]
+        rule = create_rule(name, action_map, element_map,
+                           element_interner=self._element_interner)
+        self.created_count += 1
+        if self._share:
+            # Keep the maps so the ids in the key stay valid.
+            self._rules[key] = (rule, action_map, element_map)
+        return rule
+
+    def report(self):
+        return "%d rules created, %d reused" % (self.created_count, self.reused_count)
+
+
 def combine_contexts(context1, context2):
     """Combine two contexts using "&", treating None as equivalent to a context that
     matches everything.
@@ -223,6 +410,146 @@ def combine_contexts(context1, context2):
     return context1 & context2
 
 
+class ContextResolver(object):
+    """Finds the active node in a tree of environments for a window.
+
+    Nodes must have children and unmerged_context (their context relative to
+    their parent, or None to always match) attributes. Starting from the root,
+    the resolver descends into the first child whose context matches, so each
+    context is evaluated at most once per window. The result is memoized until
+    the foreground window (executable, title or handle) changes, or the value
+    of extra_key_function(executable, title, handle), if provided.
+    """
+
+    def __init__(self, root, extra_key_function=None):
+        self._root = root
+        self._extra_key_function = extra_key_function
+        self._window_key = None
+        self._active_node = None
+        self.resolve_count = 0
+
+    def resolve(self, executable, title, handle):
+        window_key = (executable, title, handle,
+                      self._extra_key_function(executable, title, handle)
+                      if self._extra_key_function else None)
+        if window_key != self._window_key:
+            self._active_node = self._resolve(executable, title, handle)
+            self._window_key = window_key
+            self.resolve_count += 1
+        return self._active_node
+
+    def _resolve(self, executable, title, handle):
+        node = self._root
+        if node.unmerged_context and not node.unmerged_context.matches(executable, title, handle):
+            return None
+        while True:
+            for child in node.children:
+                if (not child.unmerged_context
+                    or child.unmerged_context.matches(executable, title, handle)):
+                    node = child
+                    break
+            else:
+                return node
+
+    def reset(self):
+        self._window_key = None
+        self._active_node = None
+
+
+class ResolvedContext(Context):
+    """Context which matches when the resolver picks the given node."""
+
+    def __init__(self, resolver, node):
+        Context.__init__(self)
+        self._resolver = resolver
+        self._node = node
+        self._str = getattr(node, "name", "")
+
+    def matches(self, executable, title, handle):
+        return self._resolver.resolve(executable, title, handle) is self._node
+
+
+def _reads_node(value, seen=None):
+    """Returns whether executing the value could read the "_node" extra, which
+    is bound to the node of the recognition that built it.
+    """
+    if seen is None:
+        seen = set()
+    if id(value) in seen:
+        return False
+    seen.add(id(value))
+    if isinstance(value, Function):
+        return not value._filter_keywords or "_node" in value._valid_keywords
+    if isinstance(value, ActionBase):
+        value = vars(value)
+    if isinstance(value, dict):
+        value = list(value.values())
+    if isinstance(value, (list, tuple)):
+        return any(_reads_node(item, seen) for item in value)
+    return False
+
+
+class ActionCache(object):
+    """Bounded cache of the values built from recognitions, keyed on the
+    recognizing grammar and the recognized words and rule IDs. Least recently
+    used entries are evicted beyond capacity.
+
+    Recognitions which include dictation or references to the given dynamic
+    lists bypass the cache, since their values depend on more than the words.
+    Values with functions that read "_node" are not cached, since they would
+    keep the node of the first recognition.
+    """
+
+    def __init__(self, capacity=1000, dynamic_lists=()):
+        self.capacity = capacity
+        self._dynamic_lists = set(id(lst) for lst in dynamic_lists)
+        self._values = OrderedDict()
+        self.hit_count = 0
+        self.miss_count = 0
+        self.bypass_count = 0
+
+    def __len__(self):
+        return len(self._values)
+
+    def key(self, grammar, node):
+        """Returns the cache key for a recognition, or None if it is uncacheable."""
+        stack = [node]
+        while stack:
+            child = stack.pop()
+            if (isinstance(child.actor, Dictation) or
+                (isinstance(child.actor, ListRef) and id(child.actor.list) in self._dynamic_lists)):
+                self.bypass_count += 1
+                return None
+            stack.extend(child.children)
+        return (grammar.name, tuple(node.full_results()))
+
+    def get(self, key):
+        value = self._values.get(key)
+        if value is None:
+            self.miss_count += 1
+        else:
+            self.hit_count += 1
+            self._values.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        if _reads_node(value):
+            self.bypass_count += 1
+            return
+        self._values[key] = value
+        if len(self._values) > self.capacity:
+            self._values.popitem(last=False)
+
+    def clear(self):
+        self._values.clear()
+
+    def report(self):
+        lookups = self.hit_count + self.miss_count
+        return "%d hits, %d misses (%.0f%% hit rate), %d bypassed, %d cached" % (
+            self.hit_count, self.miss_count, 100.0 * self.hit_count / lookups if lookups else 0,
+            self.bypass_count, len(self._values))
+
+
 class ModifiedAction(ActionBase):
     def __init__(self, name, action):
         ActionBase.__init__(self)
@@ -298,30 +625,122 @@ class UniversalPaste(ActionBase):
             Key("c-v").execute()
 
 
+class TextOutput(object):
+    """Types text as keystrokes, or pastes it if it is at least as long as the
+    threshold of the current environment. Pasting saves the clipboard, sets it
+    to the text, pastes using UniversalPaste and then restores the clipboard.
+
+    Thresholds are keyed on environment name; the recognizing rule sets the
+    current environment. A threshold of None always types.
+    """
+
+    def __init__(self, default_threshold=None, thresholds=None, restore_delay=0.1,
+                 clipboard_class=Clipboard, paste_action=None):
+        self.default_threshold = default_threshold
+        self.thresholds = thresholds or {}
+        self.restore_delay = restore_delay
+        self.clipboard_class = clipboard_class
+        self.paste_action = paste_action or UniversalPaste()
+        self.environment = None
+        self.typed_count = 0
+        self.pasted_count = 0
+
+    def threshold(self):
+        return self.thresholds.get(self.environment, self.default_threshold)
+
+    def output(self, text):
+        threshold = self.threshold()
+        if threshold is None or len(text) < threshold:
+            self.typed_count += 1
+            Text(text).execute()
+        else:
+            self.pasted_count += 1
+            self.paste(text)
+
+    def paste(self, text):
+        saved = self.clipboard_class(from_system=True)
+        self.clipboard_class.set_system_text(text)
+        try:
+            self.paste_action.execute()
+            # The target application may read the clipboard asynchronously.
+            time.sleep(self.restore_delay)
+        finally:
+            saved.copy_to_system()
+
+    def report(self):
+        return "%d texts typed, %d pasted" % (self.typed_count, self.pasted_count)
+
+
 class FormattedText(DynStrActionBase):
-    """Types text after running through formatter function."""
+    """Types text after running through formatter function. If a TextOutput is
+    provided, the text is output through it instead, so long text may be pasted.
+    """
 
-    def __init__(self, spec, formatter):
+    def __init__(self, spec, formatter, output=None):
         DynStrActionBase.__init__(self, spec)
         self.formatter = formatter
+        self.output = output
 
     def _parse_spec(self, spec):
         return spec
 
     def _execute_events(self, events):
-        Text(self.formatter(events)).execute()
+        text = self.formatter(events)
+        if self.output:
+            self.output.output(text)
+        else:
+            Text(text).execute()
+
+
+def _unformatted(text):
+    return text
+
+
+def output_text_action(spec, output):
+    """Like Text, but pastes long text according to the TextOutput."""
+    return FormattedText(spec, _unformatted, output)
 
 
-def lowercase_text_action(spec):
-    return FormattedText(spec, lambda text: text.lower())
+def lowercase_text_action(spec, output=None):
+    return FormattedText(spec, lambda text: text.lower(), output)
 
 
-def uncapitalize_text_action(spec):
-    return FormattedText(spec, lambda text: text[0].lower() + text[1:])
+def uncapitalize_text_action(spec, output=None):
+    return FormattedText(spec, lambda text: text[0].lower() + text[1:], output)
 
 
-def capitalize_text_action(spec):
-    return FormattedText(spec, lambda text: text[0].upper() + text[1:])
+def capitalize_text_action(spec, output=None):
+    return FormattedText(spec, lambda text: text[0].upper() + text[1:], output)
+
+
+def get_resident_memory():
+    """Returns the resident memory of this process in bytes, or None if unknown."""
+    if platform.system() == "Windows":
+        from ctypes import wintypes
+
+        class ProcessMemoryCounters(ctypes.Structure):
+            _fields_ = [("cb", wintypes.DWORD),
+                        ("PageFaultCount", wintypes.DWORD),
+                        ("PeakWorkingSetSize", ctypes.c_size_t),
+                        ("WorkingSetSize", ctypes.c_size_t),
+                        ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                        ("PagefileUsage", ctypes.c_size_t),
+                        ("PeakPagefileUsage", ctypes.c_size_t)]
+
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        if not ctypes.windll.psapi.GetProcessMemoryInfo(
+                ctypes.windll.kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb):
+            return None
+        return counters.WorkingSetSize
+    try:
+        with open("/proc/self/statm") as statm_file:
+            return int(statm_file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, ValueError):
+        return None
 
 
 def load_json(filename):
@@ -333,11 +752,82 @@ def load_json(filename):
         return None
 
 
+def load_grammar(grammar):
+    """Loads a grammar along with the current contents of its lists. Loading
+    pushes each list only to the last grammar it was added to, so a list shared
+    with another grammar would otherwise be empty in this one."""
+    grammar.load()
+    for lst in grammar.lists:
+        if lst.grammar is not grammar:
+            grammar.update_list(lst)
+
+
+class LazyGrammarLoader(object):
+    """Loads grammars the first time their context matches, instead of at
+    startup. Must be updated on the engine thread with the foreground window.
+
+    Grammars whose context has not matched for idle_timeout seconds are unloaded
+    again, unless idle_timeout is None.
+    """
+
+    def __init__(self, grammars, idle_timeout=None):
+        self._grammars = grammars
+        self.idle_timeout = idle_timeout
+        self._last_match_times = {}
+        self.load_count = 0
+        self.unload_count = 0
+
+    def add(self, grammar):
+        self._grammars.append(grammar)
+
+    def update(self, executable, title, handle):
+        now = time.time()
+        for grammar in self._grammars:
+            if not grammar.context or grammar.context.matches(executable, title, handle):
+                self._last_match_times[grammar] = now
+                if not grammar.loaded:
+                    load_grammar(grammar)
+                    self.load_count += 1
+            elif (grammar.loaded and self.idle_timeout is not None
+                  and now - self._last_match_times.get(grammar, 0) >= self.idle_timeout):
+                grammar.unload()
+                self.unload_count += 1
+
+    def unload(self):
+        for grammar in self._grammars:
+            grammar.unload()
+        self._last_match_times.clear()
+
+    def report(self):
+        return "%d of %d grammars loaded on demand" % (
+            len([grammar for grammar in self._grammars if grammar.loaded]), len(self._grammars))
+
+
+class _BeginCallbackGrammar(Grammar):
+    """Grammar which calls a function at the start of every utterance."""
+
+    def __init__(self, name, begin_callback):
+        Grammar.__init__(self, name)
+        self._begin_callback = begin_callback
+
+    def _process_begin(self, executable, title, handle):
+        self._begin_callback(executable, title, handle)
+
+
 class GrammarController(object):
-    """Wraps grammars so they can be turned on and off by command."""
+    """Wraps grammars so they can be turned on and off by command.
+
+    Lazy grammars are only loaded once their context matches, checked at the
+    start of each utterance and every poll_interval seconds (if set), so they are
+    usually loaded before speech begins. See LazyGrammarLoader.
+    """
 
-    def __init__(self, name, grammars):
-        self._controlled_grammars = grammars
+    def __init__(self, name, grammars, lazy_grammars=None, idle_timeout=None, poll_interval=None):
+        self._controlled_grammars = list(grammars) + list(lazy_grammars or [])
+        self._eager_grammars = list(grammars)
+        self.loader = (LazyGrammarLoader(list(lazy_grammars), idle_timeout)
+                       if lazy_grammars is not None else None)
+        self.loaded = False
         self.enabled = True
         rule = create_rule(name + "_mode",
                            {
@@ -345,8 +835,12 @@ class GrammarController(object):
                                name + " (on|open)": Function(lambda: self.enable()),
                            },
                            exported=True)
-        self._command_grammar = Grammar(name + "_mode")
+        self._command_grammar = _BeginCallbackGrammar(name + "_mode", self._process_begin)
         self._command_grammar.add_rule(rule)
+        self._timer = None
+        if self.loader and poll_interval:
+            self._timer = get_engine().create_timer(self._poll, poll_interval)
+            self._timer.stop()
 
     def enable(self):
         if not self.enabled:
@@ -360,12 +854,413 @@ class GrammarController(object):
                 grammar.disable()
         self.enabled = False
 
+    def add(self, grammar, lazy=False):
+        """Adds a grammar, loading it now if the controller is loaded and the
+        grammar is not lazy."""
+        self._controlled_grammars.append(grammar)
+        if not self.enabled:
+            grammar.disable()
+        if lazy:
+            self.loader.add(grammar)
+        else:
+            self._eager_grammars.append(grammar)
+            if self.loaded:
+                load_grammar(grammar)
+
+    def _process_begin(self, executable, title, handle):
+        if self.loader and self.enabled:
+            self.loader.update(executable, title, handle)
+
+    def _poll(self):
+        window = Window.get_foreground()
+        self._process_begin(window.executable, window.title, window.handle)
+
     def load(self):
-        for grammar in self._controlled_grammars:
-            grammar.load()
+        for grammar in self._eager_grammars:
+            load_grammar(grammar)
         self._command_grammar.load()
+        if self.loader:
+            self._poll()
+        if self._timer:
+            self._timer.start()
+        self.loaded = True
 
     def unload(self):
-        for grammar in self._controlled_grammars:
+        self.loaded = False
+        if self._timer:
+            self._timer.stop()
+        for grammar in self._eager_grammars:
             grammar.unload()
+        if self.loader:
+            self.loader.unload()
         self._command_grammar.unload()
+
+
+class _WakeObserver(RecognitionObserver):
+    """Wakes a callback queue at the start of each utterance."""
+
+    def __init__(self, queue):
+        RecognitionObserver.__init__(self)
+        self._queue = queue
+
+    def on_begin(self):
+        self._queue.wake()
+
+
+class CallbackQueue(object):
+    """Queue of callbacks to run on the engine thread, typically added from other
+    threads. Must be created and stopped on the engine thread.
+
+    Callbacks added with the same key are coalesced: only the latest one runs, in
+    the position of the first. Each timer tick runs callbacks until the time
+    budget (in seconds) is spent.
+
+    The timer only runs while there is work, so an idle engine isn't woken up.
+    Engine timers may only be started on the engine thread, so put() starts the
+    timer when called there, and callbacks added from other threads wait until
+    wake() is called on the engine thread, which happens at the start of each
+    utterance. While any function passed to keep_awake() returns true, the timer
+    keeps running even if the queue is empty, so that callbacks added by another
+    thread run promptly.
+    """
+
+    def __init__(self, interval=0.05, budget=0.02, clock=time.perf_counter):
+        self.budget = budget
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._callbacks = OrderedDict()
+        self._awake_functions = []
+        self._engine_thread = threading.current_thread()
+        self._timer = get_engine().create_timer(self._run, interval)
+        self._timer.stop()
+        self._observer = _WakeObserver(self)
+        self._observer.register()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._callbacks)
+
+    def put(self, callback, key=None):
+        """Adds a callback, replacing any pending callback with the same key. Safe
+        to call from any thread."""
+        with self._lock:
+            self._callbacks[key if key is not None else object()] = callback
+        if threading.current_thread() is self._engine_thread:
+            self._timer.start()
+
+    def keep_awake(self, function):
+        """Keeps the timer running while function() returns true."""
+        self._awake_functions.append(function)
+
+    def wake(self):
+        """Starts the timer if there is work. Call on the engine thread."""
+        if self._has_work():
+            self._timer.start()
+
+    def _has_work(self):
+        with self._lock:
+            if self._callbacks:
+                return True
+        return any(function() for function in self._awake_functions)
+
+    def _run(self):
+        deadline = self._clock() + self.budget
+        while self._clock() < deadline:
+            with self._lock:
+                if not self._callbacks:
+                    break
+                _, callback = self._callbacks.popitem(last=False)
+            try:
+                callback()
+            except Exception:
+                traceback.print_exc()
+        if not self._has_work():
+            self._timer.stop()
+
+    def stop(self):
+        self._observer.unregister()
+        self._timer.stop()
+        with self._lock:
+            self._callbacks.clear()
+
+
+class ActionCancelled(Exception):
+    """Raised in the executor's worker thread to stop a cancelled job."""
+
+
+class ActionExecutor(object):
+    """Runs jobs (typically the actions of one utterance) on a worker thread,
+    strictly in the order they were submitted, so that slow actions don't stop
+    the engine from delivering the next recognition.
+
+    A job which has run for more than stuck_timeout seconds when the next job is
+    submitted is cancelled, as is everything pending. Cancellation raises
+    ActionCancelled in the worker thread, which takes effect once the job
+    returns to Python code (e.g. after a blocking socket call times out). It may
+    interrupt an action series midway, e.g. while a modifier is held down, so
+    on_cancel (if given) is called on the worker thread after a cancelled job to
+    restore a known state.
+
+    Must be created, submitted to and stopped on the engine thread. Actions
+    which call into the engine must run on the engine thread; see
+    EngineThreadAction. They run through engine_callbacks, a CallbackQueue which
+    is kept awake while jobs are pending or running.
+    """
+
+    def __init__(self, engine_callbacks, stuck_timeout=None, on_cancel=None):
+        self.stuck_timeout = stuck_timeout
+        self.on_cancel = on_cancel
+        self.executed_count = 0
+        self.cancelled_count = 0
+        self.max_depth = 0
+        self.engine_callbacks = engine_callbacks
+        self._jobs = deque()
+        self._condition = threading.Condition()
+        self._running_since = None
+        self._cancelling = False
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="ActionExecutor")
+        self._thread.daemon = True
+        self._thread.start()
+        engine_callbacks.keep_awake(self.depth)
+
+    def submit(self, job):
+        with self._condition:
+            if (self.stuck_timeout is not None and self._running_since is not None
+                and time.time() - self._running_since > self.stuck_timeout):
+                print("Cancelling action stuck for %.1f seconds" % (time.time() - self._running_since))
+                self._cancel()
+            self._jobs.append(job)
+            self.max_depth = max(self.max_depth, self._depth())
+            self._condition.notify_all()
+        self.engine_callbacks.wake()
+
+    def _depth(self):
+        return len(self._jobs) + (self._running_since is not None)
+
+    def depth(self):
+        """Returns the number of jobs pending or running."""
+        with self._condition:
+            return self._depth()
+
+    def is_worker_thread(self):
+        return threading.current_thread() is self._thread
+
+    def cancel(self):
+        """Cancels the running job and drops pending jobs."""
+        with self._condition:
+            self._cancel()
+
+    def _cancel(self):
+        self.cancelled_count += len(self._jobs)
+        self._jobs.clear()
+        if self._running_since is not None and not self._cancelling:
+            self._cancelling = True
+            self.cancelled_count += 1
+            ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(self._thread.ident),
+                                                       ctypes.py_object(ActionCancelled))
+
+    def _run(self):
+        while True:
+            try:
+                if not self._run_next():
+                    return
+            except ActionCancelled:
+                # Cancellation arrived after the job finished.
+                with self._condition:
+                    self._running_since = None
+                    self._cancelling = False
+                    self._condition.notify_all()
+
+    def _run_next(self):
+        with self._condition:
+            while not self._jobs and not self._stopped:
+                self._condition.wait()
+            if self._stopped:
+                return False
+            job = self._jobs.popleft()
+            self._running_since = time.time()
+        cancelled = False
+        try:
+            job()
+        except ActionCancelled:
+            print("Cancelled action")
+            cancelled = True
+        except Exception:
+            traceback.print_exc()
+        with self._condition:
+            if self._cancelling:
+                # Clear the exception if it hasn't been raised yet.
+                ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(self._thread.ident), None)
+        # While still marked as cancelling, on_cancel won't be interrupted.
+        if cancelled and self.on_cancel:
+            try:
+                self.on_cancel()
+            except Exception:
+                traceback.print_exc()
+        with self._condition:
+            self._running_since = None
+            self._cancelling = False
+            self.executed_count += 1
+            self._condition.notify_all()
+        return True
+
+    def wait(self, timeout=None):
+        """Waits until no jobs are pending or running. Returns whether they
+        finished in time."""
+        deadline = time.time() + timeout if timeout is not None else None
+        with self._condition:
+            while self._depth():
+                remaining = deadline - time.time() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._cancel()
+            self._condition.notify_all()
+
+    def report(self):
+        with self._condition:
+            return "%d jobs executed, %d cancelled, queue depth %d (max %d)" % (
+                self.executed_count, self.cancelled_count, self._depth(), self.max_depth)
+
+
+class EngineThreadAction(ActionBase):
+    """Runs an action on the engine thread, even if it is executed by the action
+    executor (which may be None). Needed for actions which call the engine, such
+    as Mimic."""
+
+    def __init__(self, action, executor):
+        super(EngineThreadAction, self).__init__()
+        self.action = action
+        self.executor = executor
+
+    def _execute(self, data=None):
+        executor = self.executor
+        if not executor or not executor.is_worker_thread():
+            return self.action.execute(data)
+        done = threading.Event()
+        results = []
+
+        def callback():
+            try:
+                results.append(self.action.execute(data))
+            finally:
+                done.set()
+
+        executor.engine_callbacks.put(callback)
+        # Wait in short intervals so that the job can be cancelled.
+        while not done.wait(0.1):
+            pass
+        return results[0] if results else False
+
+
+class StagedLoader(object):
+    """Runs startup stages in order, one per engine timer tick, so that the
+    engine stays responsive, and grammars loaded by earlier stages usable, while
+    later stages run. If interval is None, or a stage is added with
+    blocking=True, the stage runs as soon as it is added, and exceptions
+    propagate to the caller. Blocking stages should be added before any others.
+
+    Exceptions of the types in fatal_errors cancel the remaining stages and are
+    re-raised from the timer callback; other exceptions are printed.
+
+    Records when each stage finished, in seconds since start_time (from
+    time.perf_counter).
+    """
+
+    def __init__(self, start_time, interval=None, fatal_errors=()):
+        self._start_time = start_time
+        self._fatal_errors = fatal_errors
+        self._stages = deque()
+        self.timings = OrderedDict()
+        self._timer = None
+        if interval is not None:
+            self._timer = get_engine().create_timer(self._run_next, interval)
+            self._timer.stop()
+
+    def add_stage(self, name, callback, blocking=False):
+        if self._timer and not blocking:
+            self._stages.append((name, callback))
+            self._timer.start()
+        else:
+            callback()
+            self.timings[name] = time.perf_counter() - self._start_time
+
+    def _run_next(self):
+        if self._stages:
+            name, callback = self._stages.popleft()
+            try:
+                callback()
+            except self._fatal_errors:
+                self.stop()
+                raise
+            except Exception:
+                traceback.print_exc()
+            self.timings[name] = time.perf_counter() - self._start_time
+        if not self._stages:
+            self._timer.stop()
+
+    @property
+    def done(self):
+        return not self._stages
+
+    def stop(self):
+        if self._timer:
+            self._timer.stop()
+        self._stages.clear()
+
+
+class ListUpdater(object):
+    """Updates a dragonfly list at a bounded rate. Must be called on the engine
+    thread.
+
+    Updates which don't change the contents of the list are skipped, and updates
+    which arrive within min_interval seconds of the last applied update are
+    batched so that only the latest is applied. A dragonfly list only pushes
+    changes to the last grammar it was added to, so the list is also explicitly
+    updated in every other loaded grammar that uses it.
+    """
+
+    def __init__(self, dragonfly_list, grammars, min_interval=5.0):
+        self._list = dragonfly_list
+        self._grammars = grammars
+        self.min_interval = min_interval
+        self.applied_count = 0
+        self.skipped_count = 0
+        self._pending = None
+        self._last_update_time = None
+        self._timer = get_engine().create_timer(self._apply_pending, min_interval)
+        self._timer.stop()
+
+    def update(self, items):
+        self._pending = list(items)
+        if (self._last_update_time is None
+            or time.time() - self._last_update_time >= self.min_interval):
+            self._apply_pending()
+        else:
+            self._timer.start()
+
+    def _apply_pending(self):
+        self._timer.stop()
+        items, self._pending = self._pending, None
+        if items is None:
+            return
+        if set(items) == set(self._list):
+            self.skipped_count += 1
+            return
+        self._last_update_time = time.time()
+        self.applied_count += 1
+        self._list.set(items)
+        for grammar in self._grammars:
+            if (grammar.loaded and grammar is not self._list.grammar
+                and any(lst is self._list for lst in grammar.lists)):
+                grammar.update_list(self._list)
+
+    def stop(self):
+        self._timer.stop()
+        self._pending = None
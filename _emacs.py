@@ -9,11 +9,12 @@ from dragonfly import (
     MappingRule,
     Text,
 )
+import _emacs_utils as emacs
 import _linux_utils as linux
 
 
 def Exec(command):
-    return Key("a-x") + Text(command) + Key("enter")
+    return emacs.EmacsCommand(command, Key("a-x") + Text(command) + Key("enter"))
 
 
 class CommandRule(MappingRule):
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# (c) Copyright 2015 by James Stout
+# Licensed under the LGPL, see <http://www.gnu.org/licenses/>
+
+"""Channel for running commands in Emacs directly instead of through keystrokes.
+
+This is the reverse of the TextRequestHandler server: Emacs listens on a local
+port and evaluates requests over a persistent connection. Requests and responses
+are single lines of JSON:
+
+  {"id": 1, "method": "command", "params": {"name": "revert-buffer"}}
+  {"id": 1, "result": null}
+  {"id": 2, "error": "Unknown method: foo"}
+
+Methods:
+
+  command: Calls the interactive command "name".
+  mark-lines: Pushes the mark, then marks lines "start" through "end" (or just
+    "start"), like MarkLinesAction. "tight" marks from the indentation to the end
+    of the last line; "tree" marks the tree at "start".
+  use-lines: Marks lines like mark-lines, optionally in the other window
+    ("other_buffer"), then copies or kills them ("operation" is "copy" or
+    "kill"), returns to the original position and yanks them.
+
+If Emacs isn't listening, callers fall back to keystrokes and the channel doesn't
+try again until the retry interval has passed. Callers also fall back to
+keystrokes when the foreground window isn't a local Emacs, such as Emacs in a
+remote Linux session, since the channel only connects to the local Emacs.
+"""
+
+import json
+import os.path
+import socket
+import threading
+import time
+
+from dragonfly import ActionBase, Window
+
+import _dragonfly_local as local
+import _linux_utils as linux
+
+
+class EmacsError(Exception):
+    """Emacs returned an error for a request."""
+
+
+class EmacsUnavailableError(Exception):
+    """The request could not be sent to Emacs, so it was not run."""
+
+
+class EmacsChannel(object):
+    """Persistent connection to Emacs. Safe to use from multiple threads."""
+
+    def __init__(self, host="127.0.0.1", port=9091, timeout=2.0, retry_interval=30.0):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        self.request_count = 0
+        self.fallback_count = 0
+        self._socket = None
+        self._file = None
+        self._next_id = 1
+        self._unavailable_until = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        now = time.time()
+        if self._unavailable_until is not None and now < self._unavailable_until:
+            raise EmacsUnavailableError("Emacs unavailable, retrying in %.0f seconds" %
+                                        (self._unavailable_until - now))
+        try:
+            self._socket = socket.create_connection((self.host, self.port), self.timeout)
+        except (socket.error, socket.timeout) as e:
+            self._unavailable_until = now + self.retry_interval
+            raise EmacsUnavailableError("Could not connect to Emacs: %s" % e)
+        self._unavailable_until = None
+        self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._file = self._socket.makefile("rb")
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def _close(self):
+        if self._socket:
+            self._file.close()
+            self._socket.close()
+        self._socket = None
+        self._file = None
+
+    def _send(self, data):
+        """Sends the data and returns the first response line, or None if the
+        connection closed first. In that case, Emacs didn't see the request."""
+        if not self._socket:
+            self._connect()
+        try:
+            self._socket.sendall(data)
+            return self._file.readline()
+        except socket.timeout:
+            raise
+        except socket.error:
+            return None
+
+    def call(self, method, **params):
+        """Runs the method in Emacs and returns its result. Raises
+        EmacsUnavailableError if Emacs didn't receive the request, EmacsError if
+        the request failed in Emacs, and socket.timeout if Emacs didn't respond in
+        time."""
+        with self._lock:
+            request_id = self._next_id
+            self._next_id += 1
+            data = json.dumps({"id": request_id, "method": method, "params": params}).encode("utf-8") + b"\n"
+            try:
+                line = self._send(data)
+                if not line:
+                    # Emacs may have closed an idle connection. Reconnect once.
+                    self._close()
+                    line = self._send(data)
+                    if not line:
+                        raise EmacsUnavailableError("Emacs closed the connection")
+                response = json.loads(line.decode("utf-8"))
+                while response.get("id") != request_id:
+                    # Skip responses to requests which timed out.
+                    line = self._file.readline()
+                    if not line:
+                        raise EmacsError("Emacs closed the connection before responding")
+                    response = json.loads(line.decode("utf-8"))
+            except (EmacsError, EmacsUnavailableError, socket.timeout, ValueError):
+                self._close()
+                raise
+            self.request_count += 1
+        if "error" in response:
+            raise EmacsError(response["error"])
+        return response.get("result")
+
+    def report(self):
+        return "%d requests, %d keystroke fallbacks" % (self.request_count, self.fallback_count)
+
+
+channel = (EmacsChannel(port=local.EMACS_RPC_PORT) if getattr(local, "EMACS_RPC_PORT", None)
+           else None)
+
+
+def is_local_emacs_foreground():
+    """Returns whether the foreground window is an Emacs on this machine."""
+    window = Window.get_foreground()
+    return (os.path.basename(window.executable).lower().startswith("emacs")
+            and not linux.IsRemoteTitle(window.title))
+
+
+def run(method, **params):
+    """Runs the method over the channel. Returns False if the caller should fall
+    back to keystrokes because the request could not be sent to the foreground
+    Emacs."""
+    if not channel or not is_local_emacs_foreground():
+        return False
+    try:
+        channel.call(method, **params)
+    except EmacsUnavailableError:
+        channel.fallback_count += 1
+        return False
+    except (EmacsError, socket.timeout) as e:
+        # Emacs may have run the request, so don't repeat it with keystrokes.
+        print("Emacs %s request failed: %s" % (method, e))
+    return True
+
+
+class EmacsCommand(ActionBase):
+    """Runs an interactive Emacs command, or the fallback action if the channel is
+    unavailable."""
+
+    def __init__(self, command, fallback):
+        super(EmacsCommand, self).__init__()
+        self.command = command
+        self.fallback = fallback
+
+    def _execute(self, data=None):
+        if not run("command", name=self.command):
+            self.fallback.execute(data)
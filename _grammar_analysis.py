@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# (c) Copyright 2015 by James Stout
+# Licensed under the LGPL, see <http://www.gnu.org/licenses/>
+
+"""Complexity analysis of dragonfly grammars.
+
+Walks the element tree of a grammar's exported rules, following rule
+references, and estimates how large the grammar is once compiled:
+
+  rules: number of distinct rules referenced, including private RuleWrap rules.
+  list_entries: total number of entries across referenced lists.
+  repetition_depth, alternative_depth: maximum nesting of each element type.
+  log10_expansions: number of distinct word sequences the rules accept, counting
+    each dictation as a single wildcard.
+  states: number of word positions in the compiled grammar. Each rule is counted
+    once, but elements repeated within a rule (e.g. by Repetition) are counted
+    each time.
+
+Budgets are dicts from any of these field names to a maximum.
+"""
+
+from collections import namedtuple, OrderedDict
+import math
+
+from dragonfly import (
+    Alternative,
+    Dictation,
+    Empty,
+    Impossible,
+    ListRef,
+    Literal,
+    Optional,
+    Repetition,
+    RuleRef,
+    Sequence,
+)
+
+GrammarStats = namedtuple("GrammarStats", [
+    "name", "rules", "list_entries", "repetition_depth", "alternative_depth",
+    "log10_expansions", "states",
+])
+
+
+class GrammarBudgetError(Exception):
+    pass
+
+
+class GrammarAnalyzer(object):
+    """Computes GrammarStats. Results for each element are memoized, so elements
+    shared across rules and grammars are only walked once per analyzer."""
+
+    def __init__(self):
+        self._expansions = {}
+        self._states = {}
+        self._depths = {}
+
+    def analyze_grammar(self, grammar):
+        return self.analyze_rules(grammar.name, [rule for rule in grammar.rules if rule.exported])
+
+    def analyze_rules(self, name, rules):
+        referenced_rules = OrderedDict()
+        lists = {}
+        stack = [rule.element for rule in rules]
+        for rule in rules:
+            referenced_rules[id(rule)] = rule
+        visited = set()
+        while stack:
+            element = stack.pop()
+            if id(element) in visited:
+                continue
+            visited.add(id(element))
+            if isinstance(element, RuleRef):
+                if id(element.rule) not in referenced_rules:
+                    referenced_rules[id(element.rule)] = element.rule
+                    stack.append(element.rule.element)
+            elif isinstance(element, ListRef):
+                lists[element.list.name] = len(element.list)
+            else:
+                stack.extend(element.children)
+        expansions = sum(self.expansions(rule.element) for rule in rules)
+        repetition_depth, alternative_depth = 0, 0
+        for rule in rules:
+            depths = self.depths(rule.element)
+            repetition_depth = max(repetition_depth, depths[0])
+            alternative_depth = max(alternative_depth, depths[1])
+        return GrammarStats(
+            name=name,
+            rules=len(referenced_rules),
+            list_entries=sum(lists.values()),
+            repetition_depth=repetition_depth,
+            alternative_depth=alternative_depth,
+            log10_expansions=math.log10(expansions) if expansions else float("-inf"),
+            states=sum(self.states(rule.element) for rule in referenced_rules.values()))
+
+    def _memoized(self, cache, element, compute):
+        # Keep a reference to the element so its id is not reused.
+        entry = cache.get(id(element))
+        if entry is None:
+            entry = cache[id(element)] = (element, compute(element))
+        return entry[1]
+
+    def expansions(self, element):
+        return self._memoized(self._expansions, element, self._compute_expansions)
+
+    def _compute_expansions(self, element):
+        if isinstance(element, RuleRef):
+            return self.expansions(element.rule.element)
+        if isinstance(element, ListRef):
+            return len(element.list)
+        if isinstance(element, (Literal, Dictation, Empty)):
+            return 1
+        if isinstance(element, Impossible):
+            return 0
+        if isinstance(element, Optional):
+            return 1 + self.expansions(element.children[0])
+        if isinstance(element, Alternative):
+            return sum(self.expansions(child) for child in element.children)
+        # Sequences, including Repetitions, and any other wrapper.
+        product = 1
+        for child in element.children:
+            product *= self.expansions(child)
+        return product
+
+    def states(self, element):
+        return self._memoized(self._states, element, self._compute_states)
+
+    def _compute_states(self, element):
+        if isinstance(element, RuleRef):
+            # The referenced rule is counted separately.
+            return 1
+        if isinstance(element, ListRef):
+            return sum(len(entry.split()) for entry in element.list) or 1
+        if isinstance(element, Literal):
+            return len(element.words)
+        if isinstance(element, Dictation):
+            return 1
+        return sum(self.states(child) for child in element.children)
+
+    def depths(self, element):
+        """Returns the nesting depths of Repetitions and Alternatives."""
+        return self._memoized(self._depths, element, self._compute_depths)
+
+    def _compute_depths(self, element):
+        if isinstance(element, RuleRef):
+            children = [element.rule.element]
+        elif isinstance(element, ListRef):
+            children = []
+        else:
+            children = element.children
+        repetition_depth, alternative_depth = 0, 0
+        for child in children:
+            depths = self.depths(child)
+            repetition_depth = max(repetition_depth, depths[0])
+            alternative_depth = max(alternative_depth, depths[1])
+        # Choices between a single child are not really alternatives.
+        if isinstance(element, Alternative) and len(children) > 1:
+            alternative_depth += 1
+        if isinstance(element, Repetition):
+            repetition_depth += 1
+        return repetition_depth, alternative_depth
+
+
+def analyze_grammars(grammars):
+    analyzer = GrammarAnalyzer()
+    return [analyzer.analyze_grammar(grammar) for grammar in grammars]
+
+
+def format_report(stats_list):
+    lines = ["%-24s %6s %8s %6s %6s %10s %10s" % (
+        "grammar", "rules", "entries", "rep", "alt", "log10 exp", "states")]
+    for stats in stats_list:
+        lines.append("%-24s %6d %8d %6d %6d %10.1f %10d" % (
+            stats.name, stats.rules, stats.list_entries, stats.repetition_depth,
+            stats.alternative_depth, stats.log10_expansions, stats.states))
+    return "\n".join(lines)
+
+
+def check_budget(stats_list, budget):
+    """Returns a description of each budget violation."""
+    violations = []
+    for stats in stats_list:
+        for field, limit in sorted(budget.items()):
+            value = getattr(stats, field)
+            if value > limit:
+                violations.append("%s: %s is %s, over budget of %s" % (stats.name, field, value, limit))
+    return violations
+
+
+def enforce_budget(stats_list, budget):
+    violations = check_budget(stats_list, budget)
+    if violations:
+        raise GrammarBudgetError("Grammar budget exceeded:\n" + "\n".join(violations))
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# (c) Copyright 2015 by James Stout
+# Licensed under the LGPL, see <http://www.gnu.org/licenses/>
+
+"""Caches of parsed and compiled keystrokes for dragonfly Key and Text actions.
+
+dragonfly parses a static spec when the action is created, but converts the
+parsed spec into keyboard events on every execution. Dynamic specs such as
+"left:%(n)d" are also parsed again on every execution. Once installed, a
+KeystrokeCache keeps:
+
+  parsed specs, keyed on the action type and spec. This includes each
+    interpolated dynamic spec, and the static specs of actions created while
+    processing recognitions (e.g. modifier combinations).
+  keyboard events, keyed on the action type, spec, hardware mode and typing
+    pause.
+
+Both are bounded, evicting the least recently used entries. Keyboard events
+depend on the keyboard layout, so clear the cache after switching layouts.
+"""
+
+from collections import OrderedDict
+
+from dragonfly import Key, Text
+from dragonfly.actions.action_base import ActionError
+
+
+class KeystrokeCache(object):
+    """Must be installed to take effect, and uninstalled before another cache is
+    installed."""
+
+    def __init__(self, capacity=10000):
+        self.capacity = capacity
+        self._parsed = OrderedDict()
+        self._compiled = OrderedDict()
+        self.parse_hits = 0
+        self.parse_misses = 0
+        self.compile_hits = 0
+        self.compile_misses = 0
+        self._originals = {}
+
+    def _lookup(self, cache, key):
+        value = cache.get(key)
+        if value is not None:
+            cache.move_to_end(key)
+        return value
+
+    def _store(self, cache, key, value):
+        cache[key] = value
+        if len(cache) > self.capacity:
+            cache.popitem(last=False)
+
+    def parse(self, action, spec):
+        key = (type(action), spec)
+        events = self._lookup(self._parsed, key)
+        if events is None:
+            self.parse_misses += 1
+            base_class = Text if isinstance(action, Text) else Key
+            events = self._originals[base_class, "_parse_spec"](action, spec)
+            self._store(self._parsed, key, events)
+        else:
+            self.parse_hits += 1
+        return events
+
+    def compile(self, action, spec, use_hardware):
+        key = (type(action), spec, use_hardware, getattr(action, "_pause", None))
+        keyboard_events = self._lookup(self._compiled, key)
+        if keyboard_events is None:
+            self.compile_misses += 1
+            events = action._events if action._static else action._parse_spec(spec)
+            if isinstance(action, Text):
+                keyboard_events = _compile_text(action, events, use_hardware)
+            else:
+                keyboard_events = _compile_key(action, events, use_hardware)
+            self._store(self._compiled, key, keyboard_events)
+        else:
+            self.compile_hits += 1
+        return keyboard_events
+
+    def clear(self):
+        self._parsed.clear()
+        self._compiled.clear()
+
+    def install(self):
+        """Replaces parsing and execution of Key and Text actions."""
+        cache = self
+        for cls in (Key, Text):
+            if (cls, "_execute") in self._originals:
+                continue
+            original_execute = cls._execute
+            self._originals[cls, "_execute"] = original_execute
+            self._originals[cls, "_parse_spec"] = cls._parse_spec
+
+            def parse_spec(action, spec):
+                return cache.parse(action, spec)
+
+            def execute(action, data=None, original_execute=original_execute,
+                        execute_events=cls._execute_events):
+                # Autoformatting and custom event handling need the original.
+                if (getattr(action, "_autofmt", False)
+                    or type(action)._execute_events is not execute_events):
+                    return original_execute(action, data)
+                spec = action._spec
+                if not action._static and data:
+                    try:
+                        spec = spec % data
+                    except KeyError:
+                        # Let dragonfly report the error.
+                        return original_execute(action, data)
+                keyboard_events = cache.compile(action, spec, action.require_hardware_events())
+                action._keyboard.send_keyboard_events(list(keyboard_events))
+                return True
+
+            cls._parse_spec = parse_spec
+            cls._execute = execute
+
+    def uninstall(self):
+        for (cls, name), original in self._originals.items():
+            setattr(cls, name, original)
+        self._originals.clear()
+
+    def report(self):
+        return "parse %d hits, %d misses; compile %d hits, %d misses" % (
+            self.parse_hits, self.parse_misses, self.compile_hits, self.compile_misses)
+
+
+def _compile_key(action, events, use_hardware):
+    keyboard_events = []
+    for event_data in events:
+        keyboard_events.extend(action._calc_events_single(event_data, use_hardware))
+    return tuple(keyboard_events)
+
+
+def _compile_text(action, events, use_hardware):
+    keyboard_events = []
+    for key_symbol in events:
+        typeable = action._get_typeable(key_symbol, use_hardware)
+        if typeable is None:
+            raise ActionError("Keyboard interface cannot type this character: %r" % key_symbol)
+        keyboard_events.extend(typeable.events(action._pause))
+    return tuple(keyboard_events)
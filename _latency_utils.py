@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# (c) Copyright 2015 by James Stout
+# Licensed under the LGPL, see <http://www.gnu.org/licenses/>
+
+"""Recognition latency measurement.
+
+The tracker is fed timestamps from two places: a Natlink grammar which sees
+every hypothesis and final result (see _natlink_save_audio.py), and
+RepeatRule._process_recognition in _repeat.py. Both run in the same process, so
+they share the module-level tracker. For each utterance it records:
+
+  decode: first hypothesis to final result (engine time).
+  finalize: last hypothesis to final result (engine time after speech ends).
+  dispatch: start to end of _process_recognition (our time).
+  total: first hypothesis to end of _process_recognition.
+
+Each metric is kept in a rolling histogram per result type, and passed to any
+listeners (e.g. to profile slow utterances).
+
+Garbage collection pauses are measured separately by GcMonitor, and reported
+alongside utterance latency.
+"""
+
+from collections import deque
+import gc
+import math
+import threading
+import time
+
+METRICS = ("decode", "finalize", "dispatch", "total")
+
+
+class RollingHistogram(object):
+    """Histogram over the most recent durations, in milliseconds."""
+
+    def __init__(self, size=1000):
+        self._samples = deque(maxlen=size)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def add(self, milliseconds):
+        self._samples.append(milliseconds)
+
+    def total(self):
+        return sum(self._samples)
+
+    def percentile(self, percent):
+        if not self._samples:
+            return None
+        samples = sorted(self._samples)
+        return samples[min(len(samples) - 1, int(len(samples) * percent / 100.0))]
+
+    def buckets(self):
+        """Returns a list of (upper bound, count) with power-of-two bounds."""
+        counts = {}
+        for sample in self._samples:
+            bound = 2 ** max(0, int(math.ceil(math.log(max(sample, 1), 2))))
+            counts[bound] = counts.get(bound, 0) + 1
+        return sorted(counts.items())
+
+    def summary(self):
+        if not self._samples:
+            return "no samples"
+        return "n=%d p50=%.1f p90=%.1f p99=%.1f max=%.1f ms" % (
+            len(self._samples), self.percentile(50), self.percentile(90),
+            self.percentile(99), max(self._samples))
+
+
+class LatencyTracker(object):
+    """Collects utterance timestamps and keeps histograms per result type and
+    metric. Timestamps may arrive from different threads.
+    """
+
+    def __init__(self, window=1000, clock=time.perf_counter):
+        self.window = window
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._listeners = []
+        self._reset_utterance()
+
+    def add_listener(self, listener):
+        """Calls listener(result_type, metric, start, end) for each measurement.
+        It is called with the tracker's lock held, so it must be quick."""
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self._listeners.remove(listener)
+
+    def _reset_utterance(self):
+        self._first_hypothesis = None
+        self._last_hypothesis = None
+        self._result_time = None
+        self._result_type = None
+        self._dispatch_start = None
+        self._dispatch_end = None
+
+    def _add(self, result_type, metric, start, end):
+        key = (result_type, metric)
+        if key not in self._histograms:
+            self._histograms[key] = RollingHistogram(self.window)
+        self._histograms[key].add((end - start) * 1000)
+        for listener in self._listeners:
+            listener(result_type, metric, start, end)
+
+    def histogram(self, result_type, metric):
+        return self._histograms.get((result_type, metric))
+
+    def begin(self):
+        with self._lock:
+            self._reset_utterance()
+
+    def hypothesis(self):
+        with self._lock:
+            now = self._clock()
+            if self._first_hypothesis is None:
+                self._first_hypothesis = now
+            self._last_hypothesis = now
+
+    def results(self, result_type):
+        with self._lock:
+            self._result_time = self._clock()
+            self._result_type = result_type
+            if self._first_hypothesis is not None:
+                self._add(result_type, "decode", self._first_hypothesis, self._result_time)
+                self._add(result_type, "finalize", self._last_hypothesis, self._result_time)
+            # The order in which Natlink notifies grammars of results is not
+            # defined, so dispatch may already have finished.
+            if self._dispatch_end is not None:
+                self._add_dispatch()
+
+    def dispatch_started(self):
+        with self._lock:
+            self._dispatch_start = self._clock()
+
+    def dispatch_finished(self):
+        with self._lock:
+            self._dispatch_end = self._clock()
+            if self._result_type is not None and self._dispatch_start is not None:
+                self._add_dispatch()
+
+    def _add_dispatch(self):
+        self._add(self._result_type, "dispatch", self._dispatch_start, self._dispatch_end)
+        if self._first_hypothesis is not None:
+            self._add(self._result_type, "total", self._first_hypothesis, self._dispatch_end)
+        self._dispatch_start = None
+        self._dispatch_end = None
+
+    def report(self):
+        with self._lock:
+            lines = []
+            for (result_type, metric) in sorted(self._histograms, key=lambda key: (key[0], METRICS.index(key[1]))):
+                lines.append("%s %s: %s" % (result_type, metric,
+                                            self._histograms[(result_type, metric)].summary()))
+            return "\n".join(lines) if lines else "No latency samples."
+
+    def print_report(self):
+        print(self.report())
+
+    def reset(self):
+        with self._lock:
+            self._histograms = {}
+            self._reset_utterance()
+
+
+class GcMonitor(object):
+    """Measures garbage collection pauses using gc.callbacks, keeping a rolling
+    histogram per generation."""
+
+    def __init__(self, window=1000, clock=time.perf_counter):
+        self.window = window
+        self._clock = clock
+        self.installed = False
+        self.reset()
+
+    def reset(self):
+        self._histograms = [RollingHistogram(self.window) for _ in range(3)]
+        self.collected_count = 0
+        self._start = None
+
+    def _callback(self, phase, info):
+        if phase == "start":
+            self._start = self._clock()
+        elif self._start is not None:
+            self._histograms[info["generation"]].add((self._clock() - self._start) * 1000)
+            self.collected_count += info["collected"]
+            self._start = None
+
+    def install(self):
+        if not self.installed:
+            gc.callbacks.append(self._callback)
+            self.installed = True
+
+    def uninstall(self):
+        if self.installed:
+            gc.callbacks.remove(self._callback)
+            self.installed = False
+
+    def histogram(self, generation):
+        return self._histograms[generation]
+
+    def report(self):
+        lines = ["gc generation %d: %s" % (generation, histogram.summary())
+                 for generation, histogram in enumerate(self._histograms) if len(histogram)]
+        lines.append("gc: %d objects collected, %d frozen, thresholds %s" % (
+            self.collected_count, get_freeze_count(), gc.get_threshold()))
+        return "\n".join(lines)
+
+
+def get_freeze_count():
+    # gc.freeze was added in Python 3.7.
+    return gc.get_freeze_count() if hasattr(gc, "get_freeze_count") else 0
+
+
+# The thresholds from before set_thresholds was first called.
+_saved_thresholds = None
+
+
+def set_thresholds(thresholds):
+    """Sets the collection thresholds until restore_thresholds is called."""
+    global _saved_thresholds
+    if _saved_thresholds is None:
+        _saved_thresholds = gc.get_threshold()
+    gc.set_threshold(*thresholds)
+
+
+def restore_thresholds():
+    global _saved_thresholds
+    if _saved_thresholds is not None:
+        gc.set_threshold(*_saved_thresholds)
+        _saved_thresholds = None
+
+
+def freeze_heap(thresholds=None):
+    """Collects garbage, then moves every surviving object into a permanent
+    generation which the collector no longer scans. Call once the long-lived
+    objects have been created. Optionally sets the collection thresholds.
+    Returns the number of frozen objects."""
+    gc.collect()
+    if thresholds:
+        set_thresholds(thresholds)
+    if hasattr(gc, "freeze"):
+        gc.freeze()
+    return get_freeze_count()
+
+
+tracker = LatencyTracker()
+gc_monitor = GcMonitor()
+
+
+def print_report():
+    print(tracker.report())
+    if gc_monitor.installed:
+        print(gc_monitor.report())
+
+
+def reset():
+    tracker.reset()
+    gc_monitor.reset()
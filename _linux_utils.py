@@ -43,6 +43,18 @@ class LinuxHelper(object):
 linux_helper = LinuxHelper()
 
 
+def IsRemoteTitle(title):
+    return title.find("Oracle VM VirtualBox") != -1 or title.find("<remotedesktop.corp.google.com>") != -1
+
+
+def RemoteWindowKey(executable, title, handle):
+    """Returns the remote window title if the local window shows Linux, since it
+    also affects which contexts match."""
+    if IsRemoteTitle(title):
+        return linux_helper.GetActiveWindowTitle()
+    return None
+
+
 class UniversalAppContext(AppContext):
     """Context that works on both remote Linux and local Windows."""
 
@@ -50,7 +62,7 @@ class UniversalAppContext(AppContext):
         if AppContext.matches(self, executable, title, handle):
             return True
         # Only check Linux if it is active.
-        if title.find("Oracle VM VirtualBox") != -1 or title.find("<remotedesktop.corp.google.com>") != -1:
+        if IsRemoteTitle(title):
             remote_title = linux_helper.GetActiveWindowTitle().lower()
             found = any(remote_title.find(match) != -1 for match in self._title)
             if self._exclude != found:
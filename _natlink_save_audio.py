@@ -25,6 +25,21 @@
 # This grammar's rules can be used to start and stop recording audio or
 # noise.
 #
+# If SAVE_AUDIO_FORMAT is set to "sharded" in _dragonfly_local.py, samples are
+# instead appended to size-capped shard files with a compact index (see
+# _audio_dataset.py), which avoids creating two files per utterance. In this
+# mode audio can be losslessly compressed with SAVE_AUDIO_CODEC, and the dataset
+# size can be capped with SAVE_AUDIO_MAX_BYTES (oldest samples are evicted
+# first) and SAVE_AUDIO_MAX_BYTES_BY_TYPE, e.g. {"dictation": 2 * 1024 ** 3}.
+#
+# If MEASURE_LATENCY is set in _dragonfly_local.py, this module also loads
+# LatencyGrammar, which timestamps hypotheses and results for _latency_utils.py,
+# even if audio is not being saved.
+#
+# If UTTERANCE_LOG_PATH is set in _dragonfly_local.py, the words and rule IDs of
+# every result are appended to that log along with the foreground executable
+# (see _utterance_log.py), even if audio is not being saved.
+#
 # TODO Remove Dragon's formatting from dictation output.
 # E.g. "\cap\cap" -> "cap"
 
@@ -34,7 +49,10 @@ import time
 import natlink
 from natlinkutils import GrammarBase
 
+import _audio_dataset as audio_dataset
 import _dragonfly_local as local
+import _latency_utils as latency
+import _utterance_log as utterances
 
 
 class SaveAudioGrammar(GrammarBase):
@@ -49,21 +67,14 @@ class SaveAudioGrammar(GrammarBase):
         self.activateAll()
         self.enabled = True  # Start saving audio by default.
         self.saveRejects = False
+        self.executable = ""
+
+    def gotBegin(self, moduleInfo):
+        self.executable = os.path.basename(moduleInfo[0])
 
     @classmethod
     def getResultType(cls, details, resObj):
-        if details == "reject":
-            return "reject"
-
-        # Check the rules for each word.
-        # Anything between 1 and 1000000 (exclusive) is a grammar word.
-        # 0 is used as the rule number for free-form dictation.
-        rules = [r for _, r in resObj.getResults(0)]
-        grammar_words = len([r for r in rules if 0 < r < 1000000])
-        if grammar_words > 0:
-            return "mixed" if 1000000 in rules else "grammar"
-        else:
-            return "dictation"
+        return audio_dataset.get_result_type(details, resObj)
 
     def handleSelfResults(self, resObj):
         # Handle results for this grammar using the first word and rule ID.
@@ -89,6 +100,12 @@ class SaveAudioGrammar(GrammarBase):
             details = "reject"
             words = "<???>"
 
+        if utterance_log and details != "reject":
+            try:
+                utterance_log.append(resObj.getResults(0), self.executable, "natlink")
+            except (natlink.OutOfRange, IndexError):
+                pass
+
         # Get the audio from the result object if there is any.
         try:
             wav = resObj.getWave()
@@ -103,7 +120,9 @@ class SaveAudioGrammar(GrammarBase):
             and (not isReject or isReject and self.saveRejects)
         )
 
-        if shouldSave:
+        if shouldSave and dataset is not None:
+            dataset.append(wav, words, self.getResultType(details, resObj))
+        elif shouldSave:
             name = "rec-%.03f" % time.time()
             path = os.path.join(SAVE_DIR, name + ".wav")
             f = open(path, "wb")
@@ -120,21 +139,60 @@ class SaveAudioGrammar(GrammarBase):
             self.handleSelfResults(resObj)
 
 
+class LatencyGrammar(SaveAudioGrammar):
+    """Also records recognition timestamps in the shared latency tracker."""
+
+    def gotBegin(self, moduleInfo):
+        SaveAudioGrammar.gotBegin(self, moduleInfo)
+        latency.tracker.begin()
+
+    def gotHypothesis(self, words):
+        latency.tracker.hypothesis()
+
+    def gotResultsObject(self, details, resObj):
+        try:
+            result_type = self.getResultType(details, resObj)
+        except (natlink.OutOfRange, IndexError):
+            result_type = "reject"
+        latency.tracker.results(result_type)
+        SaveAudioGrammar.gotResultsObject(self, details, resObj)
+
+
 # The directory to save .wav and .txt files into.
 # Must exist and be an absolute path.
 SAVE_DIR = local.SAVE_AUDIO_DIR
-if not os.path.isabs(SAVE_DIR) or not os.path.isdir(SAVE_DIR):
-    grammar = None
-    print("Not saving audio.")
-else:
+# Either "files" (a .wav and .txt file per utterance) or "sharded".
+SAVE_FORMAT = getattr(local, "SAVE_AUDIO_FORMAT", "files")
+MEASURE_LATENCY = getattr(local, "MEASURE_LATENCY", False)
+UTTERANCE_LOG_PATH = getattr(local, "UTTERANCE_LOG_PATH", None)
+utterance_log = utterances.UtteranceLog(UTTERANCE_LOG_PATH) if UTTERANCE_LOG_PATH else None
+saving = os.path.isabs(SAVE_DIR) and os.path.isdir(SAVE_DIR)
+dataset = None
+if saving and SAVE_FORMAT == "sharded":
+    dataset = audio_dataset.AudioDataset(
+        SAVE_DIR,
+        codec=getattr(local, "SAVE_AUDIO_CODEC", "raw"),
+        max_bytes=getattr(local, "SAVE_AUDIO_MAX_BYTES", None),
+        max_bytes_by_type=getattr(local, "SAVE_AUDIO_MAX_BYTES_BY_TYPE", None))
+if saving or MEASURE_LATENCY or utterance_log:
     # Instantiate and load the grammar.
-    grammar = SaveAudioGrammar()
+    grammar = LatencyGrammar() if MEASURE_LATENCY else SaveAudioGrammar()
     grammar.initialize()
-    print("Saving audio.")
+else:
+    grammar = None
+print("Saving audio." if saving else "Not saving audio.")
+if MEASURE_LATENCY:
+    print("Measuring latency.")
 
 
 def unload():
-    global grammar
+    global grammar, dataset, utterance_log
     if grammar:
         grammar.unload()
     grammar = None
+    if utterance_log:
+        utterance_log.close()
+    utterance_log = None
+    if dataset is not None:
+        dataset.close()
+    dataset = None
@@ -0,0 +1,370 @@
+#!/usr/bin/env python
+# (c) Copyright 2015 by James Stout
+# Licensed under the LGPL, see <http://www.gnu.org/licenses/>
+
+"""Profilers for finding slow code in recognition processing.
+
+SamplingProfiler is an always-on profiler which captures the stacks of slow
+utterances. A background thread samples the stacks of all other threads at a
+low rate and keeps a rolling window of them. The time spent sampling is
+measured, and the interval is lengthened as needed to keep it under
+max_overhead (a fraction of wall time). When the latency tracker reports an
+utterance slower than the threshold, the samples taken during that utterance
+are written in the folded format used by flamegraph.pl and speedscope:
+
+  thread;outer_function (file:line);inner_function (file:line) count
+
+ScopedProfiler runs yappi only while the next N utterances are processed, then
+writes callgrind, folded and speedscope reports on a background thread.
+"""
+
+from collections import Counter, deque
+import json
+import os
+import os.path
+import sys
+import threading
+import time
+
+
+def frame_label(name, filename, lineno):
+    return "%s (%s:%d)" % (name, os.path.basename(filename), lineno)
+
+
+def write_folded(path, folded):
+    """Writes a mapping from folded stack to weight."""
+    with open(path, "w") as folded_file:
+        for stack, weight in sorted(folded.items()):
+            folded_file.write("%s %d\n" % (stack, weight))
+
+
+def write_speedscope(path, folded, name, unit="none"):
+    """Writes a mapping from folded stack to weight as a speedscope profile."""
+    frames = []
+    frame_indexes = {}
+    samples = []
+    weights = []
+    for stack, weight in sorted(folded.items()):
+        sample = []
+        for label in stack.split(";"):
+            if label not in frame_indexes:
+                frame_indexes[label] = len(frames)
+                frames.append({"name": label})
+            sample.append(frame_indexes[label])
+        samples.append(sample)
+        weights.append(weight)
+    profile = {
+        "$schema": "https://www.speedscope.app/file-format-schema.json",
+        "name": name,
+        "exporter": "dragonfly-commands",
+        "shared": {"frames": frames},
+        "profiles": [{
+            "type": "sampled",
+            "name": name,
+            "unit": unit,
+            "startValue": 0,
+            "endValue": sum(weights),
+            "samples": samples,
+            "weights": weights,
+        }],
+    }
+    with open(path, "w") as speedscope_file:
+        json.dump(profile, speedscope_file)
+
+
+def collapse_func_stats(func_stats, max_depth=64):
+    """Converts yappi function stats into folded stacks weighted by
+    microseconds. yappi only records caller/callee pairs, so each callee's time
+    is split between its call paths in proportion to the time of each call."""
+    stats_by_name = dict((stat.full_name, stat) for stat in func_stats)
+    called = set(child.full_name for stat in func_stats for child in stat.children)
+    folded = Counter()
+
+    def visit(stat, stack, names, fraction):
+        label = frame_label(stat.name, stat.module, stat.lineno)
+        stack = stack + [label]
+        self_time = stat.tsub * fraction
+        for child in stat.children:
+            child_stat = stats_by_name.get(child.full_name)
+            if (child_stat is None or child.full_name in names or len(stack) >= max_depth
+                or not child_stat.ttot):
+                # Attribute recursive and truncated calls to the caller.
+                self_time += child.ttot * fraction
+                continue
+            visit(child_stat, stack, names | {child.full_name},
+                  fraction * min(1.0, child.ttot / child_stat.ttot))
+        weight = int(round(self_time * 1e6))
+        if weight > 0:
+            folded[";".join(stack)] += weight
+
+    for stat in func_stats:
+        if stat.full_name not in called:
+            visit(stat, [], {stat.full_name}, 1.0)
+    return folded
+
+
+class SamplingProfiler(object):
+    """Samples the stacks of all threads except its own."""
+
+    # Folded frames are cached per stack of code objects, and the cache is
+    # cleared when it grows past this many stacks.
+    max_cached_stacks = 10000
+
+    def __init__(self, interval=0.01, window=30.0, max_overhead=0.01, clock=time.perf_counter):
+        self.interval = interval
+        self.window = window
+        self.max_overhead = max_overhead
+        self._clock = clock
+        self._samples = deque()
+        self._labels = {}
+        # Folded frames, keyed by the code objects on the stack, so that repeated
+        # stacks share one string. Thread names are kept apart from the key, so
+        # that short-lived threads don't add entries.
+        self._stacks = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._captures = deque()
+        self.sample_count = 0
+        self.sampling_time = 0.0
+        self.current_interval = interval
+        self._start_time = None
+
+    def start(self):
+        self._stopped.clear()
+        self._start_time = self._clock()
+        self._thread = threading.Thread(target=self._run, name="SamplingProfiler")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stops sampling and writes any pending captures."""
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            label = self._labels[code] = frame_label(code.co_name, code.co_filename,
+                                                     code.co_firstlineno)
+        return label
+
+    def sample(self):
+        """Records the current stack of each thread."""
+        start = self._clock()
+        names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+        own_ident = threading.current_thread().ident
+        stacks = []
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+            codes = []
+            while frame is not None:
+                codes.append(frame.f_code)
+                frame = frame.f_back
+            codes = tuple(codes)
+            frames = self._stacks.get(codes)
+            if frames is None:
+                if len(self._stacks) >= self.max_cached_stacks:
+                    self._stacks.clear()
+                frames = self._stacks[codes] = ";".join(
+                    self._label(code) for code in reversed(codes))
+            stacks.append((names.get(ident, "thread-%d" % ident), frames))
+        end = self._clock()
+        with self._lock:
+            self._samples.append((start, stacks))
+            while self._samples and self._samples[0][0] < end - self.window:
+                self._samples.popleft()
+            self.sample_count += 1
+            self.sampling_time += end - start
+        return end - start
+
+    def _run(self):
+        while not self._stopped.is_set():
+            cost = self.sample()
+            # Stretch the interval so that sampling stays under the overhead cap.
+            self.current_interval = max(self.interval, cost / self.max_overhead)
+            self._write_captures()
+            self._stopped.wait(self.current_interval)
+        self._write_captures(final=True)
+
+    def folded_stacks(self, start, end):
+        """Returns a Counter of folded stacks sampled between start and end."""
+        counter = Counter()
+        with self._lock:
+            for timestamp, stacks in self._samples:
+                if start <= timestamp <= end:
+                    counter.update(stacks)
+        return Counter(dict(("%s;%s" % stack, count) for stack, count in counter.items()))
+
+    def write_folded(self, path, start, end):
+        """Writes the stacks sampled between start and end. Returns the number of
+        samples written."""
+        counter = self.folded_stacks(start, end)
+        write_folded(path, counter)
+        return sum(counter.values())
+
+    def capture(self, path, start, end):
+        """Writes the stacks between start and end from the sampling thread, once
+        it has sampled past end."""
+        self._captures.append((path, start, end))
+
+    def _write_captures(self, final=False):
+        """Writes the captures which have been sampled past, or all of them if
+        final."""
+        with self._lock:
+            latest = self._samples[-1][0] if self._samples else None
+        pending = []
+        while self._captures:
+            path, start, end = capture = self._captures.popleft()
+            if not final and (latest is None or latest <= end):
+                pending.append(capture)
+                continue
+            try:
+                count = self.write_folded(path, start, end)
+                print("Wrote %d stack samples to %s" % (count, path))
+            except (IOError, OSError) as e:
+                print("Could not write profile: %s" % e)
+        self._captures.extend(pending)
+
+    def overhead(self):
+        """Returns the fraction of wall time spent sampling."""
+        if self._start_time is None:
+            return 0.0
+        elapsed = self._clock() - self._start_time
+        return self.sampling_time / elapsed if elapsed > 0 else 0.0
+
+    def report(self):
+        with self._lock:
+            sample_count = self.sample_count
+        return "%d samples, %.2f%% overhead (cap %.2f%%), interval %.1f ms" % (
+            sample_count, 100 * self.overhead(), 100 * self.max_overhead,
+            1000 * self.current_interval)
+
+
+class SlowUtteranceRecorder(object):
+    """Latency listener which captures a profile of each utterance slower than
+    threshold milliseconds. Captures are at least min_interval seconds apart."""
+
+    def __init__(self, profiler, directory, threshold=500, metric="total", min_interval=10.0):
+        self.profiler = profiler
+        self.directory = directory
+        self.threshold = threshold
+        self.metric = metric
+        self.min_interval = min_interval
+        self.capture_count = 0
+        self._last_capture_end = None
+
+    def __call__(self, result_type, metric, start, end):
+        milliseconds = (end - start) * 1000
+        if metric != self.metric or milliseconds < self.threshold:
+            return
+        if self._last_capture_end is not None and end - self._last_capture_end < self.min_interval:
+            return
+        self._last_capture_end = end
+        self.capture_count += 1
+        path = os.path.join(self.directory, "slow_%s_%s_%dms.folded" % (
+            time.strftime("%Y%m%d_%H%M%S"), result_type, milliseconds))
+        self.profiler.capture(path, start, end)
+
+
+class ScopedProfiler(object):
+    """Profiles with yappi, but only between enter() and exit() calls, for a
+    number of utterances. Call enter() when processing of an utterance begins
+    and exit() when it ends; calls may nest and come from different threads.
+
+    Once the last utterance finishes, the stats are copied and cleared on the
+    calling thread, and reports are written on a background thread:
+
+      <prefix>.txt: function and thread stats.
+      <prefix>.callgrind.out: for KCachegrind.
+      <prefix>.folded and <prefix>.speedscope.json: call paths in microseconds.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.remaining = 0
+        self._yappi = None
+        self._clock_type = None
+        self._count = 0
+        self._depth = 0
+        self._lock = threading.Lock()
+        self._report_thread = None
+
+    @property
+    def is_active(self):
+        with self._lock:
+            return bool(self.remaining or self._depth)
+
+    def start(self, count, clock_type="wall"):
+        import yappi
+        self._yappi = yappi
+        with self._lock:
+            if self.remaining or self._depth:
+                print("Already profiling.")
+                return
+            yappi.stop()
+            yappi.clear_stats()
+            yappi.set_clock_type(clock_type)
+            self._clock_type = clock_type
+            self._count = count
+            self.remaining = count
+        print("Profiling the next %d utterances (%s time)." % (count, clock_type))
+
+    def enter(self):
+        with self._lock:
+            if not (self.remaining or self._depth):
+                return
+            self._depth += 1
+            if self._depth == 1:
+                self._yappi.start()
+
+    def exit(self, utterance_finished=False):
+        with self._lock:
+            if not self._depth:
+                return
+            self._depth -= 1
+            if not self._depth:
+                self._yappi.stop()
+            if utterance_finished and self.remaining:
+                self.remaining -= 1
+            if not self.remaining and not self._depth:
+                self._finish()
+
+    def _finish(self):
+        yappi = self._yappi
+        func_stats = yappi.get_func_stats()
+        thread_stats = yappi.get_thread_stats()
+        yappi.clear_stats()
+        # yappi uses sys.argv when saving callgrind files, which Natlink lacks.
+        if not hasattr(sys, "argv"):
+            sys.argv = [""]
+        prefix = os.path.join(self.directory, "yappi_%s_%s" % (
+            self._clock_type, time.strftime("%Y%m%d_%H%M%S")))
+        self._report_thread = threading.Thread(
+            target=self._write_reports, args=(func_stats, thread_stats, prefix, self._count),
+            name="ScopedProfilerReport")
+        self._report_thread.daemon = True
+        self._report_thread.start()
+
+    def _write_reports(self, func_stats, thread_stats, prefix, count):
+        try:
+            with open(prefix + ".txt", "w") as text_file:
+                func_stats.sort("ttot").print_all(out=text_file)
+                thread_stats.print_all(out=text_file)
+            func_stats.save(prefix + ".callgrind.out", "callgrind")
+            folded = collapse_func_stats(func_stats)
+            write_folded(prefix + ".folded", folded)
+            write_speedscope(prefix + ".speedscope.json", folded,
+                             "%d utterances (%s time)" % (count, self._clock_type),
+                             unit="microseconds")
+            print("Wrote profile of %d utterances to %s.*" % (count, prefix))
+        except Exception as e:
+            print("Could not write profile: %s" % e)
+
+    def wait(self, timeout=None):
+        """Waits for the last report to be written."""
+        if self._report_thread:
+            self._report_thread.join(timeout)
@@ -11,6 +11,8 @@ This is heavily modified from _multiedit.py, found here:
 https://github.com/t4ngo/dragonfly-modules/blob/master/command-modules/_multiedit.py
 """
 
+import codecs
+import gc
 import os.path
 import re
 import socket
@@ -31,7 +33,6 @@ from gaze_ocr import eye_tracking
 from odictliteral import odict
 from six import string_types
 from six.moves import BaseHTTPServer
-from six.moves import queue
 
 from dragonfly import (
     ActionBase,
@@ -67,7 +68,6 @@ from dragonfly import (
     Text,
     TextQuery,
     get_accessibility_controller,
-    get_engine,
 )
 from dragonfly.actions.action_base import ActionSeries
 from dragonfly.grammar.context import LogicAndContext, LogicOrContext
@@ -76,10 +76,19 @@ from selenium.webdriver.common.by import By
 
 import _dragonfly_local as local
 import _dragonfly_utils as utils
+import _emacs_utils as emacs
+import _grammar_analysis as grammar_analysis
+import _keystroke_cache as keystrokes
+import _latency_utils as latency
 import _linux_utils as linux
+import _profiling_utils as profiling
 import _text_utils as text
+import _usage_stats as usage
+import _utterance_log as utterances
 import _webdriver_utils as webdriver
 
+module_start_time = time.perf_counter()
+
 tracker = eye_tracking.EyeTracker.get_connected_instance(local.DLL_DIRECTORY,
                                                          mouse=gaze_ocr.dragonfly.Mouse(),
                                                          keyboard=gaze_ocr.dragonfly.Keyboard(),
@@ -113,6 +122,65 @@ except:
 # Make sure dragonfly errors show up in NatLink messages.
 dragonfly.log.setup_log()
 
+# Optionally parse and compile the keystrokes of Key and Text actions once per
+# spec. This patches Key and Text globally, so it is opt-in.
+keystroke_cache = keystrokes.KeystrokeCache() if getattr(local, "KEYSTROKE_CACHE", False) else None
+if keystroke_cache:
+    keystroke_cache.install()
+
+# Run callbacks added by other threads on the engine thread: actions from the
+# action executor which call the engine, and word list updates from the server.
+# Callbacks with the same key are coalesced, so if several buffers arrive
+# quickly only the last one is processed.
+callbacks = utils.CallbackQueue()
+
+# Execute actions on a worker thread so that slow actions don't block the next
+# recognition. Created here rather than in _dragonfly_utils so that it is
+# recreated when Natlink reloads this module. Cancelling a job may interrupt an
+# action series while a modifier is held, so release them afterwards.
+action_executor = None
+if getattr(local, "ASYNC_ACTIONS", False):
+    action_executor = utils.ActionExecutor(callbacks,
+                                           getattr(local, "ACTION_STUCK_TIMEOUT", 10.0),
+                                           on_cancel=Key("shift:up, ctrl:up, alt:up").execute)
+
+# Share structurally identical elements between rules. Created here so that
+# each load starts afresh, instead of handing out elements from rules of
+# grammars that were unloaded.
+element_interner = utils.ElementInterner() if getattr(local, "INTERN_ELEMENTS", True) else None
+
+# Share identical actions between maps, so that they can be compared by
+# identity. Created per load for the same reason as the element interner: the
+# canonical actions include Functions bound to this module's globals.
+action_interner = utils.ActionInterner() if getattr(local, "INTERN_ACTIONS", True) else None
+
+# Types or pastes formatted and dictated text, depending on its length and the
+# environment.
+text_output = utils.TextOutput(getattr(local, "PASTE_TEXT_THRESHOLD", None),
+                               getattr(local, "PASTE_TEXT_THRESHOLDS", None),
+                               getattr(local, "PASTE_RESTORE_DELAY", 0.1))
+
+# Measure garbage collection pauses, reported with latency.
+if getattr(local, "GC_MONITOR", False):
+    latency.gc_monitor.install()
+
+# Sample stacks continuously, and save those of utterances slower than
+# SLOW_UTTERANCE_MS for flame graphs.
+sampling_profiler = None
+slow_utterance_recorder = None
+if getattr(local, "SAMPLING_PROFILER", False):
+    sampling_profiler = profiling.SamplingProfiler(
+        interval=getattr(local, "SAMPLING_INTERVAL", 0.01),
+        max_overhead=getattr(local, "SAMPLING_MAX_OVERHEAD", 0.01))
+    slow_utterance_recorder = profiling.SlowUtteranceRecorder(
+        sampling_profiler, getattr(local, "SLOW_UTTERANCE_DIR", None) or local.HOME,
+        threshold=getattr(local, "SLOW_UTTERANCE_MS", 500))
+    latency.tracker.add_listener(slow_utterance_recorder)
+    sampling_profiler.start()
+
+# Profiles recognition processing of the next N utterances on request.
+scoped_profiler = profiling.ScopedProfiler(getattr(local, "PROFILE_DIR", None) or local.HOME)
+
 # Load _repeat.txt.
 config = Config("repeat")
 namespace = config.load()
@@ -436,16 +504,18 @@ dictation_key_action_map = {
 
 # Actions that can be interleaved with dictation but not repeated.
 nonrepeatable_dictation_action_map = utils.combine_maps(
-    utils.text_map_to_action_map(utils.combine_maps(letters_map, symbols_map)),
+    utils.text_map_to_action_map(utils.combine_maps(letters_map, symbols_map),
+                                 action_interner=action_interner),
     {
         "number <numeral>": Text(u"%(numeral)s"),
         "upper <letter>": Function(lambda letter: Text(letter.upper()).execute()),
-    })
+    }, action_interner=action_interner)
 
 
 # Actions that can be interleaved with dictation.
 dictation_action_map = utils.combine_maps(dictation_key_action_map,
-                                          nonrepeatable_dictation_action_map)
+                                          nonrepeatable_dictation_action_map,
+                                          action_interner=action_interner)
 
 # Key names that can be spoken with or without modifiers and can be repeated.
 standalone_key_action_map = utils.combine_maps(
@@ -463,18 +533,19 @@ standalone_key_action_map = utils.combine_maps(
         "delete key": Key("del"),
         "home key": Key("home"),
         "end key": Key("end"),
-    })
+    }, action_interner=action_interner)
 
 # Key names that can be spoken with modifiers keys.
 full_key_action_map = utils.combine_maps(
     standalone_key_action_map,
-    utils.text_map_to_key_action_map(utils.combine_maps(letters_map, numbers_map, symbol_keys_map)),
+    utils.text_map_to_key_action_map(utils.combine_maps(letters_map, numbers_map, symbol_keys_map),
+                                     action_interner=action_interner),
     {
         "home": Key("home"),
         "end": Key("end"),
         "tab": Key("tab"),
         "delete": Key("del"),
-    })
+    }, action_interner=action_interner)
 
 # Actions that can be repeated by prefixing with a number modifier.
 repeatable_action_map = utils.combine_maps(
@@ -494,7 +565,7 @@ repeatable_action_map = utils.combine_maps(
         "screen up": Key("pgup"),
         "screen down": Key("pgdown"),
         "cancel": Key("escape"),
-    })
+    }, action_interner=action_interner)
 
 
 
@@ -527,6 +598,14 @@ def start_wall_profiling():
     yappi.start()
 
 
+def print_sampling_report():
+    if not sampling_profiler:
+        print("Sampling profiler disabled.")
+        return
+    print("Sampling profiler: %s, %d slow utterances captured" % (
+        sampling_profiler.report(), slow_utterance_recorder.capture_count))
+
+
 def stop_profiling():
     yappi.stop()
     yappi.get_func_stats().print_all()
@@ -586,8 +665,8 @@ command_action_map = utils.combine_maps(
         "windows explorer": Key("w-e"),
 
         # Dragon commands.
-        "dragon hide": Mimic(*"switch DragonBar to tray icon mode".split()),
-        "dragon show": Mimic(*"open DragonBar".split()),
+        "dragon hide": utils.EngineThreadAction(Mimic(*"switch DragonBar to tray icon mode".split()), action_executor),
+        "dragon show": utils.EngineThreadAction(Mimic(*"open DragonBar".split()), action_executor),
 
         # Notepad text editing.
         "here edit": utils.RunApp("notepad"),
@@ -630,7 +709,15 @@ command_action_map = utils.combine_maps(
         "dragonfly CPU profiling start": Function(start_cpu_profiling),
         "dragonfly wall [time] profiling start": Function(start_wall_profiling),
         "dragonfly [(CPU|wall [time])] profiling stop": Function(stop_profiling),
-    ])
+        "dragonfly CPU profiling next <n>": Function(lambda n: scoped_profiler.start(n, "cpu")),
+        "dragonfly wall [time] profiling next <n>": Function(lambda n: scoped_profiler.start(n, "wall")),
+        "dragonfly latency report": Function(latency.print_report),
+        "dragonfly latency reset": Function(latency.reset),
+        "dragonfly sampling report": Function(lambda: print_sampling_report()),
+        "dragonfly grammar report": Function(lambda: print_grammar_report()),
+        "dragonfly action cache report": Function(lambda: print_action_cache_report()),
+        "dragonfly pruning report": Function(lambda: print_pruning_report()),
+    ], action_interner=action_interner)
 
 def reset_scroller():
     scroller.stop()
@@ -673,9 +760,9 @@ terminal_command_action_map = odict[
     "replace <text> with <replacement>": gaze_ocr.dragonfly.SelectTextAction(gaze_ocr_controller, "%(text)s", "%(text2)s") + Text("%(replacement)s"),
 
     # Full-text dictation commands.
-    "speak <text>": Text(u"%(text)s"),
-    "sentence <text>": utils.capitalize_text_action("%(text)s"),
-    "mimic <text>": Mimic(extra="text"),
+    "speak <text>": utils.output_text_action(u"%(text)s", text_output),
+    "sentence <text>": utils.capitalize_text_action("%(text)s", text_output),
+    "mimic <text>": utils.EngineThreadAction(Mimic(extra="text"), action_executor),
 ]
 
 # Here we prepare the action map of formatting functions from the config file.
@@ -693,7 +780,7 @@ if namespace:
             def wrap_function(function):
                 def _function(dictation):
                     formatted_text = function(dictation)
-                    Text(formatted_text).execute()
+                    text_output.output(formatted_text)
                 return Function(_function)
 
             action = wrap_function(function)
@@ -777,14 +864,17 @@ command_element_map = {
         ListRef(None, prefix_list),
         ListRef(None, suffix_list),
         ListRef(None, saved_word_list),
+        ListRef(None, context_phrase_list),
     ])),
-    # TODO Figure out why we can't reuse custom_text element.
+    # TODO Figure out why we can't reuse custom_text element. Note that
+    # create_rule shares identical elements anyway (see INTERN_ELEMENTS).
     "custom_text2": RuleWrap(None, Alternative([
         Dictation(),
         chars_element,
         ListRef(None, prefix_list),
         ListRef(None, suffix_list),
         ListRef(None, saved_word_list),
+        ListRef(None, context_phrase_list),
     ])),
     "replacement": Dictation(),
     "text_query": Compound(
@@ -823,7 +913,8 @@ command_element_map = {
 format_rule = utils.create_rule(
     "FormatRule",
     format_functions,
-    {"dictation": mixed_dictation}
+    {"dictation": mixed_dictation},
+    element_interner=element_interner
 )
 
 # Rule for formatting symbols.
@@ -834,7 +925,8 @@ symbol_format_rule = utils.create_rule(
     },
     {
         "symbol": symbol_element,
-    }
+    },
+    element_interner=element_interner
 )
 
 # Rule for formatting pure dictation elements.
@@ -842,7 +934,8 @@ pure_format_rule = utils.create_rule(
     "PureFormatRule",
     dict([("pure (" + k + ")", v)
           for (k, v) in format_functions.items()]),
-    {"dictation": Dictation()}
+    {"dictation": Dictation()},
+    element_interner=element_interner
 )
 
 # Rule for formatting custom_dictation elements.
@@ -850,7 +943,8 @@ custom_format_rule = utils.create_rule(
     "CustomFormatRule",
     dict([("my (" + k + ")", v)
           for (k, v) in format_functions.items()]),
-    {"dictation": custom_dictation}
+    {"dictation": custom_dictation},
+    element_interner=element_interner
 )
 
 # Rule for printing a sequence of characters.
@@ -866,7 +960,8 @@ character_rule = utils.create_rule(
         "numerals": numbers_element,
         "letters": letters_element,
         "chars": chars_element,
-    }
+    },
+    element_interner=element_interner
 )
 
 # Rule for spelling a word letter by letter and formatting it.
@@ -895,7 +990,8 @@ dictation_element = RuleWrap(None, Alternative([
     # RuleRef(rule=custom_format_rule),
     RuleRef(rule=utils.create_rule("DictationActionRule",
                                    dictation_action_map,
-                                   command_element_map)),
+                                   command_element_map,
+                                   element_interner=element_interner)),
 ]))
 
 
@@ -928,13 +1024,27 @@ final_action_map = utils.combine_maps(windows_mapping, {
     "[work] emacs win": FocusWindow(executable="nxclient.bin", title=" - Emacs editor"),
     "[work] studio win": FocusWindow(executable="nxclient.bin", title=" - Android Studio"),
     "[<n>] swap": utils.SwitchWindows("%(n)d"),
-})
+}, action_interner=action_interner)
 final_element_map = {
     "n": (IntegerRef(None, 1, 20), 1)
 }
 final_rule = utils.create_rule("FinalRule",
                                final_action_map,
-                               final_element_map)
+                               final_element_map,
+                               element_interner=element_interner)
+
+# Shared by every RepeatRule.
+full_key_rule = utils.create_rule("full_key_rule", full_key_action_map, {},
+                                  element_interner=element_interner)
+modifier_element = RuleWrap("modifier", Choice(None, {
+    "control": lambda action: Key("ctrl:down") + action + Key("ctrl:up"),
+    "alt|meta|under": lambda action: Key("alt:down") + action + Key("alt:up"),
+    "shift": lambda action: Key("shift:down") + action + Key("shift:up"),
+    "control (alt|meta|under)": lambda action: Key("ctrl:down, alt:down") + action + Key("ctrl:up, alt:up"),
+    "control shift": lambda action: Key("ctrl:down, shift:down") + action + Key("ctrl:up, shift:up"),
+    "(alt|meta|under) shift": lambda action: Key("alt:down, shift:down") + action + Key("alt:up, shift:up"),
+    "control (alt|meta|under) shift": lambda action: Key("ctrl:down, alt:down, shift:down") + action + Key("ctrl:up, alt:up, shift:up"),
+}))
 
 
 #-------------------------------------------------------------------------------
@@ -952,7 +1062,7 @@ class CommandBenchmark:
         self.remaining_count = repeat_count
         self.command = command
         self.start_time = time.time()
-        Mimic(*self.command.split()).execute()
+        utils.EngineThreadAction(Mimic(*self.command.split()), action_executor).execute()
 
     def record_and_replay_recognition(self):
         if self.remaining_count == 0:
@@ -962,7 +1072,7 @@ class CommandBenchmark:
         if self.remaining_count == 0:
             print("Average response for command %s: %.10f" % (self.command, (time.time() - self.start_time) / self.repeat_count))
         else:
-            Mimic(*self.command.split()).execute()
+            utils.EngineThreadAction(Mimic(*self.command.split()), action_executor).execute()
 
     def is_active(self):
         return self.remaining_count > 0
@@ -974,6 +1084,24 @@ def reset_benchmark():
 
 reset_benchmark()
 
+# Optionally log recognized utterances, e.g. to replay them as a benchmark with
+# replay_utterances.py.
+UTTERANCE_LOG_PATH = getattr(local, "UTTERANCE_LOG_PATH", None)
+utterance_log = utterances.UtteranceLog(UTTERANCE_LOG_PATH) if UTTERANCE_LOG_PATH else None
+
+# Reuse the actions built for frequent utterances like "up" or "three lefts".
+# Only the context phrases change while loaded, so other lists are cacheable.
+ACTION_CACHE_SIZE = getattr(local, "ACTION_CACHE_SIZE", 1000)
+action_cache = (utils.ActionCache(ACTION_CACHE_SIZE, dynamic_lists=[context_phrase_list])
+                if ACTION_CACHE_SIZE else None)
+
+def print_action_cache_report():
+    print("Action cache: " + (action_cache.report() if action_cache else "disabled"))
+    print("Keystroke cache: " + (keystroke_cache.report() if keystroke_cache else "disabled"))
+    print("Text output: " + text_output.report())
+    print("Emacs channel: " + (emacs.channel.report() if emacs.channel else "disabled"))
+    print("Action executor: " + (action_executor.report() if action_executor else "disabled"))
+
 #---------------------------------------------------------------------------
 # Here we define the top-level rule which the user can say.
 
@@ -999,18 +1127,10 @@ class RepeatRule(CompoundRule):
                                     extras=[IntegerRef("n", 1, 21, default=1),
                                             utils.renamed_element("repeatable_command", repeatable_command)],
                                     value_func=lambda node, extras: (extras["repeatable_command"] + Pause("5")) * Repeat(extras["n"]))
-        full_key_element = RuleRef(rule=utils.create_rule("full_key_rule", full_key_action_map, {}), name="single_key")
+        full_key_element = RuleRef(rule=full_key_rule, name="single_key")
         combo_key_element = Compound(spec="[<n>] <modifier> <single_key>",
                                      extras=[IntegerRef("n", 1, 21, default=1),
-                                             RuleWrap("modifier", Choice(None, {
-                                                 "control": lambda action: Key("ctrl:down") + action + Key("ctrl:up"),
-                                                 "alt|meta|under": lambda action: Key("alt:down") + action + Key("alt:up"),
-                                                 "shift": lambda action: Key("shift:down") + action + Key("shift:up"),
-                                                 "control (alt|meta|under)": lambda action: Key("ctrl:down, alt:down") + action + Key("ctrl:up, alt:up"),
-                                                 "control shift": lambda action: Key("ctrl:down, shift:down") + action + Key("ctrl:up, shift:up"),
-                                                 "(alt|meta|under) shift": lambda action: Key("alt:down, shift:down") + action + Key("alt:up, shift:up"),
-                                                 "control (alt|meta|under) shift": lambda action: Key("ctrl:down, alt:down, shift:down") + action + Key("ctrl:up, alt:up, shift:up"),
-                                             })),
+                                             modifier_element,
                                              full_key_element],
                                      value_func=lambda node, extras: (((extras["modifier"])(extras["single_key"]) + Pause("5")) * Repeat(extras["n"])))
         extras = [
@@ -1035,12 +1155,40 @@ class RepeatRule(CompoundRule):
 
         CompoundRule.__init__(self, name=name, spec=spec,
                               extras=extras, defaults=defaults, exported=True)
+        self._cache_key = None
+        self._dispatch_count = 0
 
     def _process_begin(self):
-        # Start OCR now so that results are ready when the command completes (if
-        # it uses OCR). This also has the benefit of using the gaze from the
-        # time the user starts speaking.
-        gaze_ocr_controller.start_reading_nearby()
+        scoped_profiler.enter()
+        try:
+            # Start OCR now so that results are ready when the command completes
+            # (if it uses OCR). This also has the benefit of using the gaze from
+            # the time the user starts speaking.
+            gaze_ocr_controller.start_reading_nearby()
+        finally:
+            scoped_profiler.exit()
+
+    def process_recognition(self, node):
+        # Exited by _dispatch, which may run on the action executor.
+        scoped_profiler.enter()
+        dispatch_count = self._dispatch_count
+        try:
+            key = action_cache.key(self.grammar, node) if action_cache else None
+            cached_extras = action_cache.get(key) if key else None
+            # Read by _process_recognition, which CompoundRule calls with the
+            # extras it builds. Cleared even if building or dispatch fails, so
+            # that a stale key can't store the next utterance's extras.
+            self._cache_key = key if cached_extras is None else None
+            if cached_extras is None:
+                CompoundRule.process_recognition(self, node)
+            else:
+                self._process_recognition(node, dict(cached_extras, _node=node))
+        except Exception:
+            if self._dispatch_count == dispatch_count:
+                scoped_profiler.exit(utterance_finished=True)
+            raise
+        finally:
+            self._cache_key = None
 
     # This method gets called when this rule is recognized.
     # Arguments:
@@ -1049,6 +1197,27 @@ class RepeatRule(CompoundRule):
     #     . extras["sequence"] gives the sequence of actions.
     #     . extras["n"] gives the repeat count.
     def _process_recognition(self, node, extras):
+        if utterance_log:
+            utterance_log.append(node.full_results(), self.grammar.name, "repeat")
+        if self._cache_key:
+            action_cache.put(self._cache_key, dict((name, value) for (name, value) in extras.items()
+                                                   if name != "_node"))
+        self._dispatch_count += 1
+        if action_executor:
+            action_executor.submit(lambda: self._dispatch(extras))
+        else:
+            self._dispatch(extras)
+
+    def _dispatch(self, extras):
+        text_output.environment = self.grammar.name
+        latency.tracker.dispatch_started()
+        try:
+            self._execute_actions(extras)
+        finally:
+            latency.tracker.dispatch_finished()
+            scoped_profiler.exit(utterance_finished=True)
+
+    def _execute_actions(self, extras):
         sequence = extras["sequence"]   # A sequence of actions.
         nested_repetitions = extras["nested_repetitions"]
         dictation_sequence = extras["dictation_sequence"]
@@ -1104,7 +1273,8 @@ class Environment(object):
             for key in set(environment_map.keys()) | set(parent.environment_map.keys()):
                 action_map, element_map = environment_map.get(key, ({}, {}))
                 parent_action_map, parent_element_map = parent.environment_map.get(key, ({}, {}))
-                self.environment_map[key] = (utils.combine_maps_checked(parent_action_map, action_map),
+                self.environment_map[key] = (utils.combine_maps_checked(parent_action_map, action_map,
+                                                                        action_interner=action_interner),
                                              utils.combine_maps_checked(parent_element_map, element_map))
         else:
             self.context = context
@@ -1113,18 +1283,44 @@ class Environment(object):
     def add_child(self, child):
         self.children.append(child)
 
-    def create_grammars(self, exported_rule_factory):
-        grammars = []
-        exclusive_context = self.context
+    def walk(self):
+        """Yields this environment and its descendants, children first."""
         for child in self.children:
-            grammars.extend(child.create_grammars(exported_rule_factory))
-            exclusive_context = utils.combine_contexts(exclusive_context, ~child.context)
-        rule_map = dict([(key, RuleRef(rule=utils.create_rule(self.name + "_" + key, action_map, element_map)) if action_map else Empty())
-                         for (key, (action_map, element_map)) in self.environment_map.items()])
+            for environment in child.walk():
+                yield environment
+        yield self
+
+    def specs(self):
+        return set(spec for action_map, _ in self.environment_map.values() for spec in action_map)
+
+    def create_grammar(self, exported_rule_factory, rule_registry, context_resolver=None,
+                       excluded_specs=None):
+        """Creates the grammar for this environment alone, optionally without some
+        specs."""
+        if context_resolver:
+            # Equivalent, except when sibling contexts overlap: the first
+            # sibling wins instead of both being active.
+            exclusive_context = utils.ResolvedContext(context_resolver, self)
+        else:
+            exclusive_context = self.context
+            for child in self.children:
+                exclusive_context = utils.combine_contexts(exclusive_context, ~child.context)
+        environment_map = self.environment_map
+        if excluded_specs:
+            environment_map = dict([(key, (OrderedDict([(spec, action) for (spec, action) in action_map.items()
+                                                        if spec not in excluded_specs]),
+                                           element_map))
+                                    for (key, (action_map, element_map)) in environment_map.items()])
+        # Environments which don't change a map reuse their ancestor's rule.
+        rule_map = dict([(key, RuleRef(rule=rule_registry.create_rule(self.name + "_" + key, action_map, element_map)) if action_map else Empty())
+                         for (key, (action_map, element_map)) in environment_map.items()])
         grammar = Grammar(self.name, context=exclusive_context)
         grammar.add_rule(exported_rule_factory(self.name + "_exported", **rule_map))
-        grammars.append(grammar)
-        return grammars
+        return grammar
+
+    def create_grammars(self, exported_rule_factory, rule_registry, context_resolver=None):
+        return [environment.create_grammar(exported_rule_factory, rule_registry, context_resolver)
+                for environment in self.walk()]
 
     def generate_talon_files(self, dir_path, header_prefix=""):
         file_path = os.path.join(dir_path, "{}.talon".format(self.name))
@@ -1300,10 +1496,12 @@ class MyEnvironment(object):
             context,
             parent.environment if parent else None)
 
-    def create_grammars(self):
-        def create_exported_rule(name, command, terminal_command, repeatable_command):
-            return RepeatRule(name, command or Empty(), repeatable_command or Empty(), terminal_command or Empty())
-        return self.environment.create_grammars(create_exported_rule)
+    @staticmethod
+    def create_exported_rule(name, command, terminal_command, repeatable_command):
+        return RepeatRule(name, command or Empty(), repeatable_command or Empty(), terminal_command or Empty())
+
+    def create_grammars(self, rule_registry, context_resolver=None):
+        return self.environment.create_grammars(self.create_exported_rule, rule_registry, context_resolver)
 
 
 ### Global
@@ -1381,14 +1579,14 @@ shell_command_map = utils.combine_maps(odict[
     "git stash pop",
     "git stash",
     "git status",
-]))
+]), action_interner=action_interner)
 run_local_hook("AddShellCommands", shell_command_map)
 
 
 ### Emacs
 
 def Exec(command):
-    return Key("c-c, a-x") + Text(command) + Key("enter")
+    return emacs.EmacsCommand(command, Key("c-c, a-x") + Text(command) + Key("enter"))
 
 
 def jump_to_line(line_string):
@@ -1415,6 +1613,9 @@ class MarkLinesAction(ActionBase):
         self.tree = tree
 
     def _execute(self, data=None):
+        if emacs.run("mark-lines", start=data["n1"], end=data.get("n2"),
+                     tight=self.tight, tree=self.tree):
+            return
         jump_to_line("%(n1)d" % data).execute()
         if self.tree:
             Key("a-h").execute()
@@ -1431,17 +1632,26 @@ class MarkLinesAction(ActionBase):
 
 
 class UseLinesAction(ActionBase):
-    """Make use of lines within a range."""
+    """Make use of lines within a range. If operation is given ("copy" or "kill"),
+    the lines are copied or killed and then yanked in a single Emacs request,
+    with pre_action and post_action as the fallback."""
 
-    def __init__(self, pre_action, post_action, tight=False, other_buffer=False, tree=False):
+    def __init__(self, pre_action, post_action, tight=False, other_buffer=False, tree=False,
+                 operation=None):
         super(UseLinesAction, self).__init__()
         self.pre_action = pre_action
         self.post_action = post_action
         self.tight = tight
         self.other_buffer = other_buffer
         self.tree = tree
+        self.operation = operation
 
     def _execute(self, data=None):
+        if self.operation and emacs.run("use-lines", start=data["n1"], end=data.get("n2"),
+                                        tight=self.tight, tree=self.tree,
+                                        other_buffer=self.other_buffer,
+                                        operation=self.operation):
+            return
         if self.other_buffer:
             Key("c-x, o").execute()
         else:
@@ -1627,14 +1837,14 @@ emacs_action_map = odict[
     "paste (other|preev)": Key("a-y"),
     "<n1> through [<n2>] [select]": MarkLinesAction(),
     "<n1> through [<n2>] short [select]": MarkLinesAction(tight=True),
-    "<n1> through [<n2>] copy here": UseLinesAction(Key("a-w"), Key("c-y")),
-    "<n1> through [<n2>] short copy here": UseLinesAction(Key("a-w"), Key("c-y"), tight=True),
-    "<n1> through [<n2>] move here": UseLinesAction(Key("c-w"), Key("c-y")),
-    "<n1> through [<n2>] short move here": UseLinesAction(Key("c-w"), Key("c-y"), tight=True),
-    "other <n1> through [<n2>] copy here": UseLinesAction(Key("a-w"), Key("c-y"), other_buffer=True),
-    "other <n1> through [<n2>] short copy here": UseLinesAction(Key("a-w"), Key("c-y"), tight=True, other_buffer=True),
-    "other <n1> through [<n2>] move here": UseLinesAction(Key("c-w"), Key("c-y"), other_buffer=True),
-    "other <n1> through [<n2>] short move here": UseLinesAction(Key("c-w"), Key("c-y"), tight=True, other_buffer=True),
+    "<n1> through [<n2>] copy here": UseLinesAction(Key("a-w"), Key("c-y"), operation="copy"),
+    "<n1> through [<n2>] short copy here": UseLinesAction(Key("a-w"), Key("c-y"), tight=True, operation="copy"),
+    "<n1> through [<n2>] move here": UseLinesAction(Key("c-w"), Key("c-y"), operation="kill"),
+    "<n1> through [<n2>] short move here": UseLinesAction(Key("c-w"), Key("c-y"), tight=True, operation="kill"),
+    "other <n1> through [<n2>] copy here": UseLinesAction(Key("a-w"), Key("c-y"), other_buffer=True, operation="copy"),
+    "other <n1> through [<n2>] short copy here": UseLinesAction(Key("a-w"), Key("c-y"), tight=True, other_buffer=True, operation="copy"),
+    "other <n1> through [<n2>] move here": UseLinesAction(Key("c-w"), Key("c-y"), other_buffer=True, operation="kill"),
+    "other <n1> through [<n2>] short move here": UseLinesAction(Key("c-w"), Key("c-y"), tight=True, other_buffer=True, operation="kill"),
     "layer select": Key("cas-2"),
     "layer kill": Key("ca-k"),
     "select more": Key("c-equals"),
@@ -1705,18 +1915,18 @@ emacs_terminal_action_map = odict[
     utils.Delete("words <text> [through <text2>]"): None,
     utils.Delete("replace <text> with <replacement>"): None,
 
-    "go before [preev] <custom_text>": Key("c-r") + utils.lowercase_text_action("%(custom_text)s") + Key("enter"),
-    "go after preev <custom_text>": Key("left, c-r") + utils.lowercase_text_action("%(custom_text)s") + Key("c-s, enter"),
-    "go before next <custom_text>": Key("right, c-s") + utils.lowercase_text_action("%(custom_text)s") + Key("c-r, enter"),
-    "go after [next] <custom_text>": Key("c-s") + utils.lowercase_text_action("%(custom_text)s") + Key("enter"),
+    "go before [preev] <custom_text>": Key("c-r") + utils.lowercase_text_action("%(custom_text)s", text_output) + Key("enter"),
+    "go after preev <custom_text>": Key("left, c-r") + utils.lowercase_text_action("%(custom_text)s", text_output) + Key("c-s, enter"),
+    "go before next <custom_text>": Key("right, c-s") + utils.lowercase_text_action("%(custom_text)s", text_output) + Key("c-r, enter"),
+    "go after [next] <custom_text>": Key("c-s") + utils.lowercase_text_action("%(custom_text)s", text_output) + Key("enter"),
     "words <custom_text>": (Key("c-c, c, c-r")
-                            + utils.lowercase_text_action("%(custom_text)s") + Key("enter")),
+                            + utils.lowercase_text_action("%(custom_text)s", text_output) + Key("enter")),
     "words <custom_text> through <custom_text2>": (Key("c-c, c, c-t")
-                                                   + utils.lowercase_text_action("%(custom_text)s") + Key("enter")
-                                                   + utils.lowercase_text_action("%(custom_text2)s") + Key("enter")),
+                                                   + utils.lowercase_text_action("%(custom_text)s", text_output) + Key("enter")
+                                                   + utils.lowercase_text_action("%(custom_text2)s", text_output) + Key("enter")),
     "replace <custom_text> with <custom_text2>": (Key("c-c, c, as-5")
-                                                 + utils.lowercase_text_action("%(custom_text)s") + Key("enter")
-                                                 + utils.lowercase_text_action("%(custom_text2)s") + Key("enter")),
+                                                 + utils.lowercase_text_action("%(custom_text)s", text_output) + Key("enter")
+                                                 + utils.lowercase_text_action("%(custom_text2)s", text_output) + Key("enter")),
 ]
 
 templates = {
@@ -1828,10 +2038,10 @@ emacs_org_action_map = odict[
     "move tree up": Key("as-up"),
     "tree select": Key("a-h"),
     "<n1> tree [select]": MarkLinesAction(tree=True),
-    "<n1> tree copy here": UseLinesAction(Key("a-w"), Key("c-y"), tree=True),
-    "<n1> tree move here": UseLinesAction(Key("c-w"), Key("c-y"), tree=True),
-    "other <n1> tree copy here": UseLinesAction(Key("a-w"), Key("c-y"), other_buffer=True, tree=True),
-    "other <n1> tree move here": UseLinesAction(Key("c-w"), Key("c-y"), other_buffer=True, tree=True),
+    "<n1> tree copy here": UseLinesAction(Key("a-w"), Key("c-y"), tree=True, operation="copy"),
+    "<n1> tree move here": UseLinesAction(Key("c-w"), Key("c-y"), tree=True, operation="kill"),
+    "other <n1> tree copy here": UseLinesAction(Key("a-w"), Key("c-y"), other_buffer=True, tree=True, operation="copy"),
+    "other <n1> tree move here": UseLinesAction(Key("c-w"), Key("c-y"), other_buffer=True, tree=True, operation="kill"),
     "open org link": Key("c-c, c-o"),
     "show to do's": Key("c-c, slash, t"),
     "archive": Key("c-c, c-x, c-a"),
@@ -1868,7 +2078,7 @@ emacs_shell_action_map = utils.combine_maps(
         "shell down": Key("a-n"),
         "shell (preev|back)": Key("a-r"),
         "show output": Key("c-c, c-r"),
-    ])
+    ], action_interner=action_interner)
 emacs_shell_environment = MyEnvironment(name="EmacsShell",
                                         parent=emacs_environment,
                                         context=linux.UniversalAppContext(title="- Shell -"),
@@ -1910,7 +2120,7 @@ shell_action_map = utils.combine_maps(
         "go tab <tab_n>": Key("a-%(tab_n)d"),
         "go tab last": Key("a-1, cs-left"),
         "tab new": Key("cs-t"),
-    ])
+    ], action_interner=action_interner)
 
 shell_element_map = {
     "tab_n": IntegerRef(None, 1, 10),
@@ -1955,7 +2165,7 @@ cmder_action_map = utils.combine_maps(
         "tab new ubuntu": Key("as-5"),
         "tab new dos": Key("as-2"),
         "tab new [dos] admin": Key("as-1"),
-    ])
+    ], action_interner=action_interner)
 
 cmder_element_map = {
     "tab_n": IntegerRef(None, 1, 10),
@@ -2056,7 +2266,7 @@ class ClickTextOrButtonAction(DynStrActionBase):
             webdriver.click_element(nearest_element)
 
 chrome_terminal_action_map = odict[
-    "search <text>":        Key("c-l/15") + Text(u"%(text)s") + Pause("15") + Key("enter"),
+    "search <text>":        Key("c-l/15") + utils.output_text_action(u"%(text)s", text_output) + Pause("15") + Key("enter"),
     "history search <text>": Key("c-l/15") + Text("history") + Key("tab") + Text(u"%(text)s") + Key("enter"),
     "history search": Key("c-l/15") + Text("history") + Key("tab"),
     "moma search <text>": Key("c-l/15") + Text("moma") + Key("tab") + Text(u"%(text)s") + Key("enter"),
@@ -2338,18 +2548,107 @@ linux_action_map = odict[
 run_local_hook("AddLinuxCommands", linux_action_map)
 linux_rule = utils.create_rule("LinuxRule", linux_action_map, {}, True,
                                (AppContext(title="Oracle VM VirtualBox") |
-                                AppContext(title="<remotedesktop.corp.google.com>")))
+                                AppContext(title="<remotedesktop.corp.google.com>")),
+                               element_interner=element_interner)
 
 
 #-------------------------------------------------------------------------------
 # Populate and load the grammars.
 
-grammars = global_environment.create_grammars()
+# With STAGED_LOADING, only the Global grammar is built and loaded before this
+# module finishes importing, so basic commands work as soon as possible. The
+# other grammars and services are then set up one per engine timer tick.
+staged_loader = utils.StagedLoader(
+    module_start_time,
+    interval=(getattr(local, "STAGED_LOADING_INTERVAL", 0.05)
+              if getattr(local, "STAGED_LOADING", False) else None),
+    fatal_errors=(grammar_analysis.GrammarBudgetError,))
+# Compare the load times and resident memory printed once loading finishes
+# with SHARE_RULES on and off to measure the savings.
+rule_registry = utils.RuleRegistry(element_interner, share=getattr(local, "SHARE_RULES", True))
+# Find the active environment once per window, instead of evaluating every
+# grammar's exclusive context separately.
+context_resolver = (utils.ContextResolver(global_environment.environment, linux.RemoteWindowKey)
+                    if getattr(local, "RESOLVE_CONTEXTS", True) else None)
+# Optionally load the grammars of environments other than Global when their
+# context first matches. Idle grammars are unloaded after GRAMMAR_IDLE_TIMEOUT
+# seconds, or never if it is None.
+LAZY_GRAMMARS = getattr(local, "LAZY_GRAMMARS", False)
+# Fail before loading a grammar if a change makes it too large, e.g.
+# GRAMMAR_BUDGET = {"states": 200000, "repetition_depth": 2}.
+GRAMMAR_BUDGET = getattr(local, "GRAMMAR_BUDGET", None)
+grammars = []
+grammar_controller = utils.GrammarController(
+    "dragonfly", [],
+    lazy_grammars=[] if LAZY_GRAMMARS else None,
+    idle_timeout=getattr(local, "GRAMMAR_IDLE_TIMEOUT", 600),
+    poll_interval=getattr(local, "GRAMMAR_POLL_INTERVAL", 1.0))
+
+def add_grammar(grammar, lazy=False):
+    if GRAMMAR_BUDGET:
+        grammar_analysis.enforce_budget(grammar_analysis.analyze_grammars([grammar]), GRAMMAR_BUDGET)
+    grammars.append(grammar)
+    grammar_controller.add(grammar, lazy)
+
+# Optionally count how often each spec is spoken in each environment. With
+# USAGE_PRUNE_DAYS, specs unused for that many days are left out of the
+# grammars.
+usage_stats = (usage.UsageStats(getattr(local, "USAGE_STATS_PATH", None)
+                                or os.path.join(local.HOME, "usage_stats.json"))
+               if getattr(local, "USAGE_STATS", False) else None)
+USAGE_PRUNE_DAYS = getattr(local, "USAGE_PRUNE_DAYS", None)
+if usage_stats:
+    usage_observer = usage.UsageObserver(usage_stats)
+    usage_observer.register()
+pruned_specs = {}
+
+def add_environment_grammar(environment):
+    if usage_stats:
+        usage_stats.register_specs(environment.name, environment.specs())
+        if USAGE_PRUNE_DAYS:
+            pruned_specs[environment.name] = (usage_stats.unused_specs(environment.name, USAGE_PRUNE_DAYS)
+                                              & environment.specs())
+    add_grammar(environment.create_grammar(MyEnvironment.create_exported_rule, rule_registry, context_resolver,
+                                           pruned_specs.get(environment.name)),
+                lazy=LAZY_GRAMMARS and environment is not global_environment.environment)
+
+def print_grammar_report():
+    print(grammar_analysis.format_report(grammar_analysis.analyze_grammars(grammars)))
+
+def print_pruning_report():
+    """Compares the pruned grammars with the grammars they would otherwise be."""
+    analyzer = grammar_analysis.GrammarAnalyzer()
+    unpruned_registry = utils.RuleRegistry(element_interner)
+    for environment in global_environment.environment.walk():
+        excluded_specs = pruned_specs.get(environment.name)
+        if not excluded_specs:
+            continue
+        grammar = [grammar for grammar in grammars if grammar.name == environment.name][0]
+        unpruned_grammar = environment.create_grammar(MyEnvironment.create_exported_rule, unpruned_registry)
+        stats = analyzer.analyze_grammar(grammar)
+        unpruned_stats = analyzer.analyze_grammar(unpruned_grammar)
+        print("%s: pruned %d of %d specs, states %d -> %d, log10 expansions %.1f -> %.1f" % (
+            environment.name, len(excluded_specs), len(environment.specs()),
+            unpruned_stats.states, stats.states,
+            unpruned_stats.log10_expansions, stats.log10_expansions))
+
+def load_global_grammar():
+    add_environment_grammar(global_environment.environment)
+    grammar_controller.load()
+
+staged_loader.add_stage("Global", load_global_grammar, blocking=True)
+for environment in global_environment.environment.walk():
+    if environment is not global_environment.environment:
+        staged_loader.add_stage(environment.name,
+                                lambda environment=environment: add_environment_grammar(environment))
 
 # TODO Figure out either how to integrate this with the repeating rule or move out.
-linux_grammar = Grammar("linux")   # Create this module's grammar.
-linux_grammar.add_rule(linux_rule)
-grammars.append(linux_grammar)
+def load_linux_grammar():
+    linux_grammar = Grammar("linux")   # Create this module's grammar.
+    linux_grammar.add_rule(linux_rule)
+    add_grammar(linux_grammar)
+
+staged_loader.add_stage("linux", load_linux_grammar)
 
 class BenchmarkRule(MappingRule):
     mapping = {
@@ -2358,12 +2657,12 @@ class BenchmarkRule(MappingRule):
     }
     extras = [Dictation("command"), IntegerRef("n", 1, 10, default=1)]
 
-benchmark_grammar = Grammar("benchmark")
-benchmark_grammar.add_rule(BenchmarkRule())
-grammars.append(benchmark_grammar)
+def load_benchmark_grammar():
+    benchmark_grammar = Grammar("benchmark")
+    benchmark_grammar.add_rule(BenchmarkRule())
+    add_grammar(benchmark_grammar)
 
-grammar_controller = utils.GrammarController("dragonfly", grammars)
-grammar_controller.load()
+staged_loader.add_stage("benchmark", load_benchmark_grammar)
 
 #-------------------------------------------------------------------------------
 # Start a server which lets Emacs send us nearby text being edited, so we can
@@ -2371,28 +2670,21 @@ grammar_controller.load()
 # the local machine, except it is still potentially vulnerable to CSRF
 # attacks. Consider this when adding new functionality.
 
-# Register timer to run arbitrary callbacks added by the server.
-callbacks = queue.Queue()
-
-
-def RunCallbacks():
-    while callbacks and not callbacks.empty():
-        callback = callbacks.get_nowait()
-        try:
-            callback()
-        except Exception as exception:
-            traceback.print_exc()
-
-
-timer = get_engine().create_timer(RunCallbacks, 0.1)
+# Keep the context phrases to a size Dragon handles well, and don't reload them
+# on every keystroke.
+CONTEXT_PHRASE_LIMIT = getattr(local, "CONTEXT_PHRASE_LIMIT", 500)
+# Larger buffers are rejected rather than read into the Dragon process.
+MAX_CONTEXT_BYTES = getattr(local, "MAX_CONTEXT_BYTES", 10 * 1024 * 1024)
+# Counting runs on the server thread and competes with recognition for the GIL,
+# so stop after this many seconds and use the phrases counted so far.
+CONTEXT_TIME_BUDGET = getattr(local, "CONTEXT_TIME_BUDGET", 0.5)
+context_phrase_updater = utils.ListUpdater(
+    context_phrase_list, grammars,
+    min_interval=getattr(local, "CONTEXT_PHRASE_UPDATE_INTERVAL", 5.0))
 
 # Update the context phrases.
 def UpdateWords(phrases):
-    # Not currently used, and not working if enabled. Tests indicate that the
-    # list of words is being updated, but Dragon is only aware of the words that
-    # were initially loaded.
-    # context_phrase_list.set(phrases)
-    pass
+    context_phrase_updater.update(phrases)
 
 def IsValidIp(ip):
     m = re.match(r"^(\d{1,3})\.(\d{1,3})\.(\d{1,3})\.(\d{1,3})$", ip)
@@ -2400,7 +2692,9 @@ def IsValidIp(ip):
 
 class TextRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     """HTTP handler for receiving a block of text. The file type can be provided
-    with header My-File-Type.
+    with header My-File-Type, and the cursor offset with My-Cursor-Position (as
+    an Emacs point, starting at 1). Bodies over MAX_CONTEXT_BYTES are rejected,
+    and the rest are processed in chunks for up to CONTEXT_TIME_BUDGET seconds.
     TODO: Use JSON instead of custom headers and dispatch based on path.
     """
 
@@ -2410,18 +2704,30 @@ class TextRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     # def PostInternal(self):
         start_time = time.time()
         # Check host in case of DNS rebinding attack.
-        host = self.headers.getheader("Host")
-        host = host.split(":")[0]
+        host = (self.headers.get("Host") or "").split(":")[0]
         if not (host == "localhost" or host == "localhost." or IsValidIp(host)):
             print("Host header rejected: " + host)
             return
-        length = self.headers.getheader("content-length")
-        file_type = self.headers.getheader("My-File-Type")
-        request_text = self.rfile.read(int(length)) if length else ""
-        # print("received text: %s" % request_text)
-        phrases = text.extract_phrases(request_text, file_type)
+        try:
+            length = int(self.headers.get("content-length") or 0)
+            cursor = self.headers.get("My-Cursor-Position")
+            cursor = int(cursor) - 1 if cursor else None
+        except ValueError:
+            print("Invalid header in request")
+            self.send_error(400)
+            return
+        if length > MAX_CONTEXT_BYTES:
+            print("Request too large: %d bytes" % length)
+            self.send_error(413)
+            return
+        file_type = self.headers.get("My-File-Type")
+        counter = text.count_phrases(self.ReadChunks(length), file_type, cursor=cursor,
+                                     time_budget=CONTEXT_TIME_BUDGET)
+        if counter.truncated:
+            print("Context truncated after %.2f seconds" % CONTEXT_TIME_BUDGET)
+        phrases = counter.top(CONTEXT_PHRASE_LIMIT)
         # Asynchronously update word lists available to Dragon.
-        callbacks.put_nowait(lambda: UpdateWords(phrases))
+        callbacks.put(lambda: UpdateWords(phrases), key="UpdateWords")
         self.send_response(204)  # no content
         self.end_headers()
         # The following sequence of low-level socket commands was needed to get
@@ -2434,18 +2740,65 @@ class TextRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     def do_GET(self):
         self.do_POST()
 
+    def ReadChunks(self, length, chunk_size=1 << 16):
+        """Reads and decodes the request body in chunks."""
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        while length > 0:
+            data = self.rfile.read(min(chunk_size, length))
+            if not data:
+                break
+            length -= len(data)
+            yield decoder.decode(data)
+        yield decoder.decode(b"", final=True)
+
 
 # Start a single-threaded HTTP server in a separate thread. Bind the server to
 # localhost so it cannot be accessed outside the local computer (except by SSH
 # tunneling).
 HOST, PORT = "127.0.0.1", 9090
-server = BaseHTTPServer.HTTPServer((HOST, PORT), TextRequestHandler)
-server_thread = threading.Thread(target=server.serve_forever)
-server_thread.daemon = True
-server_thread.start()
-
-# Connect to Chrome WebDriver if possible.
-webdriver.create_driver()
+server = None
+
+def start_server():
+    global server
+    server = BaseHTTPServer.HTTPServer((HOST, PORT), TextRequestHandler)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+
+# Services are left out when the grammars are only loaded for replay.
+if getattr(local, "START_SERVICES", True):
+    staged_loader.add_stage("server", start_server)
+    # Connect to Chrome WebDriver if possible.
+    staged_loader.add_stage("webdriver", webdriver.create_driver)
+
+def print_load_times():
+    print("Loaded %d grammars: %s" % (len(grammars), rule_registry.report()))
+    if element_interner:
+        print("Shared elements: " + element_interner.report())
+    if action_interner:
+        print("Shared actions: " + action_interner.report())
+    resident_memory = utils.get_resident_memory()
+    if resident_memory:
+        print("Resident memory: %.1f MB" % (resident_memory / 1e6))
+    if grammar_controller.loader:
+        print(grammar_controller.loader.report())
+    if pruned_specs:
+        print("Pruned %d specs unused for %s days" % (
+            sum(len(specs) for specs in pruned_specs.values()), USAGE_PRUNE_DAYS))
+    print("Time to first command: %.2f seconds, fully loaded: %.2f seconds" % (
+        staged_loader.timings["Global"], time.perf_counter() - module_start_time))
+
+def freeze_heap():
+    # The grammars, rules and actions created above are kept until unload, so
+    # stop the collector from rescanning them during recognition.
+    frozen_count = latency.freeze_heap(getattr(local, "GC_THRESHOLDS", None))
+    print("Froze %d objects, gc thresholds %s" % (frozen_count, gc.get_threshold()))
+
+if getattr(local, "GC_FREEZE", False):
+    staged_loader.add_stage("gc", freeze_heap)
+elif getattr(local, "GC_THRESHOLDS", None):
+    latency.set_thresholds(local.GC_THRESHOLDS)
+staged_loader.add_stage("report", print_load_times)
 
 print("Loaded _repeat.py")
 
@@ -2457,9 +2810,35 @@ def unload():
     if tracker.is_connected:
         tracker.disconnect()
     webdriver.quit_driver()
-    timer.stop()
-    server.shutdown()
-    server.server_close()
+    staged_loader.stop()
+    if keystroke_cache:
+        keystroke_cache.uninstall()
+    if usage_stats:
+        usage_observer.unregister()
+        usage_stats.save()
+    if utterance_log:
+        utterance_log.close()
+    if emacs.channel:
+        emacs.channel.close()
+    if action_executor:
+        action_executor.stop()
+    if element_interner:
+        element_interner.clear()
+    if action_interner:
+        action_interner.clear()
+    if sampling_profiler:
+        latency.tracker.remove_listener(slow_utterance_recorder)
+        sampling_profiler.stop()
+    latency.gc_monitor.uninstall()
+    if getattr(local, "GC_FREEZE", False) and hasattr(gc, "unfreeze"):
+        # Let the collector reclaim this module's objects once unloaded.
+        gc.unfreeze()
+    latency.restore_thresholds()
+    callbacks.stop()
+    context_phrase_updater.stop()
+    if server:
+        server.shutdown()
+        server.server_close()
     gaze_ocr_controller.shutdown(wait=False)
     print("Unloaded _repeat.py")
 
@@ -4,12 +4,25 @@
 
 """Library for extracting words and phrases from text."""
 
+import heapq
 import re
 from six import text_type
+import time
 import _dragonfly_local as local
 
 WORDS_PATH = local.HOME + "/dotfiles/words.txt"
 BLACKLIST_PATH = local.HOME + "/dotfiles/blacklist.txt"
+# Distance in characters from the cursor at which a phrase occurrence gets half
+# of the maximum proximity boost.
+PROXIMITY_SCALE = 2000.0
+# Number of phrases tracked exactly when counting a stream of text. Memory use is
+# bounded by twice this.
+DEFAULT_PHRASE_CAPACITY = 10000
+# Text without newlines is split at the last separator once longer than this
+# many characters when streaming.
+MAX_LINE_LENGTH = 1 << 16
+# Matches the last character which can't be part of a token.
+_LAST_SEPARATOR = re.compile(r"[^A-z_-][A-z_-]*\Z")
 
 
 def split_dictation(dictation):
@@ -65,24 +78,142 @@ def save_words(path, words):
       words_file.write(word + "\n")
 
 
+class Lexer(object):
+  """Strips comments and string literals in a single linear scan.
+
+  One regex matches the start of any construct, and each construct has its own
+  regex which matches the rest of it. Matched text is replaced with spaces,
+  keeping newlines, so offsets and line numbers are preserved. A construct which
+  is still open at the end of the text is returned as the state, to be passed
+  back in with the text that follows.
+  """
+
+  def __init__(self, line_comments=(), block_comments=(), strings=(),
+               multiline_strings=(), raw_strings=(), skips=()):
+    """Each argument is a sequence of delimiters: block_comments has (start, end)
+    pairs, and the string arguments have quotes, which may be several characters
+    long. strings end at the end of the line, multiline_strings don't, and
+    raw_strings don't allow escapes. skips are left as-is, e.g. Lisp character
+    literals."""
+    constructs = []
+    for start in line_comments:
+      constructs.append((start, r"[^\n]*((?=\n))?"))
+    for start, end in block_comments:
+      constructs.append((start, _until(end)))
+    for quote in strings:
+      constructs.append((quote, _until(quote, escape=True, newline=False)))
+    for quote in multiline_strings:
+      constructs.append((quote, _until(quote, escape=True)))
+    for quote in raw_strings:
+      constructs.append((quote, _until(quote)))
+    # Try longer delimiters first, so that """ is not lexed as an empty string.
+    constructs.sort(key=lambda construct: -len(construct[0]))
+    # Each construct has two groups: its start and its end delimiter. The
+    # lookahead lets the regex engine skip quickly to the next candidate.
+    first_characters = set(start[0] for start, _ in constructs) | set(skip[0] for skip in skips)
+    self._pattern = re.compile("(?=[%s])(?:%s)" % (
+      re.escape("".join(sorted(first_characters))),
+      "|".join([re.escape(skip) for skip in sorted(skips, key=len, reverse=True)]
+               + ["(%s)%s" % (re.escape(start), rest) for start, rest in constructs])))
+    self._rest_patterns = [re.compile(rest) for _, rest in constructs]
+
+  def strip(self, text, state=None):
+    """Returns the stripped text and the state for the text that follows."""
+    prefix = ""
+    if state is not None:
+      match = state.match(text)
+      prefix = _blank(match.group())
+      if match.group(1) is None:
+        return prefix, state
+      text = text[match.end():]
+    open_constructs = []
+
+    def replace(match):
+      index = match.lastindex
+      if index is None:
+        # A skip.
+        return match.group()
+      if index % 2:
+        # Only the start group matched, so this runs to the end of the text.
+        open_constructs.append(self._rest_patterns[index // 2])
+      return _blank(match.group())
+
+    text = self._pattern.sub(replace, text)
+    return prefix + text, open_constructs[-1] if open_constructs else None
+
+
+_BLANK_PATTERN = re.compile(r"[^\n]")
+
+
+def _blank(text):
+  """Replaces everything but newlines with spaces."""
+  if "\n" in text:
+    return _BLANK_PATTERN.sub(" ", text)
+  return " " * len(text)
+
+
+def _until(end, escape=False, newline=True):
+  """Returns a regex for the rest of a construct, capturing the end delimiter (or
+  the end of the line, if newlines aren't allowed) if present. The loop is
+  unrolled so the common case is a single character class, and each character
+  is consumed once, so matching is linear."""
+  excluded = re.escape(end[0]) + ("\\\\" if escape else "") + ("" if newline else "\\n")
+  special = []
+  if len(end) > 1:
+    special.append("%s(?!%s)" % (re.escape(end[0]), re.escape(end[1:])))
+  if escape:
+    special.append(r"\\[\s\S]")
+  body = "[^%s]*" % excluded
+  if special:
+    body += "(?:(?:%s)[^%s]*)*" % ("|".join(special), excluded)
+  return "%s(%s%s)?" % (body, re.escape(end), "" if newline else "|(?=\n)")
+
+
+_C_COMMENTS = dict(line_comments=["//"], block_comments=[("/*", "*/")])
+LEXERS = {}
+
+
+def register_lexer(file_types, lexer):
+  for file_type in file_types:
+    LEXERS[file_type] = lexer
+
+
+register_lexer(["py"], Lexer(line_comments=["#"], strings=['"', "'"],
+                             multiline_strings=['"""', "'''"]))
+register_lexer(["el"], Lexer(line_comments=[";"], multiline_strings=['"'],
+                             skips=['?\\"', "?\\\\", '?"', "?;"]))
+register_lexer(["c", "cc", "cpp", "h", "hpp", "java", "cs", "kt", "scala", "swift"],
+               Lexer(strings=['"', "'"], **_C_COMMENTS))
+register_lexer(["js", "ts", "jsx", "tsx"],
+               Lexer(strings=['"', "'"], multiline_strings=["`"], **_C_COMMENTS))
+register_lexer(["go"], Lexer(strings=['"', "'"], raw_strings=["`"], **_C_COMMENTS))
+# Only plain strings: single quotes are also used for lifetimes.
+register_lexer(["rs"], Lexer(multiline_strings=['"'], **_C_COMMENTS))
+register_lexer(["sh", "bash", "zsh"], Lexer(line_comments=["#"], multiline_strings=['"'],
+                                            raw_strings=["'"], skips=["$#", "${#"]))
+# Used for unknown file types.
+DEFAULT_LEXER = Lexer(strings=['"'])
+
+
+def get_lexer(file_type):
+  return LEXERS.get(file_type, DEFAULT_LEXER)
+
+
 def remove_plaintext(text, file_type=None):
-  if file_type == "py":
-    text = re.sub(re.compile(r"#.*$", re.MULTILINE), "", text)
-  if file_type == "el":
-    text = re.sub(re.compile(r";.*$", re.MULTILINE), "", text)
-  if file_type == "cc" or file_type == "h":
-    text = re.sub(re.compile(r"//.*$", re.MULTILINE), "", text)
-  text = re.sub(re.compile(r"\".*?\"", re.MULTILINE), "", text)
-  return text
+  """Replaces comments and strings with spaces, so offsets are preserved."""
+  return get_lexer(file_type).strip(text)[0]
 
 
-def remove_blacklist_words(words):
+def parse_blacklist():
   try:
-    blacklist_words = parse_words(BLACKLIST_PATH)
+    return parse_words(BLACKLIST_PATH)
   except:
     print("Unable to open: " + BLACKLIST_PATH)
-    blacklist_words = set()
-  return words - blacklist_words
+    return set()
+
+
+def remove_blacklist_words(words):
+  return words - parse_blacklist()
 
 
 def get_words(text):
@@ -97,7 +228,113 @@ def extract_words(text, file_type=None):
   return remove_blacklist_words(words)
 
 
+def get_phrases(text):
+  return [" ".join(get_words(phrase)) for phrase in re.findall(r"[A-z_-]+", text)]
+
+
 def extract_phrases(text, file_type=None):
   text = remove_plaintext(text, file_type)
-  words = set([" ".join(get_words(phrase)) for phrase in re.findall(r"[A-z_-]+", text)])
+  words = set(get_phrases(text))
   return remove_blacklist_words(words)
+
+
+class PhraseCounter(object):
+  """Space-saving sketch of the most frequent phrases in a stream.
+
+  Tracks between capacity and twice capacity phrases. When full, only the top
+  capacity phrases are kept, and phrases seen afterwards start from the
+  highest count dropped so far. Counts are therefore overestimated by at most
+  that floor, and any phrase with a true count above it is retained.
+  """
+
+  def __init__(self, capacity=DEFAULT_PHRASE_CAPACITY):
+    self.capacity = capacity
+    self.floor = 0.0
+    # Set by count_phrases if it ran out of time.
+    self.truncated = False
+    self._counts = {}
+
+  def __len__(self):
+    return len(self._counts)
+
+  def add(self, phrase, weight=1.0):
+    count = self._counts.get(phrase)
+    if count is not None:
+      self._counts[phrase] = count + weight
+      return
+    self._counts[phrase] = self.floor + weight
+    if len(self._counts) > 2 * self.capacity:
+      self._prune()
+
+  def _prune(self):
+    kept = heapq.nlargest(self.capacity + 1, self._counts.items(),
+                          key=lambda item: item[1])
+    self.floor = max(self.floor, kept.pop()[1])
+    self._counts = dict(kept)
+
+  def count(self, phrase):
+    return self._counts.get(phrase, 0)
+
+  def top(self, limit=None):
+    """Returns phrases, best first."""
+    phrases = sorted(self._counts, key=lambda phrase: (-self._counts[phrase], phrase))
+    return phrases[:limit] if limit is not None else phrases
+
+
+def _split_lines(chunks):
+  """Regroups chunks of text so each group ends on a line boundary. Long lines
+  are split after a separator, so tokens stay whole."""
+  remainder = ""
+  for chunk in chunks:
+    text = remainder + chunk
+    end = text.rfind("\n") + 1
+    if not end and len(text) > MAX_LINE_LENGTH:
+      separator = _LAST_SEPARATOR.search(text)
+      end = separator.start() + 1 if separator else len(text)
+    remainder = text[end:]
+    if end:
+      yield text[:end]
+  if remainder:
+    yield remainder
+
+
+def count_phrases(chunks, file_type=None, cursor=None, capacity=DEFAULT_PHRASE_CAPACITY,
+                  time_budget=None, clock=time.perf_counter):
+  """Counts the phrases in an iterable of text chunks using bounded memory. Each
+  occurrence of a phrase scores one, plus up to one more the closer it is to the
+  cursor offset (if provided). If time_budget seconds pass, the remaining chunks
+  are left unread and the counter is marked truncated. Returns a PhraseCounter."""
+  counter = PhraseCounter(capacity)
+  deadline = clock() + time_budget if time_budget is not None else None
+  blacklist = parse_blacklist()
+  # Identifiers repeat a lot in source code, so cache their phrases.
+  token_phrases = {}
+  lexer = get_lexer(file_type)
+  lexer_state = None
+  offset = 0
+  for lines in _split_lines(chunks):
+    if deadline is not None and clock() > deadline:
+      counter.truncated = True
+      break
+    stripped, lexer_state = lexer.strip(lines, lexer_state)
+    for match in re.finditer(r"[A-z_-]+", stripped):
+      token = match.group()
+      phrase = token_phrases.get(token)
+      if phrase is None:
+        if len(token_phrases) > capacity:
+          token_phrases.clear()
+        phrase = token_phrases[token] = " ".join(get_words(token))
+      if not phrase or phrase in blacklist:
+        continue
+      score = 1.0
+      if cursor is not None:
+        score += PROXIMITY_SCALE / (PROXIMITY_SCALE + abs(offset + match.start() - cursor))
+      counter.add(phrase, score)
+    offset += len(lines)
+  return counter
+
+
+def rank_phrases(text, file_type=None, cursor=None, limit=None):
+  """Returns the phrases in text, best first. See count_phrases for scoring.
+  Returns at most limit phrases."""
+  return count_phrases([text], file_type, cursor).top(limit)
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# (c) Copyright 2015 by James Stout
+# Licensed under the LGPL, see <http://www.gnu.org/licenses/>
+
+"""Usage statistics for command specs.
+
+Counts how often each MappingRule spec is spoken, keyed by environment (the name
+of the grammar which recognized it) and spec. This includes specs in rules
+referenced by other rules, such as the command rules within a RepeatRule. For
+each key it keeps:
+
+  count: number of times spoken.
+  first_seen: when the spec was first registered or spoken.
+  last_used: when the spec was last spoken, or None.
+
+Stats are kept in memory and saved as JSON at most every save_interval seconds.
+Specs registered with register_specs can then be pruned from grammars once they
+have gone unused for a number of days.
+"""
+
+import json
+import os
+import time
+
+from dragonfly import MappingRule, RecognitionObserver
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+
+class UsageStats(object):
+
+    def __init__(self, path=None, save_interval=300):
+        self.path = path
+        self.save_interval = save_interval
+        self._stats = self._load() if path else {}
+        self._last_save_time = time.time()
+        self._dirty = False
+
+    def _load(self):
+        try:
+            with open(self.path) as stats_file:
+                return json.load(stats_file)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def save(self):
+        if not (self.path and self._dirty):
+            return
+        with open(self.path + ".tmp", "w") as stats_file:
+            json.dump(self._stats, stats_file, indent=1, sort_keys=True)
+        os.replace(self.path + ".tmp", self.path)
+        self._last_save_time = time.time()
+        self._dirty = False
+
+    def _entry(self, environment, spec, now):
+        specs = self._stats.setdefault(environment, {})
+        entry = specs.get(spec)
+        if entry is None:
+            entry = specs[spec] = {"count": 0, "first_seen": now, "last_used": None}
+            self._dirty = True
+        return entry
+
+    def register_specs(self, environment, specs):
+        """Starts tracking specs which may be pruned."""
+        now = time.time()
+        for spec in specs:
+            self._entry(environment, spec, now)
+
+    def record(self, environment, node):
+        """Records every MappingRule spec in a recognition's parse tree."""
+        now = time.time()
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if isinstance(node.actor, MappingRule):
+                # The rule's Alternative, then the Compound for the spec.
+                spec = node.children[0].children[0].actor._spec
+                entry = self._entry(environment, spec, now)
+                entry["count"] += 1
+                entry["last_used"] = now
+                self._dirty = True
+            stack.extend(node.children)
+        if now - self._last_save_time >= self.save_interval:
+            self.save()
+
+    def count(self, environment, spec):
+        entry = self._stats.get(environment, {}).get(spec)
+        return entry["count"] if entry else 0
+
+    def unused_specs(self, environment, days, now=None):
+        """Returns specs which have been tracked for at least the given number of
+        days, and not used within them."""
+        cutoff = (now or time.time()) - days * SECONDS_PER_DAY
+        return set(spec for spec, entry in self._stats.get(environment, {}).items()
+                   if entry["first_seen"] <= cutoff
+                   and (entry["last_used"] is None or entry["last_used"] < cutoff))
+
+
+class UsageObserver(RecognitionObserver):
+    """Records every rule recognition in usage stats."""
+
+    def __init__(self, usage_stats):
+        RecognitionObserver.__init__(self)
+        self._usage_stats = usage_stats
+
+    def on_recognition(self, words, rule, node):
+        if rule is not None and rule.grammar is not None:
+            self._usage_stats.record(rule.grammar.name, node)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# (c) Copyright 2015 by James Stout
+# Licensed under the LGPL, see <http://www.gnu.org/licenses/>
+
+"""Append-only binary log of recognized utterances.
+
+Each record is a fixed-size header followed by its data:
+
+  header: timestamp, source, environment length, word count, words length.
+  data: the UTF-8 environment, a rule ID per word, then the UTF-8 words
+    separated by NUL characters.
+
+The environment is the name of the grammar which recognized the utterance for
+"repeat" records (written by RepeatRule), and the foreground executable for
+"natlink" records (written by SaveAudioGrammar, which sees every result).
+Records are written with a single write call, so both can append to the same
+file. A record truncated by a crash ends the log when it is read.
+
+See replay_utterances.py to replay a log as a benchmark.
+"""
+
+from collections import namedtuple
+import struct
+import time
+
+# Record sources, in encoding order.
+SOURCES = ("repeat", "natlink")
+
+# Timestamp, source, environment length, word count, words length.
+_HEADER = struct.Struct("<dBHHI")
+_RULE_ID = struct.Struct("<I")
+
+Utterance = namedtuple("Utterance", ["timestamp", "source", "environment", "words", "rule_ids"])
+
+
+def encode_utterance(utterance):
+    environment = utterance.environment.encode("utf-8")
+    words = u"\0".join(utterance.words).encode("utf-8")
+    return b"".join([
+        _HEADER.pack(utterance.timestamp, SOURCES.index(utterance.source), len(environment),
+                     len(utterance.words), len(words)),
+        environment,
+        struct.pack("<%dI" % len(utterance.rule_ids), *utterance.rule_ids),
+        words,
+    ])
+
+
+def decode_utterances(data):
+    """Yields the utterances in a log's contents, stopping at a truncated record."""
+    offset = 0
+    while offset + _HEADER.size <= len(data):
+        timestamp, source, environment_length, word_count, words_length = _HEADER.unpack_from(data, offset)
+        offset += _HEADER.size
+        end = offset + environment_length + word_count * _RULE_ID.size + words_length
+        if end > len(data):
+            return
+        environment = data[offset:offset + environment_length].decode("utf-8")
+        offset += environment_length
+        rule_ids = struct.unpack_from("<%dI" % word_count, data, offset)
+        offset += word_count * _RULE_ID.size
+        words = data[offset:end].decode("utf-8").split(u"\0") if word_count else []
+        offset = end
+        yield Utterance(timestamp, SOURCES[source], environment, words, list(rule_ids))
+
+
+def read_utterances(path, source=None):
+    with open(path, "rb") as log_file:
+        data = log_file.read()
+    for utterance in decode_utterances(data):
+        if source is None or utterance.source == source:
+            yield utterance
+
+
+class UtteranceLog(object):
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "ab")
+
+    def append(self, words_rules, environment, source, timestamp=None):
+        """Appends an utterance given as (word, rule ID) pairs."""
+        utterance = Utterance(timestamp or time.time(), source, environment,
+                              [word for word, _ in words_rules],
+                              [rule_id for _, rule_id in words_rules])
+        self._file.write(encode_utterance(utterance))
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
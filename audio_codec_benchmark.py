@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# (c) Copyright 2015 by James Stout
+# Licensed under the LGPL, see <http://www.gnu.org/licenses/>
+
+"""Benchmarks the saved audio codecs on previously saved utterances.
+
+Usage: audio_codec_benchmark.py SAVE_AUDIO_DIR [--limit N]
+
+Reads the rec-*.wav files saved by _natlink_save_audio.py, or the samples of a
+sharded dataset if the directory contains one, and reports compression ratio
+and encode/decode throughput for every codec.
+"""
+
+import argparse
+import glob
+import os
+import time
+
+import _audio_dataset as audio_dataset
+
+
+def load_audio(directory, limit):
+    if os.path.exists(os.path.join(directory, audio_dataset.INDEX_FILENAME)):
+        with audio_dataset.AudioDataset(directory) as dataset:
+            return [sample.audio for sample, _ in zip(dataset.samples(), range(limit))]
+    audio = []
+    for path in sorted(glob.glob(os.path.join(directory, "*.wav")))[:limit]:
+        with open(path, "rb") as wav_file:
+            audio.append(wav_file.read())
+    return audio
+
+
+def benchmark_codec(codec, audio):
+    start_time = time.perf_counter()
+    encoded = [audio_dataset.encode_audio(data, codec) for data in audio]
+    encode_time = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    decoded = [audio_dataset.decode_audio(data, codec) for data in encoded]
+    decode_time = time.perf_counter() - start_time
+    if decoded != audio:
+        raise AssertionError("Codec is not lossless: " + codec)
+    return sum(len(data) for data in encoded), encode_time, decode_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("directory")
+    parser.add_argument("--limit", type=int, default=1000,
+                        help="Maximum number of utterances to load.")
+    args = parser.parse_args()
+    audio = load_audio(args.directory, args.limit)
+    input_bytes = sum(len(data) for data in audio)
+    if not input_bytes:
+        print("No audio found in: " + args.directory)
+        return
+    print("%d utterances, %.1f MB" % (len(audio), input_bytes / 1e6))
+    print("%-12s %8s %14s %14s" % ("codec", "ratio", "encode MB/s", "decode MB/s"))
+    for codec in audio_dataset.CODECS:
+        output_bytes, encode_time, decode_time = benchmark_codec(codec, audio)
+        print("%-12s %8.2f %14.1f %14.1f" % (codec,
+                                             float(input_bytes) / output_bytes,
+                                             input_bytes / 1e6 / encode_time,
+                                             input_bytes / 1e6 / decode_time))
+
+
+if __name__ == "__main__":
+    main()
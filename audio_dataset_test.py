@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# (c) Copyright 2015 by James Stout
+# Licensed under the LGPL, see <http://www.gnu.org/licenses/>
+
+from _audio_dataset import *
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class AudioDatasetTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_append_and_read(self):
+        with AudioDataset(self.directory) as dataset:
+            self.assertEqual(0, dataset.append(b"\x01\x02", "hello world", "dictation", 1.0))
+            self.assertEqual(1, dataset.append(b"\x03\x04\x05", "up down", "grammar", 2.0))
+            self.assertEqual(2, len(dataset))
+            self.assertEqual(Sample("hello world", "dictation", 1.0, b"\x01\x02"), dataset[0])
+            self.assertEqual(["up down"], [sample.words for sample in dataset.samples("grammar")])
+            self.assertEqual(1, dataset.count("dictation"))
+            self.assertEqual(0, dataset.count("mixed"))
+
+    def test_shard_rollover(self):
+        with AudioDataset(self.directory, max_shard_bytes=10) as dataset:
+            for i in range(5):
+                dataset.append(b"12345678", u"caf\xe9", "mixed", float(i))
+            self.assertEqual([u"caf\xe9"] * 5, [sample.words for sample in dataset.samples()])
+        shards = sorted(name for name in os.listdir(self.directory) if name.startswith("shard-"))
+        self.assertEqual(5, len(shards))
+
+    def test_reopen_appends(self):
+        with AudioDataset(self.directory, max_shard_bytes=100) as dataset:
+            dataset.append(b"abc", "first", "reject", 1.0)
+        with AudioDataset(self.directory, max_shard_bytes=100) as dataset:
+            dataset.append(b"def", "second", "dictation", 2.0)
+            self.assertEqual([b"abc", b"def"], [sample.audio for sample in dataset.samples()])
+            self.assertEqual(["second"], [sample.words for sample in dataset.samples("dictation")])
+
+    def test_codecs_are_lossless(self):
+        audio = b"RIFF" + bytes(bytearray(range(256))) * 3 + b"\x7f"
+        for codec in CODECS:
+            self.assertEqual(audio, decode_audio(encode_audio(audio, codec), codec))
+        self.assertEqual(b"", decode_audio(encode_audio(b"", "delta-zlib"), "delta-zlib"))
+
+    def test_compressed_samples(self):
+        with AudioDataset(self.directory, codec="delta-zlib") as dataset:
+            dataset.append(b"\x00\x01" * 1000, "hello", "dictation", 1.0)
+            self.assertLess(dataset.size(), 1000)
+        with AudioDataset(self.directory) as dataset:
+            self.assertEqual(b"\x00\x01" * 1000, dataset[0].audio)
+
+    def test_evict_oldest(self):
+        with AudioDataset(self.directory, max_shard_bytes=20, max_bytes=50) as dataset:
+            for i in range(10):
+                number = dataset.append(b"123456789", str(i), "grammar", float(i))
+            self.assertEqual(3, number)
+            self.assertLessEqual(dataset.size(), 50)
+            self.assertEqual(["6", "7", "8", "9"], [sample.words for sample in dataset.samples()])
+        with AudioDataset(self.directory) as dataset:
+            self.assertEqual(["6", "7", "8", "9"], [sample.words for sample in dataset.samples()])
+
+    def test_evict_by_type(self):
+        with AudioDataset(self.directory, max_shard_bytes=22,
+                          max_bytes_by_type={"dictation": 50}) as dataset:
+            for i in range(6):
+                dataset.append(b"123456789", "d%d" % i, "dictation", float(i))
+                dataset.append(b"123456789", "m%d" % i, "mixed", float(i))
+            self.assertEqual(["m0", "m1", "m2", "m3", "m4", "m5"],
+                             [sample.words for sample in dataset.samples("mixed")])
+            # The shard holding d0 and d1 was evicted whole.
+            self.assertEqual(["d2", "d3", "d4", "d5"],
+                             [sample.words for sample in dataset.samples("dictation")])
+            self.assertEqual([b"123456789"] * 10, [sample.audio for sample in dataset.samples()])
+        shards = [name for name in os.listdir(self.directory) if name.startswith("shard-")]
+        self.assertEqual(5, len(shards))
+
+
+if __name__ == "__main__":
+    unittest.main()
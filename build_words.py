@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# (c) Copyright 2015 by James Stout
+# Licensed under the LGPL, see <http://www.gnu.org/licenses/>
+
+"""Builds words.txt from the words and phrases used in source trees.
+
+Usage: build_words.py DIR [DIR ...] [--output PATH] [--limit N] [--processes N]
+
+Files are stripped of comments and strings by file type and counted in a process
+pool. Counts per file are kept in an index next to the output along with file
+modification times, so re-runs only read files which changed. The index also
+records the ranked words last written, so ranked words are re-ranked on each run
+while words added to the output by hand are kept ahead of them.
+"""
+
+import argparse
+from collections import Counter
+import io
+import json
+import multiprocessing
+import os
+import os.path
+
+import _text_utils as text
+
+# File types with a registered lexer.
+DEFAULT_EXTENSIONS = tuple(sorted(text.LEXERS))
+SKIPPED_DIRECTORIES = ("node_modules", "__pycache__")
+INDEX_VERSION = 1
+# Skip generated and minified files.
+MAX_FILE_BYTES = 1 << 20
+
+
+def find_files(directories, extensions):
+    """Yields (path, mtime, size) for source files under the directories."""
+    for directory in directories:
+        for root, dirs, files in os.walk(directory):
+            dirs[:] = [name for name in dirs
+                       if not name.startswith(".") and name not in SKIPPED_DIRECTORIES]
+            for name in files:
+                if os.path.splitext(name)[1][1:] not in extensions:
+                    continue
+                path = os.path.abspath(os.path.join(root, name))
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if stat.st_size <= MAX_FILE_BYTES:
+                    yield path, stat.st_mtime, stat.st_size
+
+
+def count_file(path):
+    """Returns (path, word counts, phrase counts) for a file, or None counts if it
+    can't be read. Runs in a worker process."""
+    try:
+        with io.open(path, encoding="utf-8", errors="replace") as source_file:
+            contents = source_file.read()
+    except (IOError, OSError):
+        return path, None, None
+    contents = text.remove_plaintext(contents, os.path.splitext(path)[1][1:])
+    words = Counter(text.get_words(contents))
+    # Single words are already counted above.
+    phrases = Counter(phrase for phrase in text.get_phrases(contents) if " " in phrase)
+    return path, dict(words), dict(phrases)
+
+
+def load_index(path):
+    """Returns the indexed files and the ranked words last written."""
+    try:
+        with open(path) as index_file:
+            index = json.load(index_file)
+    except (IOError, OSError, ValueError):
+        return {}, []
+    if index.get("version") != INDEX_VERSION:
+        return {}, []
+    return index["files"], index.get("ranked", [])
+
+
+def save_index(path, files, ranked_words):
+    with open(path + ".tmp", "w") as index_file:
+        json.dump({"version": INDEX_VERSION, "files": files, "ranked": ranked_words}, index_file)
+    os.replace(path + ".tmp", path)
+
+
+def update_index(index, directories, extensions, processes):
+    """Returns a new index for the files under the directories, reusing entries of
+    unchanged files, and the number of files read."""
+    files = {}
+    stale = []
+    for path, mtime, size in find_files(directories, extensions):
+        entry = index.get(path)
+        if entry and entry["mtime"] == mtime and entry["size"] == size:
+            files[path] = entry
+        else:
+            files[path] = {"mtime": mtime, "size": size}
+            stale.append(path)
+    if not stale:
+        return files, 0
+    pool = multiprocessing.Pool(processes)
+    try:
+        for path, words, phrases in pool.imap_unordered(count_file, stale, chunksize=16):
+            if words is None:
+                del files[path]
+            else:
+                files[path]["words"] = words
+                files[path]["phrases"] = phrases
+    finally:
+        pool.close()
+        pool.join()
+    return files, len(stale)
+
+
+def rank_words(files, limit, include_phrases=True):
+    """Returns the most common words and phrases, best first."""
+    counts = Counter()
+    for entry in files.values():
+        counts.update(entry["words"])
+        if include_phrases:
+            counts.update(entry["phrases"])
+    blacklist = text.parse_blacklist()
+    ranked = sorted((word for word in counts if len(word) > 2 and word not in blacklist),
+                    key=lambda word: (-counts[word], word))
+    return ranked[:limit]
+
+
+def write_words(path, existing_words, ranked_words):
+    existing = set(existing_words)
+    with io.open(path + ".tmp", "w", encoding="utf-8") as words_file:
+        for word in existing_words + [word for word in ranked_words if word not in existing]:
+            words_file.write(word + u"\n")
+    os.replace(path + ".tmp", path)
+
+
+def read_existing_words(path, ranked_words=()):
+    """Returns the words in the output file, except for the given previously
+    ranked words."""
+    ranked_words = set(ranked_words)
+    try:
+        with io.open(path, encoding="utf-8") as words_file:
+            return [line.strip() for line in words_file
+                    if line.strip() and line.strip() not in ranked_words]
+    except (IOError, OSError):
+        return []
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("directories", nargs="+")
+    parser.add_argument("--output", default=text.WORDS_PATH)
+    parser.add_argument("--index", help="Defaults to the output path plus .index.json.")
+    parser.add_argument("--limit", type=int, default=2000,
+                        help="Maximum number of ranked words to add.")
+    parser.add_argument("--processes", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--extensions", default=",".join(DEFAULT_EXTENSIONS))
+    parser.add_argument("--no-phrases", action="store_true",
+                        help="Only add single words.")
+    parser.add_argument("--replace", action="store_true",
+                        help="Discard the words added to the output file by hand.")
+    args = parser.parse_args()
+    index_path = args.index or args.output + ".index.json"
+    index, previous_ranked_words = load_index(index_path)
+    files, read_count = update_index(index, args.directories,
+                                     set(args.extensions.split(",")), args.processes)
+    existing_words = [] if args.replace else read_existing_words(args.output, previous_ranked_words)
+    ranked_words = rank_words(files, args.limit, include_phrases=not args.no_phrases)
+    write_words(args.output, existing_words, ranked_words)
+    save_index(index_path, files, ranked_words)
+    print("Read %d of %d files. Wrote %d words to %s" % (
+        read_count, len(files), len(set(existing_words) | set(ranked_words)), args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# (c) Copyright 2015 by James Stout
+# Licensed under the LGPL, see <http://www.gnu.org/licenses/>
+
+"""Benchmarks build_words.py on a source tree.
+
+Usage: build_words_benchmark.py DIR [--processes 1,2,4,8]
+
+Reports throughput of a cold build (empty index) for each process count, and
+of a warm re-run where no files changed. Nothing is written.
+"""
+
+import argparse
+import time
+
+import build_words
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("directory")
+    parser.add_argument("--processes", default="1,2,4,8",
+                        help="Comma-separated process counts.")
+    args = parser.parse_args()
+    extensions = set(build_words.DEFAULT_EXTENSIONS)
+    total_bytes = sum(size for _, _, size in build_words.find_files([args.directory], extensions))
+    print("%-12s %8s %10s %10s" % ("run", "files", "seconds", "MB/s"))
+    files = {}
+    for processes in [int(count) for count in args.processes.split(",")]:
+        start_time = time.perf_counter()
+        files, read_count = build_words.update_index({}, [args.directory], extensions, processes)
+        elapsed = time.perf_counter() - start_time
+        print("%-12s %8d %10.2f %10.1f" % ("cold x%d" % processes, read_count, elapsed,
+                                           total_bytes / 1e6 / elapsed))
+    start_time = time.perf_counter()
+    _, read_count = build_words.update_index(files, [args.directory], extensions, 1)
+    elapsed = time.perf_counter() - start_time
+    print("%-12s %8d %10.2f" % ("warm", read_count, elapsed))
+    start_time = time.perf_counter()
+    ranked = build_words.rank_words(files, 2000)
+    print("Ranked %d words in %.2f seconds" % (len(ranked), time.perf_counter() - start_time))
+
+
+if __name__ == "__main__":
+    main()
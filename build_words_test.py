@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# (c) Copyright 2015 by James Stout
+# Licensed under the LGPL, see <http://www.gnu.org/licenses/>
+
+from build_words import *
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class BuildWordsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, contents):
+        path = os.path.join(self.directory, name)
+        with open(path, "w") as source_file:
+            source_file.write(contents)
+        return path
+
+    def test_update_index(self):
+        self.write("a.py", "test_word = other_word  # comment_word\n")
+        self.write("b.cc", "test_word();  // comment_word\n")
+        self.write("c.txt", "ignored_word\n")
+        files, read_count = update_index({}, [self.directory], {"py", "cc"}, 1)
+        self.assertEqual(2, read_count)
+        self.assertEqual(["word", "test", "other"], rank_words(files, 3, include_phrases=False))
+        self.assertEqual(["word", "test", "test word"], rank_words(files, 3))
+        files, read_count = update_index(files, [self.directory], {"py", "cc"}, 1)
+        self.assertEqual(0, read_count)
+        self.assertIn("words", files[os.path.join(self.directory, "a.py")])
+        path = self.write("b.cc", "other_word();\n")
+        os.utime(path, (0, 0))
+        files, read_count = update_index(files, [self.directory], {"py", "cc"}, 1)
+        self.assertEqual(1, read_count)
+        self.assertEqual(["word", "other", "other word", "test", "test word"], rank_words(files, 5))
+
+    def test_write_words(self):
+        path = self.write("words.txt", "hand added\n")
+        write_words(path, read_existing_words(path), ["test word", "hand added"])
+        self.assertEqual(["hand added", "test word"], read_existing_words(path))
+        # Previously ranked words are dropped, so they can be re-ranked.
+        write_words(path, read_existing_words(path, ["test word"]), ["other word"])
+        self.assertEqual(["hand added", "other word"], read_existing_words(path))
+
+    def test_index(self):
+        path = os.path.join(self.directory, "words.txt.index.json")
+        self.assertEqual(({}, []), load_index(path))
+        self.write("a.py", "test_word\n")
+        files, _ = update_index({}, [self.directory], {"py"}, 1)
+        save_index(path, files, ["word", "test"])
+        self.assertEqual((files, ["word", "test"]), load_index(path))
+
+
+if __name__ == "__main__":
+    unittest.main()
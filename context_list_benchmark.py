@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# (c) Copyright 2015 by James Stout
+# Licensed under the LGPL, see <http://www.gnu.org/licenses/>
+
+"""Benchmarks how the size of the context phrase list affects decoding.
+
+Usage: context_list_benchmark.py [--sizes 0,100,500,1000,5000] [--repeat N]
+
+Loads a grammar shaped like the custom_text commands in _repeat.py into the
+dragonfly text engine, fills the phrase list with synthetic phrases, and reports
+the mean time to mimic an utterance which uses the list, one which uses
+dictation instead, and to reload the list.
+"""
+
+import argparse
+import time
+
+from dragonfly import (
+    Alternative,
+    Dictation,
+    Function,
+    Grammar,
+    List,
+    ListRef,
+    MappingRule,
+    get_engine,
+)
+
+
+def phrase(i):
+    """Returns a distinct phrase of ordinary words for index i."""
+    words = ["alpha", "bravo", "charlie", "delta", "echo", "foxtrot", "golf", "hotel"]
+    result = []
+    while True:
+        result.append(words[i % len(words)])
+        i //= len(words)
+        if not i:
+            return " ".join(result)
+
+
+def time_mimic(engine, words, repeat):
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        engine.mimic(words)
+    return (time.perf_counter() - start_time) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="0,100,500,1000,5000",
+                        help="Comma-separated list sizes.")
+    parser.add_argument("--repeat", type=int, default=50,
+                        help="Number of utterances per measurement.")
+    args = parser.parse_args()
+    engine = get_engine("text")
+    phrase_list = List("context_phrase_list", [])
+    rule = MappingRule(
+        name="context_phrases",
+        mapping={"go after <custom_text>": Function(lambda custom_text: None)},
+        extras=[Alternative([Dictation(), ListRef(None, phrase_list)], name="custom_text")])
+    grammar = Grammar("context_list_benchmark")
+    grammar.add_rule(rule)
+    grammar.load()
+    print("%8s %14s %14s %14s" % ("size", "list ms", "dictation ms", "update ms"))
+    try:
+        for size in [int(size) for size in args.sizes.split(",")]:
+            phrases = [phrase(i) for i in range(size)]
+            start_time = time.perf_counter()
+            phrase_list.set(phrases)
+            update_time = (time.perf_counter() - start_time) * 1000
+            list_words = "go after " + (phrases[-1] if phrases else "alpha")
+            print("%8d %14.3f %14.3f %14.3f" % (
+                size,
+                time_mimic(engine, list_words, args.repeat),
+                time_mimic(engine, "go after zulu yankee", args.repeat),
+                update_time))
+    finally:
+        grammar.unload()
+
+
+if __name__ == "__main__":
+    main()
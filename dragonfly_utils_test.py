@@ -0,0 +1,451 @@
+#!/usr/bin/env python
+# (c) Copyright 2015 by James Stout
+# Licensed under the LGPL, see <http://www.gnu.org/licenses/>
+
+from _dragonfly_utils import *
+import threading
+import time
+import unittest
+
+from dragonfly import (
+    Alternative,
+    AppContext,
+    Compound,
+    CompoundRule,
+    Context,
+    Dictation,
+    Function,
+    Grammar,
+    IntegerRef,
+    Key,
+    List,
+    ListRef,
+    MappingRule,
+    MimicFailure,
+    RuleWrap,
+    get_engine,
+)
+from dragonfly.actions.action_base_keyboard import BaseKeyboardAction
+
+
+class DragonflyUtilsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        get_engine("text")
+
+    def test_rule_registry(self):
+        registry = RuleRegistry()
+        up = Key("up")
+        element_map = {"text": Dictation()}
+        rule = registry.create_rule("Global_command", {"up": up}, element_map)
+        self.assertIs(rule, registry.create_rule("Emacs_command", {"up": up}, dict(element_map)))
+        self.assertIsNot(rule, registry.create_rule("Shell_command", {"up": Key("up")}, element_map))
+        self.assertIsNot(rule, registry.create_rule("Chrome_command", {"up": up, "down": Key("down")},
+                                                    element_map))
+        self.assertEqual("Global_command", rule.name)
+        self.assertEqual("3 rules created, 1 reused", registry.report())
+        unshared_registry = RuleRegistry(share=False)
+        rule = unshared_registry.create_rule("Global_command", {"up": up}, element_map)
+        self.assertIsNot(rule, unshared_registry.create_rule("Emacs_command", {"up": up}, element_map))
+        self.assertEqual("2 rules created, 0 reused", unshared_registry.report())
+
+    def test_element_interner(self):
+        interner = ElementInterner()
+        phrases = List("phrases", ["hello world"])
+        other_phrases = List("other_phrases", ["hello world"])
+
+        def custom_text():
+            return RuleWrap(None, Alternative([Dictation(), IntegerRef(None, 1, 10), ListRef(None, phrases)]))
+
+        text = interner.intern(custom_text())
+        self.assertIs(text, interner.intern(custom_text()))
+        self.assertIsNot(text, interner.intern(RuleWrap(None, Alternative([
+            Dictation(), IntegerRef(None, 1, 10), ListRef(None, other_phrases)]))))
+        self.assertIsNot(text, interner.intern(RuleWrap(None, Alternative([
+            Dictation(), IntegerRef(None, 1, 11), ListRef(None, phrases)]))))
+        self.assertEqual("1 of 4 elements deduplicated", interner.report())
+        interner.clear()
+        self.assertIsNot(text, interner.intern(custom_text()))
+
+    def test_shared_element_in_rule(self):
+        interner = ElementInterner()
+        element = RuleWrap(None, Alternative([Dictation(), IntegerRef(None, 1, 10)]))
+        results = []
+        rule = MappingRule("shared", {
+            "words <text> through <text2>": Function(lambda text, text2: results.append((text, text2))),
+        }, element_map_to_extras({"text": element,
+                                  "text2": RuleWrap(None, Alternative([Dictation(), IntegerRef(None, 1, 10)]))},
+                                 interner))
+        self.assertEqual(1, interner.deduplicated_count)
+        grammar = Grammar("shared")
+        grammar.add_rule(rule)
+        grammar.load()
+        try:
+            get_engine().mimic("words hello through world")
+        finally:
+            grammar.unload()
+        self.assertEqual([("hello", "world")], [(str(text), str(text2)) for (text, text2) in results])
+
+    def test_context_resolver(self):
+        emacs_context = CountingContext("emacs")
+        shell_context = CountingContext("shell")
+        chrome_context = CountingContext("chrome")
+        shell = Node("shell", shell_context)
+        emacs = Node("emacs", emacs_context, [shell])
+        chrome = Node("chrome", chrome_context)
+        root = Node("global", None, [emacs, chrome])
+        resolver = ContextResolver(root)
+        self.assertIs(shell, resolver.resolve("emacs", "shell", 1))
+        self.assertIs(shell, resolver.resolve("emacs", "shell", 1))
+        self.assertEqual(1, emacs_context.count)
+        self.assertEqual(0, chrome_context.count)
+        self.assertIs(emacs, resolver.resolve("emacs", "file", 1))
+        self.assertIs(root, resolver.resolve("notepad", "file", 2))
+        self.assertEqual(3, emacs_context.count)
+        self.assertTrue(ResolvedContext(resolver, chrome).matches("chrome", "", 3))
+        self.assertFalse(ResolvedContext(resolver, root).matches("chrome", "", 3))
+        self.assertEqual(4, resolver.resolve_count)
+
+    def test_lazy_grammars(self):
+        results = []
+        emacs_grammar = Grammar("emacs", context=AppContext(executable="emacs"))
+        emacs_grammar.add_rule(create_rule("emacs", {"save file": Function(lambda: results.append("save"))},
+                                           exported=True))
+        controller = GrammarController("lazy", [], lazy_grammars=[emacs_grammar], idle_timeout=0)
+        controller.load()
+        try:
+            self.assertFalse(emacs_grammar.loaded)
+            get_engine().mimic("save file", executable="emacs", title="", handle=1)
+            self.assertTrue(emacs_grammar.loaded)
+            self.assertEqual(["save"], results)
+            with self.assertRaises(MimicFailure):
+                get_engine().mimic("save file", executable="chrome", title="", handle=2)
+            self.assertFalse(emacs_grammar.loaded)
+            self.assertEqual((1, 1), (controller.loader.load_count, controller.loader.unload_count))
+        finally:
+            controller.unload()
+
+    def test_staged_loader(self):
+        results = []
+        controller = GrammarController("staged", [])
+        loader = StagedLoader(time.perf_counter())
+        grammar = Grammar("staged_grammar")
+        grammar.add_rule(create_rule("staged", {"hello world": Function(lambda: results.append("hello"))},
+                                     exported=True))
+        loader.add_stage("load", controller.load)
+        loader.add_stage("grammar", lambda: controller.add(grammar))
+        try:
+            self.assertTrue(grammar.loaded)
+            get_engine().mimic("hello world")
+        finally:
+            controller.unload()
+        self.assertEqual(["hello"], results)
+        self.assertEqual(["load", "grammar"], list(loader.timings))
+        self.assertTrue(loader.done)
+
+    def test_staged_loader_errors(self):
+        results = []
+        loader = StagedLoader(time.perf_counter(), interval=60, fatal_errors=(KeyError,))
+        try:
+            loader.add_stage("blocking", lambda: results.append("blocking"), blocking=True)
+            self.assertEqual(["blocking"], results)
+            loader.add_stage("error", lambda: [][0])
+            loader.add_stage("fatal", lambda: {}["missing"])
+            loader.add_stage("later", lambda: results.append("later"))
+            self.assertEqual(["blocking"], results)
+            loader._run_next()
+            with self.assertRaises(KeyError):
+                loader._run_next()
+        finally:
+            loader.stop()
+        self.assertEqual(["blocking"], results)
+        self.assertEqual(["blocking", "error"], list(loader.timings))
+        self.assertTrue(loader.done)
+
+    def test_callback_queue(self):
+        now = [0.0]
+        results = []
+
+        def callback(name):
+            def run():
+                results.append(name)
+                now[0] += 0.015
+            return run
+
+        queue = CallbackQueue(interval=60, budget=0.02, clock=lambda: now[0])
+        try:
+            self.assertFalse(queue._timer.active)
+            queue.put(callback("words1"), key="words")
+            queue.put(callback("other"))
+            queue.put(callback("words2"), key="words")
+            queue.put(callback("last"))
+            self.assertEqual(3, len(queue))
+            self.assertTrue(queue._timer.active)
+            # Runs callbacks until the budget is spent.
+            queue._run()
+            self.assertEqual(["words2", "other"], results)
+            self.assertTrue(queue._timer.active)
+            # Stops the timer once the queue is empty.
+            queue._run()
+            self.assertEqual(["words2", "other", "last"], results)
+            self.assertFalse(queue._timer.active)
+            # Callbacks from other threads wait for the engine thread to wake
+            # the queue, e.g. at the start of an utterance.
+            thread = threading.Thread(target=queue.put, args=(callback("thread"),))
+            thread.start()
+            thread.join()
+            self.assertEqual(1, len(queue))
+            self.assertFalse(queue._timer.active)
+            try:
+                get_engine().mimic("unknown words")
+            except MimicFailure:
+                pass
+            self.assertTrue(queue._timer.active)
+            queue._run()
+            self.assertEqual(["words2", "other", "last", "thread"], results)
+            self.assertFalse(queue._timer.active)
+            # Stays awake while asked to, even if empty.
+            awake = [True]
+            queue.keep_awake(lambda: awake[0])
+            queue.wake()
+            queue._run()
+            self.assertTrue(queue._timer.active)
+            awake[0] = False
+            queue._run()
+            self.assertFalse(queue._timer.active)
+            queue.put(callback("stopped"))
+        finally:
+            queue.stop()
+        self.assertEqual(0, len(queue))
+        self.assertFalse(queue._timer.active)
+
+    def test_list_updater(self):
+        phrases = List("phrases", [])
+        updater = ListUpdater(phrases, [], min_interval=60)
+        try:
+            updater.update(["hello", "world"])
+            self.assertEqual(["hello", "world"], list(phrases))
+            # Updates within the interval are batched until the timer fires.
+            updater.update(["goodbye"])
+            updater.update(["goodbye", "world"])
+            self.assertEqual(["hello", "world"], list(phrases))
+            updater._apply_pending()
+            self.assertEqual(["goodbye", "world"], list(phrases))
+            updater._last_update_time -= 60
+            updater.update(["world", "goodbye"])
+        finally:
+            updater.stop()
+        self.assertEqual(2, updater.applied_count)
+        self.assertEqual(1, updater.skipped_count)
+
+    def test_list_update_before_lazy_load(self):
+        engine = get_engine()
+        phrases = List("phrases", [])
+        updated = []
+
+        def create_grammar(name, context):
+            grammar = Grammar(name, context=context)
+            grammar.add_rule(MappingRule(name, {"say <phrase>": Function(lambda phrase: None)},
+                                         [ListRef("phrase", phrases)]))
+            return grammar
+
+        lazy = create_grammar("lazy", AppContext(title="Lazy"))
+        eager = create_grammar("eager", None)
+        loader = LazyGrammarLoader([lazy], idle_timeout=0)
+        updater = ListUpdater(phrases, [lazy, eager], min_interval=0)
+        engine.update_list = lambda lst, grammar: updated.append((list(lst), grammar.name))
+        try:
+            loader.update("", "Lazy", 0)
+            eager.load()
+            loader.update("", "Other", 0)
+            self.assertFalse(lazy.loaded)
+            updater.update(["hello"])
+            del updated[:]
+            # The list now pushes to the eager grammar, which was loaded last.
+            loader.update("", "Lazy", 0)
+            self.assertIn((["hello"], "lazy"), updated)
+        finally:
+            del engine.update_list
+            updater.stop()
+            loader.unload()
+            eager.unload()
+
+    def test_action_cache(self):
+        static_words = List("static_words", ["left"])
+        dynamic_words = List("dynamic_words", ["right"])
+        cache = ActionCache(capacity=2, dynamic_lists=[dynamic_words])
+        nodes = []
+
+        class CaptureRule(CompoundRule):
+            spec = "<command>"
+            extras = [Alternative([Compound("up"), Compound("down"),
+                                   Compound("say <text>", extras=[Dictation("text")]),
+                                   ListRef(None, static_words), ListRef(None, dynamic_words)],
+                                  name="command")]
+
+            def process_recognition(self, node):
+                nodes.append(node)
+
+        grammar = Grammar("Global")
+        grammar.add_rule(CaptureRule())
+        grammar.load()
+        try:
+            for words in ["up", "up", "down", "say hello", "left", "right"]:
+                get_engine().mimic(words)
+        finally:
+            grammar.unload()
+        up_key, up_key2, down_key, say_key, static_key, dynamic_key = [
+            cache.key(grammar, node) for node in nodes]
+        self.assertEqual(up_key, up_key2)
+        self.assertNotEqual(up_key, down_key)
+        self.assertIsNone(say_key)
+        self.assertIsNotNone(static_key)
+        self.assertIsNone(dynamic_key)
+        # Values which read the recognition node are not cached.
+        cache.put(static_key, {"sequence": [Key("a") + Function(lambda _node: None)]})
+        cache.put(static_key, {"sequence": [Key("a") + Function(lambda **kwargs: None)]})
+        self.assertEqual(0, len(cache))
+        cache.put(up_key, "up")
+        cache.put(down_key, "down")
+        self.assertEqual("up", cache.get(up_key))
+        # Evicts the least recently used.
+        cache.put(("Global", ()), "other")
+        self.assertIsNone(cache.get(down_key))
+        self.assertEqual("1 hits, 1 misses (50% hit rate), 4 bypassed, 2 cached", cache.report())
+
+    def test_action_interner(self):
+        interner = ActionInterner()
+        close = interner.intern(Key("c-w"))
+        self.assertIs(close, interner.intern(Key("c-w")))
+        self.assertIsNot(close, interner.intern(Text("c-w")))
+        self.assertIsNot(close, interner.intern(Key("c-w", use_hardware=True)))
+        self.assertIs(interner.intern(Key("a") + Text("b")), interner.intern(Key("a") + Text("b")))
+        self.assertIs(interner.intern(Function(len)), interner.intern(Function(len)))
+        self.assertIsNot(interner.intern(Function(lambda: None)), interner.intern(Function(lambda: None)))
+        self.assertEqual("3 of 10 actions deduplicated", interner.report())
+        interner.clear()
+        self.assertIsNot(close, interner.intern(Key("c-w")))
+
+    def test_combine_maps_interns_actions(self):
+        interner = ActionInterner()
+        first = text_map_to_action_map({"arrow": "->"}, action_interner=interner)
+        second = text_map_to_action_map({"arrow": "->"}, action_interner=interner)
+        self.assertIs(first["arrow"], second["arrow"])
+        close = Key("c-w")
+        combined = combine_maps({"close": close}, {"close": close}, first, action_interner=interner)
+        self.assertIs(first["arrow"], combined["arrow"])
+        self.assertIs(combined["close"],
+                      combine_maps_checked({"close": Key("c-w")}, action_interner=interner)["close"])
+        self.assertIsNot(first["arrow"], text_map_to_action_map({"arrow": "->"})["arrow"])
+        # Equal actions are still duplicates unless they are the same object.
+        with self.assertRaises(ValueError):
+            combine_maps({"close": Key("c-w")}, {"close": Key("c-w")}, action_interner=interner)
+
+    def test_text_output(self):
+        original_keyboard = BaseKeyboardAction._keyboard
+        keyboard = BaseKeyboardAction._keyboard = RecordingKeyboard(original_keyboard)
+        pasted = []
+        output = TextOutput(10, {"Shell": None}, restore_delay=0, clipboard_class=FakeClipboard,
+                            paste_action=Function(lambda: pasted.append(FakeClipboard.system_text)))
+        try:
+            output.output(u"short")
+            output.output(u"long enough")
+            output.environment = "Shell"
+            output.output(u"long enough")
+            output.environment = None
+            output_text_action(u"%(text)s", output).execute({"text": u"dictated text"})
+        finally:
+            BaseKeyboardAction._keyboard = original_keyboard
+        self.assertEqual([u"long enough", u"dictated text"], pasted)
+        self.assertEqual(u"saved", FakeClipboard.system_text)
+        self.assertEqual(2, len(keyboard.events))
+        self.assertEqual("2 texts typed, 2 pasted", output.report())
+
+    def test_action_executor(self):
+        results = []
+        threads = []
+        # Would release held modifiers.
+        callbacks = CallbackQueue()
+        executor = ActionExecutor(callbacks, stuck_timeout=0.2,
+                                  on_cancel=lambda: results.append("released"))
+
+        def stuck():
+            while True:
+                time.sleep(0.01)
+
+        try:
+            executor.submit(lambda: results.append(1))
+            executor.submit(lambda: EngineThreadAction(
+                Function(lambda: threads.append(threading.current_thread())), executor).execute())
+            executor.submit(lambda: results.append(2))
+            self.assertTrue(executor.wait(5))
+            executor.submit(stuck)
+            time.sleep(0.3)
+            self.assertEqual(1, executor.depth())
+            # Cancels the stuck job.
+            executor.submit(lambda: results.append(3))
+            self.assertTrue(executor.wait(5))
+            executor.submit(stuck)
+            executor.submit(lambda: results.append(4))
+            executor.cancel()
+            self.assertTrue(executor.wait(5))
+        finally:
+            executor.stop()
+            callbacks.stop()
+        self.assertEqual([1, 2, "released", 3], results[:4])
+        self.assertEqual(["released"] * (len(results) - 4), results[4:])
+        self.assertIsNot(executor._thread, threads[0])
+        self.assertEqual(3, executor.cancelled_count)
+        self.assertEqual(0, executor.depth())
+
+
+class RecordingKeyboard(object):
+
+    def __init__(self, keyboard):
+        self._keyboard = keyboard
+        self.events = []
+
+    def get_typeable(self, char, is_text=False):
+        return self._keyboard.get_typeable(char, is_text=is_text)
+
+    def send_keyboard_events(self, events):
+        self.events.append(list(events))
+
+
+class FakeClipboard(object):
+    system_text = u"saved"
+
+    def __init__(self, from_system=False):
+        self.text = FakeClipboard.system_text if from_system else None
+
+    @staticmethod
+    def set_system_text(content):
+        FakeClipboard.system_text = content
+
+    def copy_to_system(self):
+        FakeClipboard.system_text = self.text
+
+
+class CountingContext(Context):
+    """Matches windows whose executable or title contains a name."""
+
+    def __init__(self, name):
+        Context.__init__(self)
+        self.name = name
+        self.count = 0
+
+    def matches(self, executable, title, handle):
+        self.count += 1
+        return self.name in executable or self.name in title
+
+
+class Node(object):
+
+    def __init__(self, name, unmerged_context, children=()):
+        self.name = name
+        self.unmerged_context = unmerged_context
+        self.children = list(children)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# (c) Copyright 2015 by James Stout
+# Licensed under the LGPL, see <http://www.gnu.org/licenses/>
+
+from _emacs_utils import *
+import _emacs_utils
+import json
+import socket
+import threading
+import unittest
+
+from six.moves import socketserver
+
+from dragonfly import Function
+
+
+class FakeEmacsHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        self.server.connection_count += 1
+        for line in self.rfile:
+            request = json.loads(line.decode("utf-8"))
+            self.server.requests.append((request["method"], request["params"]))
+            if request["method"] in ("command", "mark-lines", "use-lines"):
+                response = {"id": request["id"], "result": None}
+            else:
+                response = {"id": request["id"], "error": "Unknown method: " + request["method"]}
+            self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+            if self.server.close_after_response:
+                return
+
+
+class FakeEmacsServer(socketserver.ThreadingTCPServer):
+    """Stand-in for Emacs which records requests and responds to each."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, close_after_response=False):
+        socketserver.ThreadingTCPServer.__init__(self, ("127.0.0.1", 0), FakeEmacsHandler)
+        self.close_after_response = close_after_response
+        self.connection_count = 0
+        self.requests = []
+        self.port = self.server_address[1]
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def unused_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class EmacsUtilsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.original_channel = _emacs_utils.channel
+        self.original_is_local = _emacs_utils.is_local_emacs_foreground
+        _emacs_utils.is_local_emacs_foreground = lambda: True
+
+    def tearDown(self):
+        if _emacs_utils.channel:
+            _emacs_utils.channel.close()
+        _emacs_utils.channel = self.original_channel
+        _emacs_utils.is_local_emacs_foreground = self.original_is_local
+
+    def test_call(self):
+        server = FakeEmacsServer()
+        channel = EmacsChannel(port=server.port)
+        try:
+            self.assertIsNone(channel.call("command", name="revert-buffer"))
+            self.assertIsNone(channel.call("use-lines", start=3, end=5, operation="copy"))
+            with self.assertRaises(EmacsError):
+                channel.call("unknown")
+        finally:
+            channel.close()
+            server.stop()
+        self.assertEqual([("command", {"name": "revert-buffer"}),
+                          ("use-lines", {"start": 3, "end": 5, "operation": "copy"}),
+                          ("unknown", {})],
+                         server.requests)
+        self.assertEqual(1, server.connection_count)
+        self.assertEqual("3 requests, 0 keystroke fallbacks", channel.report())
+
+    def test_reconnect(self):
+        server = FakeEmacsServer(close_after_response=True)
+        channel = EmacsChannel(port=server.port)
+        try:
+            channel.call("command", name="recompile")
+            channel.call("command", name="recompile")
+        finally:
+            channel.close()
+            server.stop()
+        self.assertEqual(2, len(server.requests))
+        self.assertEqual(2, server.connection_count)
+
+    def test_command_action(self):
+        fallbacks = []
+        fallback = Function(lambda: fallbacks.append(True))
+        server = FakeEmacsServer()
+        _emacs_utils.channel = EmacsChannel(port=server.port)
+        try:
+            EmacsCommand("rgrep", fallback).execute()
+        finally:
+            server.stop()
+        self.assertEqual([("command", {"name": "rgrep"})], server.requests)
+        self.assertEqual([], fallbacks)
+        _emacs_utils.channel.close()
+
+        _emacs_utils.channel = EmacsChannel(port=unused_port(), retry_interval=60)
+        EmacsCommand("rgrep", fallback).execute()
+        EmacsCommand("rgrep", fallback).execute()
+        self.assertEqual([True, True], fallbacks)
+        self.assertEqual("0 requests, 2 keystroke fallbacks", _emacs_utils.channel.report())
+
+        _emacs_utils.channel = None
+        EmacsCommand("rgrep", fallback).execute()
+        self.assertEqual(3, len(fallbacks))
+
+    def test_remote_emacs_uses_keystrokes(self):
+        fallbacks = []
+        fallback = Function(lambda: fallbacks.append(True))
+        server = FakeEmacsServer()
+        _emacs_utils.channel = EmacsChannel(port=server.port)
+        _emacs_utils.is_local_emacs_foreground = lambda: False
+        try:
+            EmacsCommand("rgrep", fallback).execute()
+        finally:
+            server.stop()
+        self.assertEqual([], server.requests)
+        self.assertEqual([True], fallbacks)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# (c) Copyright 2015 by James Stout
+# Licensed under the LGPL, see <http://www.gnu.org/licenses/>
+
+"""Benchmarks how garbage collection settings affect dispatch latency.
+
+Usage: gc_benchmark.py [--environments N] [--specs N] [--repeat N] [--thresholds A,B,C]
+
+Builds a long-lived graph of rules, elements and actions shaped like the
+environments in _repeat.py, then mimics utterances whose actions allocate
+objects like RepeatRule does. Reports dispatch latency and garbage collection
+pauses with the default collector, with the heap frozen after loading, and with
+the heap frozen and the given thresholds.
+"""
+
+import argparse
+import gc
+import time
+
+from dragonfly import (
+    Dictation,
+    Function,
+    Grammar,
+    IntegerRef,
+    Key,
+    MappingRule,
+    Pause,
+    Repeat,
+    Text,
+    get_engine,
+)
+
+import _latency_utils as latency
+
+
+def create_environments(environment_count, spec_count):
+    """Returns rules like those of _repeat.py environments, kept until exit."""
+    rules = []
+    for i in range(environment_count):
+        mapping = {}
+        for j in range(spec_count):
+            mapping["command %d item %d [<n>]" % (i, j)] = (
+                Key("c-c, %s" % "abcdefghij"[j % 10]) + Text("item %d" % j) + Pause("5"))
+        rules.append(MappingRule("environment%d" % i, mapping,
+                                 extras=[IntegerRef("n", 1, 21), Dictation("text")],
+                                 defaults={"n": 1}))
+    return rules
+
+
+def build_actions(text, n):
+    # Like RepeatRule, which builds a new action series for each utterance.
+    actions = [(Key("left:%d" % n) + Text(text) + Pause("5")) * Repeat(n) for _ in range(20)]
+    return dict(("action%d" % i, action) for i, action in enumerate(actions))
+
+
+def time_dispatch(engine, repeat):
+    histogram = latency.RollingHistogram(repeat)
+    for i in range(repeat):
+        start_time = time.perf_counter()
+        engine.mimic(["build", "actions", "number", "item %d" % (i % 10)])
+        histogram.add((time.perf_counter() - start_time) * 1000)
+    return histogram
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--environments", type=int, default=30)
+    parser.add_argument("--specs", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=2000)
+    parser.add_argument("--thresholds", default="50000,20,100")
+    args = parser.parse_args()
+    engine = get_engine("text")
+    default_thresholds = gc.get_threshold()
+    tuned_thresholds = tuple(int(threshold) for threshold in args.thresholds.split(","))
+    environments = create_environments(args.environments, args.specs)
+    grammar = Grammar("gc_benchmark")
+    grammar.add_rule(MappingRule("dispatch", {
+        "build actions number <text>": Function(lambda text: build_actions(text, 3)),
+    }, extras=[Dictation("text")]))
+    grammar.load()
+    print("Built %d rules with %d objects tracked by the collector" % (
+        len(environments), len(gc.get_objects())))
+    monitor = latency.GcMonitor(window=args.repeat * 10)
+    monitor.install()
+    configurations = [
+        ("default", False, default_thresholds),
+        ("frozen", True, default_thresholds),
+        ("frozen+thresholds", True, tuned_thresholds),
+    ]
+    print("%-18s %9s %9s %9s %9s %10s %10s" % (
+        "configuration", "p50 ms", "p99 ms", "max ms", "gc count", "gc max ms", "gc total ms"))
+    try:
+        for name, freeze, thresholds in configurations:
+            if hasattr(gc, "unfreeze"):
+                gc.unfreeze()
+            gc.set_threshold(*default_thresholds)
+            if freeze:
+                latency.freeze_heap(thresholds)
+            else:
+                gc.collect()
+                gc.set_threshold(*thresholds)
+            monitor.reset()
+            dispatch = time_dispatch(engine, args.repeat)
+            pauses = [monitor.histogram(generation) for generation in range(3)]
+            print("%-18s %9.2f %9.2f %9.2f %9d %10.2f %10.1f" % (
+                name, dispatch.percentile(50), dispatch.percentile(99), dispatch.percentile(100),
+                sum(len(histogram) for histogram in pauses),
+                max(histogram.percentile(100) or 0.0 for histogram in pauses),
+                sum(histogram.total() for histogram in pauses)))
+    finally:
+        monitor.uninstall()
+        grammar.unload()
+        if hasattr(gc, "unfreeze"):
+            gc.unfreeze()
+        gc.set_threshold(*default_thresholds)
+
+
+if __name__ == "__main__":
+    main()
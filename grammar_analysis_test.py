@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# (c) Copyright 2015 by James Stout
+# Licensed under the LGPL, see <http://www.gnu.org/licenses/>
+
+from _grammar_analysis import *
+import unittest
+
+from dragonfly import (
+    Alternative,
+    Compound,
+    Dictation,
+    Grammar,
+    List,
+    ListRef,
+    Literal,
+    Repetition,
+    RuleRef,
+    RuleWrap,
+    get_engine,
+)
+
+import _dragonfly_utils as utils
+
+
+class GrammarAnalysisTestCase(unittest.TestCase):
+
+    def setUp(self):
+        get_engine("text")
+
+    def create_grammar(self):
+        letters = List("letters", ["alpha", "bravo", "charlie delta"])
+        command = utils.create_rule("command", {
+            "up": None,
+            "down": None,
+            "say <text>": None,
+            "letter <letter>": None,
+        }, {
+            "text": Dictation(),
+            "letter": ListRef(None, letters),
+        })
+        element = Repetition(RuleWrap(None, Alternative([
+            Literal("go"),
+            Compound("[<n>] stop", extras=[Alternative([Literal("one"), Literal("two")], name="n")]),
+        ])), min=1, max=3)
+        repeat = utils.create_rule("repeat", {"<sequence> <command>": None},
+                                   {"sequence": element, "command": RuleRef(rule=command)},
+                                   exported=True)
+        grammar = Grammar("test")
+        grammar.add_rule(repeat)
+        return grammar
+
+    def test_analyze_grammar(self):
+        stats = analyze_grammars([self.create_grammar()])[0]
+        self.assertEqual("test", stats.name)
+        # repeat, command, and the RuleWrap.
+        self.assertEqual(3, stats.rules)
+        self.assertEqual(3, stats.list_entries)
+        self.assertEqual(1, stats.repetition_depth)
+        # Alternatives of go/stop, and of one/two.
+        self.assertEqual(2, stats.alternative_depth)
+        # One or two of 1 + 3 sequences, followed by one of 6 commands.
+        self.assertAlmostEqual(math.log10((4 + 4 ** 2) * 6), stats.log10_expansions)
+        # Each rule once, with the RuleWrap referenced twice by the Repetition.
+        self.assertEqual(16, stats.states)
+
+    def test_budget(self):
+        stats_list = analyze_grammars([self.create_grammar()])
+        self.assertEqual([], check_budget(stats_list, {"rules": 3, "repetition_depth": 1}))
+        self.assertEqual(1, len(check_budget(stats_list, {"rules": 2, "repetition_depth": 1})))
+        with self.assertRaises(GrammarBudgetError):
+            enforce_budget(stats_list, {"log10_expansions": 2})
+
+
+if __name__ == "__main__":
+    unittest.main()
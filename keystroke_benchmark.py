@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# (c) Copyright 2015 by James Stout
+# Licensed under the LGPL, see <http://www.gnu.org/licenses/>
+
+"""Benchmarks the per-execution overhead of Key and Text actions.
+
+Usage: keystroke_benchmark.py [--repeat N]
+
+Replaces the keyboard backend with one which computes keystrokes but sends
+nothing, then reports the mean time to execute typical actions with and without
+a KeystrokeCache installed.
+"""
+
+import argparse
+import time
+
+from dragonfly import Key, Pause, Text, get_engine
+from dragonfly.actions.action_base_keyboard import BaseKeyboardAction
+
+import _keystroke_cache as keystrokes
+
+
+class NullKeyboard(object):
+    """Keyboard backend which creates typeables but sends no events."""
+
+    def __init__(self, keyboard):
+        self._keyboard = keyboard
+
+    def get_typeable(self, char, is_text=False):
+        return self._keyboard.get_typeable(char, is_text=is_text)
+
+    def send_keyboard_events(self, events):
+        pass
+
+
+def create_actions():
+    """Returns (name, function) pairs which execute typical actions."""
+    save = Key("c-s")
+    keys = Key("plus, k")
+    letter = Text("a")
+    symbol = Text("->")
+    lefts = Key("left:%(n)d")
+    # Like combo_key_element, which builds a new action for each recognition.
+    modified = lambda: Key("c-%s" % "x").execute()
+    # Like UseLinesAction, which combines actions with +.
+    lines = Key("c-u") + Text("15") + Key("c-c, c, g") + Pause("5")
+    return [
+        ("static key", save.execute),
+        ("static key sequence", keys.execute),
+        ("text letter", letter.execute),
+        ("text symbol", symbol.execute),
+        ("dynamic key", lambda: lefts.execute({"n": 3})),
+        ("new key", modified),
+        ("action series", lines.execute),
+    ]
+
+
+def time_action(function, repeat):
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start_time) / repeat * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=10000)
+    args = parser.parse_args()
+    get_engine("text")
+    BaseKeyboardAction._keyboard = NullKeyboard(BaseKeyboardAction._keyboard)
+    # Don't pause in the action series.
+    Pause._execute_events = lambda self, events: True
+    print("%-20s %12s %12s" % ("action", "uncached us", "cached us"))
+    uncached_times = [time_action(function, args.repeat) for _, function in create_actions()]
+    cache = keystrokes.KeystrokeCache()
+    cache.install()
+    try:
+        # Actions must be created after installing to cache their parsed specs.
+        cached_times = [time_action(function, args.repeat) for _, function in create_actions()]
+    finally:
+        cache.uninstall()
+    for (name, _), uncached_time, cached_time in zip(create_actions(), uncached_times, cached_times):
+        print("%-20s %12.2f %12.2f" % (name, uncached_time, cached_time))
+    print(cache.report())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# (c) Copyright 2015 by James Stout
+# Licensed under the LGPL, see <http://www.gnu.org/licenses/>
+
+from _keystroke_cache import *
+import unittest
+
+from dragonfly import get_engine
+from dragonfly.actions.action_base_keyboard import BaseKeyboardAction
+
+
+class RecordingKeyboard(object):
+
+    def __init__(self, keyboard):
+        self._keyboard = keyboard
+        self.events = []
+
+    def get_typeable(self, char, is_text=False):
+        return self._keyboard.get_typeable(char, is_text=is_text)
+
+    def send_keyboard_events(self, events):
+        self.events.append(list(events))
+
+
+class KeystrokeCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        get_engine("text")
+        self.original_keyboard = BaseKeyboardAction._keyboard
+        self.keyboard = BaseKeyboardAction._keyboard = RecordingKeyboard(self.original_keyboard)
+
+    def tearDown(self):
+        BaseKeyboardAction._keyboard = self.original_keyboard
+
+    def execute_actions(self):
+        Key("c-s, a:2").execute()
+        Key("left:%(n)d").execute({"n": 3})
+        Key("left:%(n)d").execute({"n": 3})
+        Text("a\n").execute()
+        events = self.keyboard.events
+        self.keyboard.events = []
+        return events
+
+    def test_same_events(self):
+        expected = self.execute_actions()
+        cache = KeystrokeCache()
+        cache.install()
+        try:
+            self.assertEqual(expected, self.execute_actions())
+            self.assertEqual(expected, self.execute_actions())
+        finally:
+            cache.uninstall()
+        self.assertEqual("parse 2 hits, 3 misses; compile 5 hits, 3 misses", cache.report())
+        self.assertEqual(expected, self.execute_actions())
+
+
+if __name__ == "__main__":
+    unittest.main()
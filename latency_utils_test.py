@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# (c) Copyright 2015 by James Stout
+# Licensed under the LGPL, see <http://www.gnu.org/licenses/>
+
+from _audio_dataset import get_result_type
+from _latency_utils import *
+import gc
+import unittest
+
+
+class FakeResults(object):
+    """Stand-in for a Natlink results object."""
+
+    def __init__(self, results):
+        self.results = results
+
+    def getResults(self, choice):
+        return self.results
+
+    def getWords(self, choice):
+        return [word for word, _ in self.results]
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, milliseconds):
+        self.now += milliseconds / 1000.0
+
+
+class LatencyUtilsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.tracker = LatencyTracker(clock=self.clock)
+
+    def recognize(self, res_obj, dispatch_before_results=False):
+        self.tracker.begin()
+        self.clock.advance(100)
+        self.tracker.hypothesis()
+        self.clock.advance(200)
+        self.tracker.hypothesis()
+        self.clock.advance(50)
+        if dispatch_before_results:
+            self.tracker.dispatch_started()
+            self.clock.advance(20)
+            self.tracker.dispatch_finished()
+            self.tracker.results(get_result_type("", res_obj))
+        else:
+            self.tracker.results(get_result_type("", res_obj))
+            self.tracker.dispatch_started()
+            self.clock.advance(20)
+            self.tracker.dispatch_finished()
+
+    def test_result_type(self):
+        self.assertEqual("grammar", get_result_type("", FakeResults([("up", 3), ("down", 3)])))
+        self.assertEqual("dictation", get_result_type("", FakeResults([("hello", 1000000)])))
+        self.assertEqual("mixed", get_result_type("", FakeResults([("say", 3), ("hello", 1000000)])))
+        self.assertEqual("reject", get_result_type("reject", FakeResults([])))
+
+    def test_metrics(self):
+        self.recognize(FakeResults([("up", 3)]))
+        self.assertAlmostEqual(250, self.tracker.histogram("grammar", "decode").percentile(50))
+        self.assertAlmostEqual(50, self.tracker.histogram("grammar", "finalize").percentile(50))
+        self.assertAlmostEqual(20, self.tracker.histogram("grammar", "dispatch").percentile(50))
+        self.assertAlmostEqual(270, self.tracker.histogram("grammar", "total").percentile(50))
+        self.assertIsNone(self.tracker.histogram("dictation", "decode"))
+
+    def test_listener(self):
+        measurements = []
+        self.tracker.add_listener(lambda *args: measurements.append(args))
+        self.recognize(FakeResults([("up", 3)]))
+        self.assertEqual(["decode", "finalize", "dispatch", "total"],
+                         [metric for _, metric, _, _ in measurements])
+        _, _, start, end = measurements[-1]
+        self.assertAlmostEqual(0.27, end - start)
+
+    def test_dispatch_before_results(self):
+        self.recognize(FakeResults([("say", 3), ("hello", 1000000)]), dispatch_before_results=True)
+        self.assertAlmostEqual(20, self.tracker.histogram("mixed", "dispatch").percentile(50))
+        self.assertEqual(1, len(self.tracker.histogram("mixed", "total")))
+
+    def test_unhandled_results(self):
+        self.tracker.begin()
+        self.tracker.hypothesis()
+        self.tracker.results(get_result_type("", FakeResults([("hello", 1000000)])))
+        self.assertEqual(1, len(self.tracker.histogram("dictation", "decode")))
+        self.assertIsNone(self.tracker.histogram("dictation", "dispatch"))
+        self.assertIn("dictation decode", self.tracker.report())
+
+    def test_histogram(self):
+        histogram = RollingHistogram(size=3)
+        for milliseconds in (1, 3, 5, 100):
+            histogram.add(milliseconds)
+        self.assertEqual(3, len(histogram))
+        self.assertEqual([(4, 1), (8, 1), (128, 1)], histogram.buckets())
+        self.assertEqual(100, histogram.percentile(99))
+
+    def test_gc_monitor(self):
+        monitor = GcMonitor(clock=self.clock)
+        monitor._callback("start", {"generation": 2, "collected": 0, "uncollectable": 0})
+        self.clock.advance(30)
+        monitor._callback("stop", {"generation": 2, "collected": 5, "uncollectable": 0})
+        self.assertAlmostEqual(30, monitor.histogram(2).percentile(50))
+        self.assertEqual(0, len(monitor.histogram(0)))
+        self.assertIn("gc generation 2: n=1", monitor.report())
+        self.assertIn("5 objects collected", monitor.report())
+        monitor.install()
+        try:
+            gc.collect()
+        finally:
+            monitor.uninstall()
+        self.assertEqual(2, len(monitor.histogram(2)))
+        self.assertNotIn(monitor._callback, gc.callbacks)
+
+    def test_thresholds(self):
+        thresholds = gc.get_threshold()
+        try:
+            set_thresholds((50000, 20, 100))
+            set_thresholds((60000, 20, 100))
+            self.assertEqual((60000, 20, 100), gc.get_threshold())
+            restore_thresholds()
+            self.assertEqual(thresholds, gc.get_threshold())
+        finally:
+            gc.set_threshold(*thresholds)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# (c) Copyright 2015 by James Stout
+# Licensed under the LGPL, see <http://www.gnu.org/licenses/>
+
+"""Benchmarks typing text as keystrokes against pasting it through the clipboard.
+
+Usage: paste_benchmark.py [--repeat N] [--event-latency MS] [--clipboard-latency MS]
+
+Replaces the keyboard and clipboard with stand-ins which send nothing, but which
+account for the time a real input sink would take: each keyboard event costs
+--event-latency plus the pause dragonfly requests after it, and each clipboard
+read or write costs --clipboard-latency. Reports the characters per second of
+each strategy at several text lengths, including the restore delay.
+"""
+
+import argparse
+import time
+
+from dragonfly import Key, get_engine
+from dragonfly.actions.action_base_keyboard import BaseKeyboardAction
+
+import _dragonfly_utils as utils
+
+
+class SimulatedKeyboard(object):
+    """Keyboard backend which sends no events, but tallies their cost."""
+
+    def __init__(self, keyboard, event_latency):
+        self._keyboard = keyboard
+        self.event_latency = event_latency
+        self.event_count = 0
+        self.simulated_time = 0.0
+
+    def get_typeable(self, char, is_text=False):
+        return self._keyboard.get_typeable(char, is_text=is_text)
+
+    def send_keyboard_events(self, events):
+        for event in events:
+            self.event_count += 1
+            self.simulated_time += self.event_latency + event[-1]
+
+
+class SimulatedClipboard(object):
+    """Clipboard which holds text in memory and tallies the cost of access."""
+    latency = 0.0
+    simulated_time = 0.0
+    system_text = u""
+
+    def __init__(self, from_system=False):
+        self.text = None
+        if from_system:
+            SimulatedClipboard.simulated_time += SimulatedClipboard.latency
+            self.text = SimulatedClipboard.system_text
+
+    @staticmethod
+    def set_system_text(content):
+        SimulatedClipboard.simulated_time += SimulatedClipboard.latency
+        SimulatedClipboard.system_text = content
+
+    def copy_to_system(self):
+        SimulatedClipboard.set_system_text(self.text)
+
+
+def time_output(output, keyboard, text, repeat):
+    """Returns the simulated seconds to output the text and the events sent."""
+    keyboard.event_count = 0
+    keyboard.simulated_time = 0.0
+    SimulatedClipboard.simulated_time = 0.0
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        output.output(text)
+    elapsed = time.perf_counter() - start_time
+    total = elapsed + keyboard.simulated_time + SimulatedClipboard.simulated_time
+    return total / repeat, keyboard.event_count // repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--event-latency", type=float, default=0.5,
+                        help="Milliseconds for the system to process a keyboard event.")
+    parser.add_argument("--clipboard-latency", type=float, default=5.0,
+                        help="Milliseconds for each clipboard read or write.")
+    parser.add_argument("--restore-delay", type=float, default=0.1)
+    args = parser.parse_args()
+    get_engine("text")
+    keyboard = SimulatedKeyboard(BaseKeyboardAction._keyboard, args.event_latency / 1000)
+    BaseKeyboardAction._keyboard = keyboard
+    SimulatedClipboard.latency = args.clipboard_latency / 1000
+    # Don't sleep; the restore delay is added to the simulated time instead.
+    typed = utils.TextOutput(None, clipboard_class=SimulatedClipboard)
+    pasted = utils.TextOutput(0, restore_delay=0, clipboard_class=SimulatedClipboard,
+                              paste_action=Key("c-v"))
+    print("%-8s %14s %14s %10s %10s" % ("length", "typed chars/s", "pasted chars/s",
+                                       "typed ev", "pasted ev"))
+    sentence = u"The quick brown fox jumps over the lazy dog. "
+    crossover = None
+    for length in (10, 20, 40, 80, 160, 320, 640, 1280):
+        text = (sentence * (length // len(sentence) + 1))[:length]
+        typed_time, typed_events = time_output(typed, keyboard, text, args.repeat)
+        pasted_time, pasted_events = time_output(pasted, keyboard, text, args.repeat)
+        pasted_time += args.restore_delay
+        if crossover is None and pasted_time < typed_time:
+            crossover = length
+        print("%-8d %14.0f %14.0f %10d %10d" % (length, length / typed_time, length / pasted_time,
+                                               typed_events, pasted_events))
+    print("Pasting is faster from %s characters" % (crossover or "more than 1280"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# (c) Copyright 2015 by James Stout
+# Licensed under the LGPL, see <http://www.gnu.org/licenses/>
+
+from _profiling_utils import *
+from collections import namedtuple
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from _latency_utils import LatencyTracker
+
+
+FuncStat = namedtuple("FuncStat", "full_name name module lineno tsub ttot children")
+ChildStat = namedtuple("ChildStat", "full_name ttot")
+
+
+def busy_wait(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+class ProfilingUtilsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_folded_stacks(self):
+        profiler = SamplingProfiler(interval=0.001, max_overhead=0.5)
+        thread = threading.Thread(target=busy_wait, args=(0.1,), name="busy")
+        start = time.perf_counter()
+        thread.start()
+        profiler.start()
+        thread.join()
+        profiler.stop()
+        stacks = profiler.folded_stacks(start, time.perf_counter())
+        busy_stacks = [stack for stack in stacks if stack.startswith("busy;")]
+        self.assertTrue(busy_stacks)
+        self.assertTrue(all("busy_wait (profiling_utils_test.py:" in stack for stack in busy_stacks))
+        self.assertFalse([stack for stack in stacks if "SamplingProfiler" in stack])
+        self.assertEqual(0, len(profiler.folded_stacks(0, start - 1)))
+        self.assertIn("overhead", profiler.report())
+
+    def test_repeated_stacks_are_shared(self):
+        profiler = SamplingProfiler()
+        event = threading.Event()
+        thread = threading.Thread(target=event.wait, name="waiting")
+        thread.start()
+        try:
+            time.sleep(0.01)
+            profiler.sample()
+            profiler.sample()
+        finally:
+            event.set()
+            thread.join()
+        first, second = [[frames for name, frames in stacks if name == "waiting"]
+                         for _, stacks in profiler._samples]
+        self.assertEqual(1, len(first))
+        self.assertIs(first[0], second[0])
+        profiler.max_cached_stacks = 0
+        profiler.sample()
+        self.assertEqual(1, len(profiler._stacks))
+
+    def test_capture_waits_for_end(self):
+        now = [10.0]
+        profiler = SamplingProfiler(clock=lambda: now[0])
+        path = os.path.join(self.directory, "capture.folded")
+        profiler.sample()
+        profiler.capture(path, 5.0, 11.0)
+        profiler._write_captures()
+        self.assertFalse(os.path.exists(path))
+        now[0] = 12.0
+        profiler.sample()
+        profiler._write_captures()
+        self.assertTrue(os.path.exists(path))
+
+    def test_overhead_cap(self):
+        profiler = SamplingProfiler(interval=0.001, max_overhead=0.01)
+        profiler.start()
+        time.sleep(0.05)
+        profiler.stop()
+        self.assertGreaterEqual(profiler.current_interval, profiler.interval)
+        self.assertLess(profiler.overhead(), 0.1)
+
+    def test_slow_utterance(self):
+        profiler = SamplingProfiler(interval=0.001, max_overhead=0.5)
+        tracker = LatencyTracker()
+        recorder = SlowUtteranceRecorder(profiler, self.directory, threshold=50)
+        tracker.add_listener(recorder)
+        profiler.start()
+        for seconds in (0.01, 0.1):
+            tracker.begin()
+            tracker.hypothesis()
+            tracker.results("grammar")
+            tracker.dispatch_started()
+            busy_wait(seconds)
+            tracker.dispatch_finished()
+        profiler.stop()
+        paths = os.listdir(self.directory)
+        self.assertEqual(1, len(paths))
+        self.assertIn("_grammar_", paths[0])
+        with open(os.path.join(self.directory, paths[0])) as folded_file:
+            lines = folded_file.read().splitlines()
+        self.assertTrue([line for line in lines if "busy_wait" in line])
+        self.assertTrue(all(line.rsplit(" ", 1)[1].isdigit() for line in lines))
+
+    def test_collapse_func_stats(self):
+        func_stats = [
+            FuncStat("m.py:1 main", "main", "/src/m.py", 1, 0.001, 0.010,
+                     [ChildStat("m.py:5 a", 0.006), ChildStat("m.py:9 b", 0.003)]),
+            FuncStat("m.py:5 a", "a", "/src/m.py", 5, 0.002, 0.006, [ChildStat("m.py:13 c", 0.004)]),
+            FuncStat("m.py:9 b", "b", "/src/m.py", 9, 0.001, 0.003, [ChildStat("m.py:13 c", 0.002)]),
+            FuncStat("m.py:13 c", "c", "/src/m.py", 13, 0.006, 0.006, []),
+        ]
+        folded = collapse_func_stats(func_stats)
+        self.assertEqual({
+            "main (m.py:1)": 1000,
+            "main (m.py:1);a (m.py:5)": 2000,
+            "main (m.py:1);a (m.py:5);c (m.py:13)": 4000,
+            "main (m.py:1);b (m.py:9)": 1000,
+            "main (m.py:1);b (m.py:9);c (m.py:13)": 2000,
+        }, dict(folded))
+        path = os.path.join(self.directory, "profile.speedscope.json")
+        write_speedscope(path, folded, "test", unit="microseconds")
+        with open(path) as speedscope_file:
+            profile = json.load(speedscope_file)
+        frames = [frame["name"] for frame in profile["shared"]["frames"]]
+        self.assertEqual(["main (m.py:1)", "a (m.py:5)", "c (m.py:13)", "b (m.py:9)"], frames)
+        self.assertEqual(10000, profile["profiles"][0]["endValue"])
+        self.assertEqual([0, 1, 2], profile["profiles"][0]["samples"][2])
+
+
+if __name__ == "__main__":
+    unittest.main()
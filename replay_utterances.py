@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# (c) Copyright 2015 by James Stout
+# Licensed under the LGPL, see <http://www.gnu.org/licenses/>
+
+"""Replays an utterance log against the current grammars as a benchmark.
+
+Usage: replay_utterances.py LOG [--source repeat|natlink] [--limit N] [--module NAME] [--caches]
+
+The grammar module (default _repeat) is loaded into dragonfly's text engine
+without its services, and actions are disabled so replay does not type or click
+anything. Actions run synchronously, so that dispatch time includes them. The
+action and keystroke caches are disabled unless --caches is given, so that
+timings don't depend on local settings. Each utterance is mimicked: "repeat" utterances only in the grammar of
+the environment which recognized them, "natlink" utterances with their
+executable as the foreground window. Reports decode time (mimic start to
+recognition) and dispatch time (processing the recognition, which still builds
+every action) per utterance.
+"""
+
+import argparse
+import importlib
+import time
+
+from dragonfly import (
+    ActionBase,
+    DynStrActionBase,
+    MimicFailure,
+    RecognitionObserver,
+    get_engine,
+)
+import dragonfly.actions.action_base
+
+import _utterance_log as utterances
+
+
+def _noop(self, *args, **kwargs):
+    return True
+
+
+def disable_actions():
+    """Stops all loaded action classes from having effects. Composite actions
+    still execute their children."""
+    stack = [ActionBase]
+    while stack:
+        cls = stack.pop()
+        stack.extend(cls.__subclasses__())
+        if cls.__module__ == dragonfly.actions.action_base.__name__:
+            continue
+        if "_execute_events" in vars(cls) or issubclass(cls, DynStrActionBase):
+            cls._execute_events = _noop
+        elif "_execute" in vars(cls):
+            cls._execute = _noop
+
+
+class ReplayObserver(RecognitionObserver):
+    """Times the phases of each mimicked recognition."""
+
+    def __init__(self):
+        RecognitionObserver.__init__(self)
+        self.decode_times = []
+        self.dispatch_times = []
+        self._start_time = None
+        self._recognition_time = None
+
+    def start(self):
+        self._start_time = time.perf_counter()
+
+    def on_recognition(self, words):
+        self._recognition_time = time.perf_counter()
+        self.decode_times.append(self._recognition_time - self._start_time)
+
+    def on_post_recognition(self, words):
+        self.dispatch_times.append(time.perf_counter() - self._recognition_time)
+
+
+def normalize_word(word):
+    # Dragon words may include their spoken form, e.g. "." as ".\\period".
+    return word.split("\\")[0] or word
+
+
+def replay(utterances_iterable, grammars):
+    """Mimics each utterance and returns the observer and number of failures."""
+    engine = get_engine()
+    grammars_by_name = dict((grammar.name, grammar) for grammar in grammars)
+    contexts = dict((grammar, grammar.context) for grammar in grammars)
+    observer = ReplayObserver()
+    observer.register()
+    failures = 0
+    try:
+        for utterance in utterances_iterable:
+            window = {"executable": "", "title": "", "handle": 0}
+            if utterance.source == "repeat":
+                # Pin the utterance to its environment, regardless of window.
+                for grammar in grammars:
+                    grammar.set_context(None)
+                    if grammar is grammars_by_name.get(utterance.environment):
+                        grammar.enable()
+                    else:
+                        grammar.disable()
+            else:
+                window["executable"] = utterance.environment
+                for grammar in grammars:
+                    grammar.set_context(contexts[grammar])
+                    grammar.enable()
+            observer.start()
+            try:
+                engine.mimic([normalize_word(word) for word in utterance.words], **window)
+            except MimicFailure:
+                failures += 1
+    finally:
+        observer.unregister()
+        for grammar in grammars:
+            grammar.set_context(contexts[grammar])
+            grammar.enable()
+    return observer, failures
+
+
+def format_times(name, times):
+    if not times:
+        return "%s: no samples" % name
+    times = sorted(times)
+    total = sum(times)
+    return "%s: %.0f/s, mean %.2f ms, median %.2f ms, 90th percentile %.2f ms" % (
+        name, len(times) / total if total else float("inf"), 1000 * total / len(times),
+        1000 * times[len(times) // 2], 1000 * times[int(len(times) * 0.9)])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("log")
+    parser.add_argument("--source", default="repeat", choices=utterances.SOURCES)
+    parser.add_argument("--limit", type=int)
+    parser.add_argument("--module", default="_repeat",
+                        help="Module whose grammars list is replayed against.")
+    parser.add_argument("--caches", action="store_true",
+                        help="Keep the local action and keystroke cache settings.")
+    args = parser.parse_args()
+    get_engine("text")
+    import _dragonfly_local as local
+    local.START_SERVICES = False
+    local.STAGED_LOADING = False
+    local.LAZY_GRAMMARS = False
+    local.USAGE_STATS = False
+    local.UTTERANCE_LOG_PATH = None
+    local.ASYNC_ACTIONS = False
+    if not args.caches:
+        local.ACTION_CACHE_SIZE = 0
+        local.KEYSTROKE_CACHE = False
+    module = importlib.import_module(args.module)
+    disable_actions()
+    utterance_list = list(utterances.read_utterances(args.log, args.source))[:args.limit]
+    start_time = time.perf_counter()
+    observer, failures = replay(utterance_list, module.grammars)
+    elapsed = time.perf_counter() - start_time
+    print("Replayed %d utterances in %.2f seconds, %d failed" % (len(utterance_list), elapsed, failures))
+    print("Action cache size %d, keystroke cache %s" % (
+        getattr(local, "ACTION_CACHE_SIZE", 1000),
+        "on" if getattr(local, "KEYSTROKE_CACHE", False) else "off"))
+    print(format_times("decode", observer.decode_times))
+    print(format_times("dispatch", observer.dispatch_times))
+
+
+if __name__ == "__main__":
+    main()
@@ -3,7 +3,9 @@
 # Licensed under the LGPL, see <http://www.gnu.org/licenses/>
 
 from _text_utils import *
+import _text_utils
 import unittest
+from unittest import mock
 
 
 class TextUtilsTestCase(unittest.TestCase):
@@ -30,6 +32,81 @@ class TextUtilsTestCase(unittest.TestCase):
         self.assertEqual(set(["test word"]), extract_phrases("test_word // another_word", "cc"))
         self.assertEqual(set(["test word"]), extract_phrases("test-word ; another_word", "el"))
 
+    def test_remove_plaintext(self):
+        corpus = [
+            ("py", 'a = "b # c" # d\nx = \'e\\\'f\' + """g\n"h"\n"""\n',
+             'a =            \nx =        +     \n   \n   \n'),
+            ("py", "x = '''\\'''' + '' q", "x =          +    q"),
+            ("el", '(a "b ; \\"c" ?\\" d) ; e\n"f\ng"',
+             '(a           ?\\" d)    \n  \n  '),
+            ("cc", 'a = "b // c"; /* d\n * "e */ f // g\n\'"\'',
+             'a =         ;     \n         f     \n   '),
+            ("java", 'a("b\\"c") /* d */ e', 'a(      )         e'),
+            ("js", "a = `b\n${c}` + 'd' // e", "a =   \n      +         "),
+            ("go", "a := `b\\` + 'c' /* d */", "a :=      +            "),
+            ("rs", "fn a<'b>(c: &'b str) { \"d\\\"\ne\" }", "fn a<'b>(c: &'b str) {     \n   }"),
+            ("sh", "echo $# \"a\" 'b\\' c # d", "echo $#          c    "),
+            (None, 'a "b\\"c" d', "a        d"),
+            (None, 'a "b\nc"', "a   \nc "),
+        ]
+        for file_type, text, expected in corpus:
+            self.assertEqual(expected, remove_plaintext(text, file_type), (file_type, text))
+
+    def test_lexer_state(self):
+        lexer = get_lexer("cc")
+        stripped, state = lexer.strip("a /* b\n")
+        self.assertEqual("a     \n", stripped)
+        self.assertEqual(("     d", None), lexer.strip("c */ d", state))
+        text = "first_word /* comment_word\n comment_word */ second_word\n"
+        chunks = [text[i:i + 3] for i in range(0, len(text), 3)]
+        self.assertEqual(["first word", "second word"], count_phrases(chunks, "cc").top())
+
+    def test_rank_phrases(self):
+        self.assertEqual(["test word", "another word"],
+                         rank_phrases("another_word test_word testWord"))
+        self.assertEqual(["test word"], rank_phrases("another_word test_word testWord", limit=1))
+        self.assertEqual(["test word"], rank_phrases("test_word // another_word", "cc"))
+        text = "near_word " + " " * 10000 + "far_word"
+        self.assertEqual(["far word", "near word"], rank_phrases(text))
+        self.assertEqual(["near word", "far word"], rank_phrases(text, cursor=0))
+
+    def test_count_phrases_streaming(self):
+        text = "test_word // another_word\nsecond_word test_word\n"
+        chunks = [text[i:i + 5] for i in range(0, len(text), 5)]
+        counter = count_phrases(chunks, "cc")
+        self.assertEqual(["test word", "second word"], counter.top())
+        self.assertEqual(2, counter.count("test word"))
+        near = count_phrases(chunks, "cc", cursor=len(text))
+        self.assertEqual(["test word", "second word"], near.top())
+        self.assertGreater(near.count("second word"), 1.5)
+
+    def test_count_phrases_long_line(self):
+        text = "first_word second_word third_word"
+        chunks = [text[i:i + 3] for i in range(0, len(text), 3)]
+        with mock.patch.object(_text_utils, "MAX_LINE_LENGTH", 12):
+            counter = count_phrases(chunks)
+        self.assertEqual(["first word", "second word", "third word"], sorted(counter.top()))
+
+    def test_count_phrases_time_budget(self):
+        times = iter(range(100))
+        chunks = ["first_word\n", "second_word\n", "third_word\n"]
+        counter = count_phrases(chunks, time_budget=2.5, clock=lambda: next(times))
+        self.assertTrue(counter.truncated)
+        self.assertEqual(["first word", "second word"], sorted(counter.top()))
+        self.assertFalse(count_phrases(chunks, time_budget=10).truncated)
+
+    def test_phrase_counter_bounded(self):
+        counter = PhraseCounter(capacity=3)
+        for i in range(1000):
+            counter.add("frequent")
+            counter.add("rare %d" % i)
+            if i % 2:
+                counter.add("common")
+        self.assertLessEqual(len(counter), 6)
+        self.assertEqual(["frequent", "common"], counter.top(2))
+        self.assertGreaterEqual(counter.count("frequent"), 1000)
+        self.assertLessEqual(counter.count("frequent"), 1000 + counter.floor)
+
     def test_split_dictation(self):
         self.assertEqual(["test", "word"], split_dictation("test word"))
         self.assertEqual(["test", "word", "ab"], split_dictation("test word A B"))
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# (c) Copyright 2015 by James Stout
+# Licensed under the LGPL, see <http://www.gnu.org/licenses/>
+
+from _usage_stats import *
+import os.path
+import shutil
+import tempfile
+import time
+import unittest
+
+from dragonfly import (
+    CompoundRule,
+    Function,
+    Grammar,
+    IntegerRef,
+    MappingRule,
+    RuleRef,
+    get_engine,
+)
+
+
+class UsageStatsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        get_engine("text")
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "usage_stats.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_record(self):
+        stats = UsageStats(self.path)
+        command = MappingRule("command", {
+            "up [<n>]": Function(lambda: None),
+            "down": Function(lambda: None),
+        }, [IntegerRef("n", 1, 10)])
+
+        class SequenceRule(CompoundRule):
+            spec = "<first> [<second>]"
+            extras = [RuleRef(command, name="first"), RuleRef(command, name="second")]
+
+        grammar = Grammar("Emacs")
+        grammar.add_rule(SequenceRule())
+        grammar.add_rule(MappingRule("exported", {"save file": Function(lambda: None)}))
+        grammar.load()
+        observer = UsageObserver(stats)
+        observer.register()
+        try:
+            get_engine().mimic("up three up")
+            get_engine().mimic("save file")
+        finally:
+            observer.unregister()
+            grammar.unload()
+        self.assertEqual(2, stats.count("Emacs", "up [<n>]"))
+        self.assertEqual(0, stats.count("Emacs", "down"))
+        self.assertEqual(1, stats.count("Emacs", "save file"))
+        stats.save()
+        self.assertEqual(2, UsageStats(self.path).count("Emacs", "up [<n>]"))
+
+    def test_unused_specs(self):
+        stats = UsageStats(self.path)
+        stats.register_specs("Emacs", ["up", "down", "left"])
+        now = time.time()
+        self.assertEqual(set(), stats.unused_specs("Emacs", 30, now))
+        for entry in stats._stats["Emacs"].values():
+            entry["first_seen"] = now - 60 * SECONDS_PER_DAY
+        stats._stats["Emacs"]["up"]["last_used"] = now - 10 * SECONDS_PER_DAY
+        stats._stats["Emacs"]["down"]["last_used"] = now - 40 * SECONDS_PER_DAY
+        # Newly registered specs are not pruned.
+        stats.register_specs("Emacs", ["right"])
+        self.assertEqual({"down", "left"}, stats.unused_specs("Emacs", 30, now))
+
+
+if __name__ == "__main__":
+    unittest.main()
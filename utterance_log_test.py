@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# (c) Copyright 2015 by James Stout
+# Licensed under the LGPL, see <http://www.gnu.org/licenses/>
+
+from _utterance_log import *
+import os.path
+import shutil
+import tempfile
+import unittest
+
+from dragonfly import (
+    AppContext,
+    Function,
+    Grammar,
+    Key,
+    MappingRule,
+    get_engine,
+)
+
+import replay_utterances
+
+
+class UtteranceLogTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "utterances.log")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        log = UtteranceLog(self.path)
+        log.append([(u"say", 1), (u"café", 1000000)], "Emacs", "repeat", timestamp=1.5)
+        log.append([(u"up", 2)], "emacs.exe", "natlink", timestamp=2.5)
+        log.close()
+        self.assertEqual([Utterance(1.5, "repeat", "Emacs", [u"say", u"café"], [1, 1000000]),
+                          Utterance(2.5, "natlink", "emacs.exe", [u"up"], [2])],
+                         list(read_utterances(self.path)))
+        self.assertEqual([u"up"], [word for utterance in read_utterances(self.path, "natlink")
+                                   for word in utterance.words])
+
+    def test_truncated(self):
+        data = b"".join(encode_utterance(Utterance(float(i), "repeat", "Global", [u"up"], [1]))
+                        for i in range(3))
+        self.assertEqual(2, len(list(decode_utterances(data[:-1]))))
+        self.assertEqual(3, len(list(decode_utterances(data))))
+
+    def test_replay(self):
+        get_engine("text")
+        results = []
+        emacs = Grammar("Emacs", context=AppContext(executable="emacs"))
+        emacs.add_rule(MappingRule("emacs", {"save file": Function(lambda: results.append("emacs"))}))
+        chrome = Grammar("Chrome", context=AppContext(executable="chrome"))
+        chrome.add_rule(MappingRule("chrome", {"save file": Function(lambda: results.append("chrome"))}))
+        grammars = [emacs, chrome]
+        for grammar in grammars:
+            grammar.load()
+        try:
+            observer, failures = replay_utterances.replay([
+                Utterance(1.0, "repeat", "Chrome", [u"save", u"file"], [1, 1]),
+                Utterance(2.0, "natlink", "emacs", [u"save", u"file"], [1, 1]),
+                Utterance(3.0, "natlink", "notepad", [u"save", u"file"], [1, 1]),
+            ], grammars)
+        finally:
+            for grammar in grammars:
+                grammar.unload()
+        self.assertEqual(["chrome", "emacs"], results)
+        self.assertEqual(1, failures)
+        self.assertEqual(2, len(observer.dispatch_times))
+        self.assertIsNotNone(chrome.context)
+
+
+if __name__ == "__main__":
+    unittest.main()